@@ -0,0 +1,301 @@
+"""
+Packed, indexed archives of finished sessions.  Moving a session to tape or
+object storage as its many thousand small files is slow, so each session is
+written to a single archive, alongside an index of its members:
+
+    DEST_DIR/sub-X_ses-Y.tar.gz              the session folder, as a tar
+    DEST_DIR/sub-X_ses-Y.tar.gz.index.json   chunk offsets and members
+
+The tar stream is cut into chunks of a fixed uncompressed size, each
+compressed by a pool of threads into a gzip member of its own.  Concatenated
+gzip members are a valid gzip file, so the archive may be unpacked by tar
+-xzf as any other.  The index records where each chunk starts in the archive,
+and where each member's data starts in the tar stream, so that a single file,
+e.g. one dtseries.nii for QC, is extracted by decompressing only the chunks
+holding it:
+
+    nhp-abcd-bids-pipeline archive create DEST_DIR OUTPUT_DIR...
+    nhp-abcd-bids-pipeline archive list ARCHIVE
+    nhp-abcd-bids-pipeline archive extract ARCHIVE PATH... [-o DIR]
+"""
+import argparse
+import collections
+import fnmatch
+import glob
+import json
+import os
+import sys
+import tarfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+INDEX = '.index.json'
+# uncompressed bytes per gzip member
+CHUNK = 2 ** 22
+LEVEL = 6
+
+
+class ChunkWriter(object):
+    """
+    file object compressing what is written to it in chunks, each as a gzip
+    member of its own, by a pool of threads.
+    """
+
+    def __init__(self, fd, ncpus=1, level=LEVEL):
+        self.fd = fd
+        self.level = level
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.pool = ThreadPoolExecutor(max_workers=max(1, ncpus))
+        # bounds the memory held by chunks waiting to be written
+        self.max_pending = 2 * max(1, ncpus)
+        self.offsets = []
+        self.size = 0
+
+    def _compress(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    def _write_next(self):
+        self.offsets.append(self.fd.tell())
+        self.fd.write(self.pending.popleft().result())
+
+    def _submit(self, data):
+        self.pending.append(self.pool.submit(self._compress, bytes(data)))
+        while len(self.pending) > self.max_pending:
+            self._write_next()
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= CHUNK:
+            self._submit(self.buffer[:CHUNK])
+            del self.buffer[:CHUNK]
+        return len(data)
+
+    def close(self):
+        if self.buffer:
+            self._submit(self.buffer)
+            self.buffer = bytearray()
+        while self.pending:
+            self._write_next()
+        self.pool.shutdown()
+
+
+def create_archive(session_dir, archive, root, ncpus=1, level=LEVEL):
+    """
+    archives a session folder, writing archive and its index.
+    :param session_dir: session folder, e.g. output_dir/sub-X/ses-Y
+    :param archive: path of the archive to write.
+    :param root: folder member paths are relative to, e.g. output_dir
+    :param ncpus: number of compressing threads.
+    :param level: gzip compression level.
+    :return: index dict.
+    """
+    start = time.time()
+    tmp = '%s.tmp-%d' % (archive, os.getpid())
+    members = []
+    with open(tmp, 'wb') as fd:
+        writer = ChunkWriter(fd, ncpus, level)
+        with tarfile.open(fileobj=writer, mode='w|',
+                          format=tarfile.PAX_FORMAT) as tar:
+            for folder, dirs, files in os.walk(session_dir):
+                dirs.sort()
+                # links to folders are listed, but not walked, as folders
+                links = [d for d in dirs
+                         if os.path.islink(os.path.join(folder, d))]
+                for name in [''] + sorted(files + links):
+                    path = os.path.join(folder, name) if name else folder
+                    arcname = os.path.relpath(path, root)
+                    info = tar.gettarinfo(path, arcname)
+                    if info.isreg():
+                        with open(path, 'rb') as data:
+                            tar.addfile(info, data)
+                    else:
+                        tar.addfile(info)
+                    entry = {'path': arcname, 'size': info.size,
+                             'mode': info.mode, 'mtime': info.mtime}
+                    if info.isreg():
+                        entry['type'] = 'file'
+                        # data ends at the next header, padded to a block
+                        entry['offset'] = tar.offset - \
+                            -(-info.size // tarfile.BLOCKSIZE) * \
+                            tarfile.BLOCKSIZE
+                    elif info.isdir():
+                        entry['type'] = 'dir'
+                    else:
+                        entry['type'] = 'hardlink' if info.islnk() else \
+                            'symlink' if info.issym() else 'other'
+                        entry['target'] = info.linkname
+                    members.append(entry)
+        writer.close()
+        end = fd.tell()
+    index = {'archive': os.path.basename(archive), 'chunk_size': CHUNK,
+             'chunks': writer.offsets + [end], 'tar_size': writer.size,
+             'members': members, 'created': time.time()}
+    with open(tmp + INDEX, 'w') as fd:
+        json.dump(index, fd)
+    os.rename(tmp, archive)
+    os.rename(tmp + INDEX, archive + INDEX)
+    print('archived %s to %s: %d members, %.1f MB to %.1f MB in %.1fs' % (
+        session_dir, archive, len(members), writer.size / 2. ** 20,
+        end / 2. ** 20, time.time() - start))
+    return index
+
+
+class Archive(object):
+    """
+    random access to the members of an indexed archive.
+    """
+
+    def __init__(self, archive):
+        self.path = archive
+        with open(archive + INDEX) as fd:
+            self.index = json.load(fd)
+        self.members = collections.OrderedDict(
+            (m['path'], m) for m in self.index['members'])
+
+    def iter_range(self, offset, size):
+        """
+        yields size bytes of the tar stream from offset, chunk by chunk,
+        decompressing only the chunks holding them.
+        """
+        chunk_size = self.index['chunk_size']
+        chunks = self.index['chunks']
+        start = offset % chunk_size
+        with open(self.path, 'rb') as fd:
+            for i in range(offset // chunk_size, len(chunks) - 1):
+                if size <= 0:
+                    break
+                fd.seek(chunks[i])
+                data = zlib.decompress(fd.read(chunks[i + 1] - chunks[i]),
+                                       31)[start:start + size]
+                size -= len(data)
+                start = 0
+                yield data
+
+    def _file_member(self, path):
+        member = self.members[path]
+        if member['type'] == 'hardlink':
+            member = self.members[member['target']]
+        if member['type'] != 'file':
+            raise ValueError('%s is not a file' % path)
+        return member
+
+    def read(self, path):
+        """
+        :param path: member path, as listed.
+        :return: contents of a file member.
+        """
+        member = self._file_member(path)
+        return b''.join(self.iter_range(member['offset'], member['size']))
+
+    def extract(self, path, output_dir):
+        """
+        extracts a single member.
+        :return: path of the extracted file.
+        """
+        member = self.members[path]
+        target = os.path.join(output_dir, path)
+        os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+        if member['type'] == 'dir':
+            os.makedirs(target, exist_ok=True)
+            return target
+        if member['type'] == 'symlink':
+            if os.path.lexists(target):
+                os.remove(target)
+            os.symlink(member['target'], target)
+            return target
+        source = self._file_member(path)
+        with open(target, 'wb') as fd:
+            for block in self.iter_range(source['offset'], source['size']):
+                fd.write(block)
+        os.chmod(target, member['mode'])
+        os.utime(target, (member['mtime'], member['mtime']))
+        return target
+
+
+def find_sessions(path):
+    """
+    :param path: pipeline output directory or session folder.
+    :return: list of (session folder, output directory) under path.
+    """
+    sessions = sorted(glob.glob(os.path.join(path, 'sub-*', 'ses-*')))
+    if sessions:
+        return [(s, path) for s in sessions if os.path.isdir(s)]
+    path = os.path.normpath(path)
+    return [(path, os.path.dirname(os.path.dirname(path)))]
+
+
+def generate_parser(parser=None):
+    """
+    Generates the command line parser for the archive mode.
+    :param parser: optional subparser for wrapping this program as a submodule.
+    :return: ArgumentParser for this script/module
+    """
+    if not parser:
+        parser = argparse.ArgumentParser(
+            prog='nhp-abcd-bids-pipeline archive',
+            description='pack finished sessions into single, indexed '
+                        'tar.gz archives, from which single files may be '
+                        'extracted without unpacking the whole session.'
+        )
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    create = commands.add_parser(
+        'create', help='archive every session of the output directories.')
+    create.add_argument(
+        'dest_dir', help='folder to write the archives to.')
+    create.add_argument(
+        'output_dirs', nargs='+', metavar='OUTPUT_DIR',
+        help='pipeline output directories or session folders.')
+    create.add_argument(
+        '--ncpus', type=int, default=1,
+        help='number of compressing threads. Default = 1.')
+    create.add_argument(
+        '--level', type=int, default=LEVEL, choices=range(1, 10),
+        help='gzip compression level. Default = %d.' % LEVEL)
+    listing = commands.add_parser(
+        'list', help='list the members of an archive.')
+    listing.add_argument('archive')
+    extract = commands.add_parser(
+        'extract', help='extract members of an archive by path or pattern.')
+    extract.add_argument('archive')
+    extract.add_argument(
+        'paths', nargs='+', metavar='PATH',
+        help='member paths, as listed, or shell patterns.')
+    extract.add_argument(
+        '-o', '--output-dir', default='.',
+        help='folder to extract to. Default = current directory.')
+    return parser
+
+
+def _cli(mode='archive', argv=None):
+    args = generate_parser().parse_args(argv)
+    if args.command == 'create':
+        os.makedirs(args.dest_dir, exist_ok=True)
+        for path in args.output_dirs:
+            for session_dir, root in find_sessions(path):
+                name = '_'.join(os.path.relpath(session_dir, root).split(
+                    os.sep)) + '.tar.gz'
+                create_archive(session_dir, os.path.join(args.dest_dir, name),
+                               root, args.ncpus, args.level)
+    elif args.command == 'list':
+        for member in Archive(args.archive).members.values():
+            print('%-8s %12d  %s' % (member['type'], member['size'],
+                                     member['path']))
+    else:
+        archive = Archive(args.archive)
+        names = [name for name in archive.members if any(
+            fnmatch.fnmatchcase(name, p) for p in args.paths)]
+        if not names:
+            print('no members match %s' % ' '.join(args.paths))
+            return 1
+        for name in names:
+            print(archive.extract(name, args.output_dir))
+    return 0
+
+
+if __name__ == '__main__':
+    exit(_cli(argv=sys.argv[1:]))
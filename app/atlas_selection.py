@@ -0,0 +1,212 @@
+"""
+Preselection of joint label fusion atlases.  JLF in PreFreeSurfer registers
+every atlas of --multi-template-dir to the subject, so its cost grows with the
+number of atlases.  With --jlf-top-k K, the atlases are first ranked by their
+similarity to the subject's T1w and only the K most similar are passed on.
+
+Similarity is the normalised cross-correlation of downsampled volumes after a
+quick alignment: each atlas brain is sampled on a grid spanning its
+intensity weighted spread around its centre of mass, the subject's T1w on the
+same grid around the subject's centre of mass, so that differences in size
+and shape count against an atlas.  The atlases and the subject are assumed to
+share an axis orientation, as the T1w images of a study usually do.  Voxel
+data is memory-mapped where uncompressed, and the sampled atlases are kept
+for the process, so that each is read once per run.
+
+Requires numpy.
+"""
+import gzip
+import json
+import os
+
+from helpers import read_nifti_header
+
+SELECTION = 'jlf_selection.json'
+ATLAS_IMAGE = 'T1w_brain.nii.gz'
+
+# sample points per axis.
+GRID = 40
+# extent of the sampling grid, in standard deviations of the atlas brain.
+EXTENT = 2.5
+# voxels per axis above which volumes are strided before the moments are
+# computed.
+MAX_SHAPE = 96
+
+# nifti datatype codes
+DTYPES = {2: 'u1', 4: 'i2', 8: 'i4', 16: 'f4', 64: 'f8', 256: 'i1',
+          512: 'u2', 768: 'u4', 1024: 'i8', 1280: 'u8'}
+
+# sampled atlases of this process, by atlas image and modification time
+_atlases = {}
+
+
+def read_volume(filename):
+    """
+    reads the first volume of a nifti-1 or nifti-2 image, memory-mapped if
+    uncompressed.
+    :param filename: path to .nii or .nii.gz file.
+    :return: (3d array of voxel values, voxel sizes in mm)
+    """
+    import numpy as np
+    header = read_nifti_header(filename)
+    if header['datatype'] not in DTYPES:
+        raise ValueError('unsupported nifti datatype %d in %s' %
+                         (header['datatype'], filename))
+    dtype = np.dtype(DTYPES[header['datatype']]).newbyteorder(
+        header['endian'])
+    shape = tuple(max(1, d) for d in (header['dims'] + (1, 1))[:3])
+    count = shape[0] * shape[1] * shape[2]
+    if filename.endswith('.gz'):
+        with gzip.open(filename, 'rb') as fd:
+            fd.seek(header['vox_offset'])
+            data = np.frombuffer(fd.read(count * dtype.itemsize), dtype)
+    else:
+        data = np.memmap(filename, dtype, 'r', header['vox_offset'],
+                         (count,))
+    data = data.reshape(shape, order='F')
+    slope, inter = header['slope'], header['inter']
+    # a slope of 0 means the values are not scaled
+    if slope != 0 and (slope != 1 or inter != 0):
+        data = data * slope + inter
+    pixdim = (header['pixdim'] + (1, 1))[:3]
+    return data, np.abs(np.array(pixdim, dtype=float))
+
+
+def _moments(data, voxel_size):
+    """
+    :return: (centre of mass, standard deviation per axis) in mm of the
+    foreground of a volume, strided down to at most MAX_SHAPE voxels per
+    axis.
+    """
+    import numpy as np
+    step = max(1, -(-max(data.shape) // MAX_SHAPE))
+    data = np.asarray(data[::step, ::step, ::step], dtype=np.float32)
+    positive = data[data > 0]
+    if not positive.size:
+        raise ValueError('empty volume')
+    weights = np.where(data > 0.1 * np.percentile(positive, 99), data, 0)
+    total = weights.sum()
+    centre, spread = [], []
+    for axis in range(3):
+        other = tuple(a for a in range(3) if a != axis)
+        profile = weights.sum(axis=other)
+        mm = np.arange(profile.size) * step * voxel_size[axis]
+        mean = (profile * mm).sum() / total
+        centre.append(mean)
+        spread.append(np.sqrt((profile * (mm - mean) ** 2).sum() / total))
+    return np.array(centre), np.array(spread)
+
+
+def _sample(data, voxel_size, centre, offsets):
+    """
+    samples a volume at centre + offsets (in mm, one array per axis) by
+    nearest neighbour, zero outside of the volume.
+    """
+    import numpy as np
+    index, inside = [], True
+    for axis in range(3):
+        i = np.rint((centre[axis] + offsets[axis]) / voxel_size[axis])
+        i = i.astype(np.int64)
+        valid = (i >= 0) & (i < data.shape[axis])
+        index.append(np.clip(i, 0, data.shape[axis] - 1))
+        inside = inside & valid.reshape([-1 if a == axis else 1
+                                         for a in range(3)])
+    sample = np.asarray(data[np.ix_(*index)], dtype=np.float32)
+    return np.where(inside, sample, 0)
+
+
+def _sample_atlas(filename):
+    """
+    :return: (sampling offsets per axis in mm, sampled atlas brain)
+    """
+    import numpy as np
+    data, voxel_size = read_volume(filename)
+    centre, spread = _moments(data, voxel_size)
+    offsets = [np.linspace(-EXTENT, EXTENT, GRID) * s for s in spread]
+    return offsets, _sample(data, voxel_size, centre, offsets)
+
+
+def load_atlas(filename):
+    """
+    :param filename: atlas brain image.
+    :return: (sampling offsets per axis in mm, sampled atlas brain)
+    """
+    key = (os.path.realpath(filename), os.stat(filename).st_mtime_ns)
+    if key not in _atlases:
+        _atlases[key] = _sample_atlas(filename)
+    return _atlases[key]
+
+
+def ncc(a, b):
+    """
+    :return: normalised cross-correlation of two arrays.
+    """
+    import numpy as np
+    a = a - a.mean()
+    b = b - b.mean()
+    norm = np.sqrt((a * a).sum() * (b * b).sum())
+    return float((a * b).sum() / norm) if norm else 0.
+
+
+def rank_atlases(t1w, multi_template_dir, brain_mask=None):
+    """
+    :param t1w: subject T1w image.
+    :param multi_template_dir: joint label fusion atlases, see
+    --multi-template-dir
+    :param brain_mask: optional subject brain mask, see --t1-brain-mask
+    :return: list of (atlas folder name, score), most similar first.
+    """
+    data, voxel_size = read_volume(t1w)
+    if brain_mask:
+        data = data * (read_volume(brain_mask)[0] > 0)
+    centre, _ = _moments(data, voxel_size)
+    scores = []
+    for atlas in sorted(os.listdir(multi_template_dir)):
+        image = os.path.join(multi_template_dir, atlas, ATLAS_IMAGE)
+        if not os.path.isfile(image):
+            continue
+        offsets, sample = load_atlas(image)
+        subject = _sample(data, voxel_size, centre, offsets)
+        # over the whole grid, so that the background around a smaller
+        # atlas brain counts against it
+        scores.append((atlas, ncc(subject, sample)))
+    return sorted(scores, key=lambda x: -x[1])
+
+
+def select_atlases(t1w, multi_template_dir, k, output_dir, log_dir,
+                   brain_mask=None):
+    """
+    links the k atlases most similar to the subject into a folder of their
+    own, logging the ranking to log_dir/jlf_selection.json
+    :param t1w: subject T1w image.
+    :param multi_template_dir: joint label fusion atlases.
+    :param k: number of atlases to select.
+    :param output_dir: folder for links to the selected atlases.
+    :param log_dir: session log folder.
+    :param brain_mask: optional subject brain mask.
+    :return: output_dir
+    """
+    scores = rank_atlases(t1w, multi_template_dir, brain_mask)
+    if not scores:
+        raise ValueError('no joint label fusion atlases in %s' %
+                         multi_template_dir)
+    selected = [atlas for atlas, _ in scores[:k]]
+    os.makedirs(output_dir, exist_ok=True)
+    for entry in os.listdir(output_dir):
+        if os.path.islink(os.path.join(output_dir, entry)):
+            os.remove(os.path.join(output_dir, entry))
+    for atlas in selected:
+        os.symlink(os.path.abspath(os.path.join(multi_template_dir, atlas)),
+                   os.path.join(output_dir, atlas))
+
+    os.makedirs(log_dir, exist_ok=True)
+    with open(os.path.join(log_dir, SELECTION), 'w') as fd:
+        json.dump({'t1w': t1w, 'multi_template_dir': multi_template_dir,
+                   'k': k,
+                   'atlases': [{'atlas': atlas, 'score': score,
+                                'selected': atlas in selected}
+                               for atlas, score in scores]}, fd, indent=4)
+    print('selected %d of %d joint label fusion atlases: %s' % (
+        len(selected), len(scores), ', '.join(
+            '%s (%.3f)' % (atlas, score) for atlas, score in scores[:k])))
+    return output_dir
@@ -0,0 +1,200 @@
+"""
+Snapshots of the template and atlas files shared by a cohort.  The study
+template and the joint label fusion atlases, often kept on slow or changing
+storage, are copied once, under a file lock so that concurrent sessions,
+spool workers or nodes sharing the directory wait for the first copy rather
+than repeat it, then used by every session whose inputs have the same
+contents.  Nothing is derived from the inputs: files are copied
+byte-identical, so that a session gives the same results with or without
+a snapshot; of the atlases, only the files read by joint label fusion are
+kept:
+
+    CACHE_DIR/<snapshot>/<sha256 of snapshot version and file contents>/
+        manifest.json   inputs and copy time
+        ...             the copied files
+
+Input hashes are memoized in CACHE_DIR/hashes.json by path, size and
+modification time, so that a cohort's sessions hash each template once.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+
+MANIFEST = 'manifest.json'
+HASHES = 'hashes.json'
+
+# files read by joint label fusion from each atlas folder
+JLF_FILES = ('T1w_brain.nii.gz', 'Segmentation.nii.gz')
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        for block in iter(lambda: fd.read(2 ** 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class _Lock(object):
+    """
+    exclusive lock on a file, held across processes and nodes sharing it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.fd = open(self.path, 'a')
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.fd.close()
+
+
+class TemplateCache(object):
+
+    def __init__(self, root):
+        """
+        :param root: cache directory, may be shared by many runs.
+        """
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._hashes = None
+
+    def file_hash(self, path):
+        """
+        :return: sha256 of a file's contents, memoized by size and mtime.
+        """
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        if self._hashes is None:
+            self._hashes = self._read_hashes()
+        entry = self._hashes.get(path)
+        if entry and entry[:2] == stamp:
+            return entry[2]
+        digest = _sha256(path)
+        with _Lock(os.path.join(self.root, HASHES + '.lock')):
+            self._hashes = self._read_hashes()
+            self._hashes[path] = stamp + [digest]
+            tmp = os.path.join(self.root, '.%s.%d' % (HASHES, os.getpid()))
+            with open(tmp, 'w') as fd:
+                json.dump(self._hashes, fd)
+            os.replace(tmp, os.path.join(self.root, HASHES))
+        return digest
+
+    def _read_hashes(self):
+        try:
+            with open(os.path.join(self.root, HASHES)) as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return {}
+
+    def key(self, snapshot, inputs):
+        """
+        :param snapshot: name and version of the snapshot, e.g.
+        study-template-2
+        :param inputs: dict of name to input file.
+        :return: content address of the snapshot.
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps(
+            [snapshot, sorted((name, self.file_hash(path))
+                              for name, path in inputs.items())],
+            sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def get(self, snapshot, inputs, copy):
+        """
+        returns the snapshot folder, copying the inputs first unless done.
+        :param snapshot: name and version of the snapshot.
+        :param inputs: dict of name to input file.
+        :param copy: function(folder, inputs) copying the inputs to folder.
+        Raises on failure.
+        :return: path to the folder of the snapshot.
+        """
+        name = snapshot.rsplit('-', 1)[0]
+        folder = os.path.join(self.root, name, self.key(snapshot, inputs))
+        if os.path.exists(os.path.join(folder, MANIFEST)):
+            return folder
+        os.makedirs(os.path.dirname(folder), exist_ok=True)
+        with _Lock(folder + '.lock'):
+            # built by another process while waiting for the lock
+            if os.path.exists(os.path.join(folder, MANIFEST)):
+                return folder
+            tmp = '%s.tmp-%d' % (folder, os.getpid())
+            shutil.rmtree(tmp, ignore_errors=True)
+            os.makedirs(tmp)
+            start = time.time()
+            try:
+                copy(tmp, inputs)
+            except BaseException:
+                shutil.rmtree(tmp, ignore_errors=True)
+                raise
+            with open(os.path.join(tmp, MANIFEST), 'w') as fd:
+                json.dump({'snapshot': snapshot,
+                           'inputs': {k: os.path.realpath(v)
+                                      for k, v in inputs.items()},
+                           'created': time.time(),
+                           'copy_seconds': time.time() - start}, fd,
+                          indent=4)
+            shutil.rmtree(folder, ignore_errors=True)
+            os.rename(tmp, folder)
+        print('copied %s to %s' % (name, folder))
+        return folder
+
+
+def _copy_study_template(folder, inputs):
+    shutil.copyfile(inputs['head'],
+                    os.path.join(folder, 'template_head.nii.gz'))
+    shutil.copyfile(inputs['brain'],
+                    os.path.join(folder, 'template_brain.nii.gz'))
+
+
+def _copy_jlf_atlases(folder, inputs):
+    for name, path in sorted(inputs.items()):
+        atlas, filename = name.split('/')
+        os.makedirs(os.path.join(folder, atlas), exist_ok=True)
+        shutil.copyfile(path, os.path.join(folder, atlas, filename))
+
+
+def cache_study_template(cache, head, brain):
+    """
+    :param cache: TemplateCache
+    :param head: study template head, see --study-template
+    :param brain: study template brain.
+    :return: (head, brain) of the snapshot of the study template.
+    """
+    folder = cache.get('study-template-2', {'head': head, 'brain': brain},
+                       _copy_study_template)
+    return (os.path.join(folder, 'template_head.nii.gz'),
+            os.path.join(folder, 'template_brain.nii.gz'))
+
+
+def cache_jlf_atlases(cache, multi_template_dir):
+    """
+    :param cache: TemplateCache
+    :param multi_template_dir: joint label fusion atlases, see
+    --multi-template-dir
+    :return: snapshot of the atlas folder holding only the files read by
+    joint label fusion.
+    """
+    inputs = {}
+    for atlas in sorted(os.listdir(multi_template_dir)):
+        path = os.path.join(multi_template_dir, atlas)
+        if not os.path.isdir(path):
+            continue
+        for filename in JLF_FILES:
+            if not os.path.isfile(os.path.join(path, filename)):
+                raise ValueError('joint label fusion atlas %s has no %s' %
+                                 (path, filename))
+            inputs['%s/%s' % (atlas, filename)] = os.path.join(path, filename)
+    if not inputs:
+        raise ValueError('no joint label fusion atlases in %s' %
+                         multi_template_dir)
+    return cache.get('jlf-atlases-2', inputs, _copy_jlf_atlases)
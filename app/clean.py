@@ -0,0 +1,193 @@
+"""
+In-process cleaning of session outputs, a native stand-in for the dcan
+cleaning script run by CustomClean.  The custom-clean json names the paths,
+relative to a session's files folder, to remove, either as a list or as an
+object of path to true (remove) or false (keep).  Paths may contain shell
+wildcards, matched one path component at a time; a matched folder is removed
+with all of its contents.
+
+Sessions are scanned with os.scandir, descending only into folders under
+which a path may match, and files are removed by a pool of threads, which
+hides the latency of each removal on network filesystems.  With --dry-run,
+nothing is removed and the number of files and bytes which would be is
+reported.  Any number of finished sessions may be cleaned at once:
+
+    nhp-abcd-bids-pipeline clean [--dry-run] [--ncpus N] JSON OUTPUT_DIR...
+"""
+import argparse
+import fnmatch
+import glob
+import json
+import os
+import stat
+import sys
+from multiprocessing.pool import ThreadPool
+
+
+def load_patterns(filename):
+    """
+    :param filename: custom-clean json.
+    :return: list of path patterns to remove, as lists of path components.
+    """
+    with open(filename) as fd:
+        spec = json.load(fd)
+    if isinstance(spec, dict) and all(isinstance(v, bool)
+                                      for v in spec.values()):
+        paths = [path for path, remove in spec.items() if remove]
+    elif isinstance(spec, list) and all(isinstance(v, str) for v in spec):
+        paths = spec
+    else:
+        raise ValueError('%s is neither a list of paths to remove nor an '
+                         'object of path to true (remove) or false (keep)'
+                         % filename)
+    return [[part for part in path.split('/') if part not in ('', '.')]
+            for path in paths]
+
+
+def _match(parts, pattern):
+    return len(parts) == len(pattern) and all(
+        fnmatch.fnmatchcase(p, q) for p, q in zip(parts, pattern))
+
+
+def _below(parts, pattern):
+    return len(parts) < len(pattern) and all(
+        fnmatch.fnmatchcase(p, q) for p, q in zip(parts, pattern))
+
+
+def _tree(path, files, dirs):
+    """
+    adds the entries of a folder to be removed, deepest folders last.
+    """
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            _tree(entry.path, files, dirs)
+        else:
+            files.append((entry.path, entry.stat(follow_symlinks=False)))
+    dirs.append(path)
+
+
+def scan(folder, patterns):
+    """
+    :param folder: session files folder.
+    :param patterns: see load_patterns
+    :return: (files, folders) to remove, files as (path, stat) tuples and
+    folders deepest first.
+    """
+    files, dirs = [], []
+
+    def visit(path, parts):
+        for entry in os.scandir(path):
+            rel = parts + [entry.name]
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if any(_match(rel, p) for p in patterns):
+                if is_dir:
+                    _tree(entry.path, files, dirs)
+                else:
+                    files.append((entry.path,
+                                  entry.stat(follow_symlinks=False)))
+            elif is_dir and any(_below(rel, p) for p in patterns):
+                visit(entry.path, rel)
+
+    if os.path.isdir(folder):
+        visit(folder, [])
+    return files, dirs
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        return '%s: %s' % (path, e)
+
+
+def clean_sessions(folders, patterns, ncpus=1, dry_run=False):
+    """
+    removes the paths matching patterns from every session.
+    :param folders: session files folders.
+    :param patterns: see load_patterns
+    :param ncpus: number of threads scanning and removing.
+    :param dry_run: only report what would be removed.
+    :return: list of paths which could not be removed.
+    """
+    errors = []
+    with ThreadPool(processes=max(1, ncpus)) as pool:
+        found = pool.map(lambda f: scan(f, patterns), folders, chunksize=1)
+        for folder, (files, dirs) in zip(folders, found):
+            size = sum(st.st_size for _, st in files
+                       if stat.S_ISREG(st.st_mode))
+            if not dry_run:
+                errors += [e for e in pool.imap_unordered(
+                    _remove, [path for path, _ in files], chunksize=16) if e]
+                for path in dirs:
+                    try:
+                        os.rmdir(path)
+                    except FileNotFoundError:
+                        pass
+                    except OSError as e:
+                        errors.append('%s: %s' % (path, e))
+            print('%s %d files, %d folders, %.1f MB from %s' % (
+                'would remove' if dry_run else 'removed', len(files),
+                len(dirs), size / 2. ** 20, folder))
+    for error in errors:
+        print('could not remove %s' % error)
+    return errors
+
+
+def find_sessions(path):
+    """
+    :param path: pipeline output directory, session folder or files folder.
+    :return: files folders of the sessions under path.
+    """
+    sessions = sorted(glob.glob(os.path.join(path, 'sub-*', 'ses-*',
+                                             'files')))
+    if sessions:
+        return sessions
+    if os.path.isdir(os.path.join(path, 'files')):
+        return [os.path.join(path, 'files')]
+    return [path]
+
+
+def generate_parser(parser=None):
+    """
+    Generates the command line parser for the clean mode.
+    :param parser: optional subparser for wrapping this program as a submodule.
+    :return: ArgumentParser for this script/module
+    """
+    if not parser:
+        parser = argparse.ArgumentParser(
+            prog='nhp-abcd-bids-pipeline clean',
+            description='remove the outputs named in a custom-clean json '
+                        'from any number of finished sessions at once.'
+        )
+    parser.add_argument(
+        'cleaning_json', metavar='JSON',
+        help='custom-clean json, see nhp-abcd-bids-pipeline --custom-clean.'
+    )
+    parser.add_argument(
+        'output_dirs', nargs='+', metavar='OUTPUT_DIR',
+        help='pipeline output directories or session folders.'
+    )
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='only report the number of files and bytes which would be '
+             'removed.'
+    )
+    parser.add_argument(
+        '--ncpus', type=int, default=8,
+        help='number of threads scanning and removing files. Default = 8.'
+    )
+    return parser
+
+
+def _cli(mode='clean', argv=None):
+    args = generate_parser().parse_args(argv)
+    patterns = load_patterns(args.cleaning_json)
+    folders = [s for path in args.output_dirs for s in find_sessions(path)]
+    errors = clean_sessions(folders, patterns, args.ncpus, args.dry_run)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    exit(_cli(argv=sys.argv[1:]))
@@ -0,0 +1,106 @@
+"""
+Uncompressed intermediates.  The HCP scripts write every intermediate nifti
+gzip-compressed, only for the next tool to decompress it again.  With
+--uncompressed-intermediates, stages run with FSLOUTPUTTYPE=NIFTI, so that
+FSL tools write .nii files, and only the deliverables, the .nii.gz files of
+pipeline_expected_outputs.json, are compressed, by each stage's teardown
+before the next stage reads them.  Inputs a stage takes from an earlier one
+which are not expected outputs are resolved in either form, see
+helpers.find_output.  Other intermediates stay uncompressed in the output
+directory, taking typically 2-3 times the space.
+
+Each file is compressed in blocks by a pool of threads (zlib releases the
+GIL), as pigz does: every block is raw deflate data, primed with the 32 KB
+before it and ended by a sync flush, so that the blocks concatenate into a
+single deflate stream.  The file is written as one gzip member, whose
+trailer records the CRC32 and length of the whole file, so that readers
+which check the trailer's length, e.g. helpers.verify_output, accept it.
+Compressed files keep the modification time of the .nii, so that forks
+still tell the stages' outputs apart, see fork.py
+"""
+import mmap
+import os
+import shutil
+import struct
+import zlib
+from multiprocessing.pool import ThreadPool
+
+# uncompressed bytes per deflate block
+BLOCK = 2 ** 24
+LEVEL = 6
+# deflate's window, the data a block may refer back to
+WINDOW = 2 ** 15
+# magic, deflate, no flags, no modification time, no extra flags, unix
+HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03'
+
+
+def _compress_block(data, offset, size):
+    """
+    :return: raw deflate data of the block of data at offset, ending the
+    stream if it is the last.
+    """
+    end = min(offset + BLOCK, size)
+    if offset:
+        compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, -15,
+                                      zdict=data[max(0, offset - WINDOW):
+                                                 offset])
+    else:
+        compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, -15)
+    return compressor.compress(data[offset:end]) + compressor.flush(
+        zlib.Z_FINISH if end == size else zlib.Z_SYNC_FLUSH)
+
+
+def compress_file(filename, pool):
+    """
+    compresses filename to filename.gz, then removes filename.
+    :param filename: path to an uncompressed file.
+    :param pool: ThreadPool compressing the blocks.
+    :return: (uncompressed, compressed) size in bytes.
+    """
+    target = filename + '.gz'
+    tmp = '%s.tmp-%d' % (target, os.getpid())
+    size = os.path.getsize(filename)
+    crc = 0
+    with open(filename, 'rb') as fd, open(tmp, 'wb') as out:
+        out.write(HEADER)
+        if size:
+            data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                offsets = range(0, size, BLOCK)
+                blocks = pool.imap(
+                    lambda offset: _compress_block(data, offset, size),
+                    offsets)
+                for offset, block in zip(offsets, blocks):
+                    crc = zlib.crc32(data[offset:offset + BLOCK], crc)
+                    out.write(block)
+            finally:
+                data.close()
+        else:
+            out.write(_compress_block(b'', 0, 0))
+        out.write(struct.pack('<II', crc, size % 2 ** 32))
+    shutil.copystat(filename, tmp)
+    os.rename(tmp, target)
+    os.remove(filename)
+    return size, os.path.getsize(target)
+
+
+def compress_outputs(outputs, ncpus=1):
+    """
+    compresses the expected outputs which were written uncompressed.
+    :param outputs: expected outputs, see Stage.get_expected_outputs
+    :param ncpus: number of threads.
+    :return: number of files compressed.
+    """
+    pending = {p[:-3] for p in outputs if p.endswith('.nii.gz') and
+               os.path.isfile(p[:-3]) and not os.path.exists(p)}
+    before = after = 0
+    with ThreadPool(processes=max(1, ncpus)) as pool:
+        # largest first, as their blocks keep every thread busy
+        for filename in sorted(pending, key=lambda f: -os.path.getsize(f)):
+            sizes = compress_file(filename, pool)
+            before += sizes[0]
+            after += sizes[1]
+    if pending:
+        print('compressed %d outputs, %.1f MB to %.1f MB' % (
+            len(pending), before / 2. ** 20, after / 2. ** 20))
+    return len(pending)
@@ -0,0 +1,411 @@
+"""
+Content-addressed deduplication of session outputs.  Every session's
+MNINonLinear and T1w folders hold byte-identical copies of template derived
+files, e.g. reference volumes, atlas surfaces and label tables.  Deduplication
+makes each such copy share its data with a single read-only object of a
+content store on the same filesystem:
+
+    STORE_DIR/objects/<size>/<blake2b of the contents>
+
+Only files whose size matches another file's, or an object's, are hashed, in
+a pool of threads reading memory-mapped files.  Where the filesystem supports
+reflinks, e.g. btrfs or xfs, a copy is replaced by a reflink of the object,
+which shares its data blocks until either is written to, but keeps its own
+inode, mode and modification time.  Any file may be deduplicated this way.
+
+Elsewhere, a copy is replaced by a hard link to the object.  A tool
+rewriting a hard linked file in place, rather than replacing it, would
+change every session's copy (objects are read-only, which does not stop
+root), and the file takes the object's modification time.  So only the
+declared expected outputs of the pipeline's stages are hard linked, as a
+stage which is rerun removes its expected outputs first.  The hard linked
+files of a session are recorded in its logs/dedup.json, and fork.py refuses
+to fork such a session, as it tells the outputs of stages apart by their
+modification time.  A file is replaced atomically, so a deduplication may be
+interrupted and run again.
+
+    nhp-abcd-bids-pipeline dedup STORE_DIR OUTPUT_DIR [OUTPUT_DIR ...]
+    nhp-abcd-bids-pipeline dedup --verify STORE_DIR
+
+Run on its own, the expected outputs of a session are those recorded in its
+checksum manifest, see manifest.py; without one, its files are only
+deduplicated by reflinks.
+"""
+import argparse
+import errno
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import stat
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+from clean import find_sessions
+from fork import FICLONE, UNSUPPORTED
+
+OBJECTS = 'objects'
+# record of a session's hard linked files, in its log folder
+RECORD = 'dedup.json'
+# files smaller than this are left alone, their links would save little.
+MIN_SIZE = 4096
+BUFFER = 2 ** 24
+
+
+def file_hash(path):
+    """
+    :return: blake2b hex digest of a file's contents, read memory-mapped.
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, 'rb') as fd:
+        size = os.fstat(fd.fileno()).st_size
+        if size:
+            data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                # hashlib releases the GIL for blocks this large
+                for offset in range(0, size, BUFFER):
+                    digest.update(data[offset:offset + BUFFER])
+            finally:
+                data.close()
+    return digest.hexdigest()
+
+
+def _read_only(path):
+    mode = os.stat(path).st_mode
+    os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+
+class ContentStore(object):
+
+    def __init__(self, root):
+        """
+        :param root: store directory, on the filesystem of the outputs.
+        """
+        self.root = root
+        self.objects = os.path.join(root, OBJECTS)
+        os.makedirs(self.objects, exist_ok=True)
+        # until the filesystem is found not to support them
+        self.reflink = True
+
+    def sizes(self):
+        """
+        :return: set of the sizes of stored objects.
+        """
+        return {int(name) for name in os.listdir(self.objects)
+                if name.isdigit()}
+
+    def inodes(self):
+        """
+        :return: set of (device, inode) of stored objects.
+        """
+        inodes = set()
+        for root, dirs, files in os.walk(self.objects):
+            for name in files:
+                st = os.lstat(os.path.join(root, name))
+                inodes.add((st.st_dev, st.st_ino))
+        return inodes
+
+    def path(self, size, digest):
+        return os.path.join(self.objects, str(size), digest)
+
+    def _clone(self, src, dst):
+        """
+        :return: True if dst was written as a reflink of src, False if the
+        filesystem does not support reflinks.
+        """
+        if not self.reflink:
+            return False
+        try:
+            with open(src, 'rb') as s, open(dst, 'wb') as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return True
+        except OSError as e:
+            if os.path.exists(dst):
+                os.remove(dst)
+            if e.errno not in UNSUPPORTED:
+                raise
+            self.reflink = False
+            return False
+
+    def _store(self, path, size, digest, hardlink):
+        target = self.path(size, digest)
+        tmp = '%s.tmp-%d' % (target, os.getpid())
+        if self._clone(path, tmp):
+            _read_only(tmp)
+            try:
+                os.link(tmp, target)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            finally:
+                os.remove(tmp)
+            return 'copied'
+        if not hardlink:
+            return None
+        try:
+            os.link(path, target)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            # stored meanwhile
+            return self.add(path, size, digest, hardlink)
+        _read_only(target)
+        return 'stored'
+
+    def add(self, path, size, digest, hardlink=False):
+        """
+        makes path share the data of the object of its contents, by a reflink
+        where the filesystem supports them, else, if hardlink, by a hard link.
+        A file without an object is stored, as a reflink of it, else, if
+        hardlink, as a hard link to it.
+        :param path: file to deduplicate.
+        :param size: its size.
+        :param digest: its file_hash
+        :param hardlink: whether path may be replaced by a hard link.
+        :return: 'reflink' or 'hardlink' if path was replaced, 'copied' or
+        'stored' if a reflink of it, or it, became the object, None if it was
+        left alone.
+        """
+        target = self.path(size, digest)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if not os.path.exists(target):
+            return self._store(path, size, digest, hardlink)
+        tmp = '%s.dedup-%d' % (path, os.getpid())
+        if self._clone(target, tmp):
+            # the copy's own mode and modification time
+            shutil.copystat(path, tmp)
+            os.rename(tmp, path)
+            return 'reflink'
+        if not hardlink:
+            return None
+        os.link(target, tmp)
+        os.rename(tmp, path)
+        return 'hardlink'
+
+
+def expected_outputs(folders):
+    """
+    :param folders: session files folders.
+    :return: set of the files recorded in the sessions' checksum manifests.
+    """
+    # manifest.py hashes by file_hash
+    from manifest import read_manifest
+    outputs = set()
+    for folder in folders:
+        session = os.path.dirname(os.path.abspath(folder))
+        outputs.update(os.path.join(session, path) for path in
+                       read_manifest(os.path.join(session, 'logs')))
+    return outputs
+
+
+def record_hardlinks(session_dir, paths):
+    """
+    adds hard linked files to the session's record, see fork.py
+    :param session_dir: session folder, e.g. output_dir/sub-X/ses-Y
+    :param paths: paths of the files hard linked.
+    :return: None
+    """
+    log_dir = os.path.join(session_dir, 'logs')
+    filename = os.path.join(log_dir, RECORD)
+    try:
+        with open(filename) as fd:
+            record = json.load(fd)
+    except (OSError, ValueError):
+        record = {'hardlinked': []}
+    record['hardlinked'] = sorted(set(record['hardlinked']) | {
+        os.path.relpath(p, session_dir) for p in paths})
+    record['updated'] = time.time()
+    os.makedirs(log_dir, exist_ok=True)
+    with open(filename, 'w') as fd:
+        json.dump(record, fd, indent=4)
+
+
+def _candidates(folders, min_size):
+    for folder in folders:
+        for root, dirs, files in os.walk(folder):
+            for name in files:
+                path = os.path.join(root, name)
+                st = os.lstat(path)
+                if stat.S_ISREG(st.st_mode) and st.st_size >= min_size:
+                    yield folder, path, st
+
+
+def deduplicate(store, folders, ncpus=1, min_size=MIN_SIZE, outputs=None):
+    """
+    deduplicates the files of folders against the objects of store.
+    :param store: ContentStore
+    :param folders: session files folders, e.g. output_dir/sub-X/ses-Y/files
+    :param ncpus: number of hashing threads.
+    :param min_size: size in bytes below which files are left alone.
+    :param outputs: paths of the expected outputs, which may be hard linked.
+    Default = those of the sessions' checksum manifests.
+    :return: report dict.
+    """
+    start = time.time()
+    if outputs is None:
+        outputs = expected_outputs(folders)
+    outputs = {os.path.abspath(p) for p in outputs}
+    inodes = store.inodes()
+    files = [(f, p, st) for f, p, st in _candidates(folders, min_size)
+             if (st.st_dev, st.st_ino) not in inodes]
+    counts = {}
+    for _, _, st in files:
+        counts[st.st_size] = counts.get(st.st_size, 0) + 1
+    stored = store.sizes()
+    pending = [(f, p, st) for f, p, st in files
+               if counts[st.st_size] > 1 or st.st_size in stored]
+
+    report = {'folders': [os.path.abspath(f) for f in folders],
+              'scanned': len(files), 'hashed': len(pending), 'reflinked': 0,
+              'hardlinked': 0, 'stored': 0, 'kept': 0, 'skipped': 0,
+              'saved_bytes': 0}
+    hardlinked = {}
+    with ThreadPool(processes=max(1, ncpus)) as pool:
+        digests = pool.imap(lambda x: file_hash(x[1]), pending, chunksize=4)
+        for (folder, path, st), digest in zip(pending, digests):
+            # another link to a file stored meanwhile
+            if (st.st_dev, st.st_ino) in inodes:
+                continue
+            try:
+                result = store.add(path, st.st_size, digest,
+                                   os.path.abspath(path) in outputs)
+            except OSError as e:
+                # e.g. on another filesystem than the store
+                print('not deduplicating %s: %s' % (path, e))
+                report['skipped'] += 1
+                continue
+            if result in ('reflink', 'hardlink'):
+                report[result + 'ed'] += 1
+                report['saved_bytes'] += st.st_size
+            elif result in ('copied', 'stored'):
+                report['stored'] += 1
+            else:
+                report['kept'] += 1
+            if result in ('hardlink', 'stored'):
+                hardlinked.setdefault(folder, []).append(path)
+            if result == 'stored':
+                inodes.add((st.st_dev, st.st_ino))
+    for folder, paths in hardlinked.items():
+        record_hardlinks(os.path.dirname(os.path.abspath(folder)), paths)
+    report['seconds'] = time.time() - start
+    print('deduplicated %d of %d files, %d reflinked and %d hard linked, '
+          'saving %.1f MB' % (
+              report['reflinked'] + report['hardlinked'], report['scanned'],
+              report['reflinked'], report['hardlinked'],
+              report['saved_bytes'] / 2. ** 20))
+    return report
+
+
+def verify(store, ncpus=1, prune=False):
+    """
+    rehashes every object of store.
+    :param store: ContentStore
+    :param ncpus: number of hashing threads.
+    :param prune: remove objects no longer linked from any output.  Objects
+    shared by reflinks are not linked either, removing them keeps the
+    outputs' data, but later copies are no longer deduplicated against them.
+    :return: report dict, of corrupt and unused objects, and of the space
+    saved by the hard links to the others.
+    """
+    objects = []
+    for root, dirs, files in os.walk(store.objects):
+        for name in files:
+            objects.append(os.path.join(root, name))
+    report = {'objects': len(objects), 'corrupt': [], 'unused': [],
+              'links': 0, 'stored_bytes': 0, 'saved_bytes': 0}
+    with ThreadPool(processes=max(1, ncpus)) as pool:
+        digests = pool.imap(file_hash, objects, chunksize=4)
+        for path, digest in zip(objects, digests):
+            st = os.stat(path)
+            if digest != os.path.basename(path) or \
+                    st.st_size != int(os.path.basename(os.path.dirname(path))):
+                report['corrupt'].append(path)
+            if st.st_nlink == 1:
+                report['unused'].append(path)
+                if prune:
+                    os.remove(path)
+                continue
+            # one link is the store's, one the copy which would be kept
+            report['links'] += st.st_nlink - 1
+            report['stored_bytes'] += st.st_size
+            report['saved_bytes'] += st.st_size * (st.st_nlink - 2)
+    print('%d objects, %d corrupt, %d unused%s, %d links saving %.1f MB' % (
+        report['objects'], len(report['corrupt']), len(report['unused']),
+        ' (removed)' if prune else '', report['links'],
+        report['saved_bytes'] / 2. ** 20))
+    for path in report['corrupt']:
+        print('corrupt object: %s' % path)
+    return report
+
+
+def generate_parser(parser=None):
+    """
+    Generates the command line parser for the dedup mode.
+    :param parser: optional subparser for wrapping this program as a submodule.
+    :return: ArgumentParser for this script/module
+    """
+    if not parser:
+        parser = argparse.ArgumentParser(
+            prog='nhp-abcd-bids-pipeline dedup',
+            description='make identical files of finished sessions share '
+                        'the data of read-only objects of a content store '
+                        'on the same filesystem, by reflinks, else, for '
+                        'expected outputs, by hard links, or verify the '
+                        'store.'
+        )
+    parser.add_argument(
+        'store_dir',
+        help='content store directory, shared by all output directories.'
+    )
+    parser.add_argument(
+        'output_dirs', nargs='*', metavar='OUTPUT_DIR',
+        help='pipeline output directories or session folders to deduplicate.'
+    )
+    parser.add_argument(
+        '--verify', action='store_true',
+        help='rehash every stored object, reporting corrupt and unused '
+             'objects and the space saved.'
+    )
+    parser.add_argument(
+        '--prune', action='store_true',
+        help='with --verify, remove objects no longer linked from any output.'
+    )
+    parser.add_argument(
+        '--min-size', type=int, default=MIN_SIZE, metavar='BYTES',
+        help='leave files smaller than this alone. Default = %d.' % MIN_SIZE
+    )
+    parser.add_argument(
+        '--ncpus', type=int, default=1,
+        help='number of hashing threads. Default = 1.'
+    )
+    parser.add_argument(
+        '--report', metavar='FILE',
+        help='write the report to this json file.'
+    )
+    return parser
+
+
+def _cli(mode='dedup', argv=None):
+    parser = generate_parser()
+    args = parser.parse_args(argv)
+    store = ContentStore(args.store_dir)
+    if args.verify:
+        report = verify(store, args.ncpus, args.prune)
+    elif args.output_dirs:
+        folders = [s for path in args.output_dirs
+                   for s in find_sessions(path)]
+        report = deduplicate(store, folders, args.ncpus,
+                             args.min_size)
+    else:
+        parser.error('give output directories to deduplicate, or --verify')
+    if args.report:
+        with open(args.report, 'w') as fd:
+            json.dump(report, fd, indent=4)
+    return 1 if args.verify and report['corrupt'] else 0
+
+
+if __name__ == '__main__':
+    exit(_cli(argv=sys.argv[1:]))
@@ -0,0 +1,137 @@
+"""
+Forks of a session's outputs, to rerun the pipeline from a later stage with
+different settings without rerunning the earlier stages.  The output files
+of the stages before the fork point are linked into the fork as reflinks,
+which share data blocks until either copy is written to, where the
+filesystem supports them, else copied.  Hard links are never used, as a
+later stage of the fork rewriting an upstream output in place, e.g.
+PostFreeSurfer's fslmaths on T1w_acpc_dc_restore_brain, would write into the
+source and every other fork of it.  Files written by the source's later
+stages are left out, telling them apart by being newer than the status.json
+of the last stage before the fork point.
+
+Sessions deduplicated by hard links, see dedup.py, cannot be forked.  Many
+forks of the same source may run concurrently, the source itself is not
+written to.
+"""
+import errno
+import fcntl
+import json
+import os
+import shutil
+import time
+
+from pipelines import Status
+
+RECORD = 'fork.json'
+
+# ioctl cloning a file's extents, linux/fs.h
+FICLONE = 0x40049409
+# reflinks are not supported by the filesystem
+UNSUPPORTED = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV,
+               errno.EPERM)
+
+
+class Linker(object):
+    """
+    links files as reflinks where the filesystem supports them, else copies
+    them.
+    """
+
+    def __init__(self):
+        self.reflink = True
+        self.counts = {'reflink': 0, 'copy': 0}
+
+    def __call__(self, src, dst):
+        if self.reflink:
+            try:
+                with open(src, 'rb') as s, open(dst, 'wb') as d:
+                    fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+                shutil.copystat(src, dst)
+                self.counts['reflink'] += 1
+                return
+            except OSError as e:
+                if e.errno not in UNSUPPORTED:
+                    raise
+                os.remove(dst)
+                self.reflink = False
+        shutil.copy2(src, dst)
+        self.counts['copy'] += 1
+
+
+def get_cutoff(source, upstream):
+    """
+    :param source: session output folder, e.g. output_dir/sub-X/ses-Y
+    :param upstream: names of the stages before the fork point, in order.
+    :return: modification time of the last upstream stage's status.json
+    """
+    from dedup import RECORD
+    if os.path.exists(os.path.join(source, 'logs', RECORD)):
+        # hard linked files have the modification time of the stored object
+        raise ValueError('%s has been deduplicated by hard links, whose '
+                         'modification times no longer tell the stages '
+                         'apart, see %s' % (source, RECORD))
+    stage = upstream[-1]
+    path = os.path.join(source, 'logs', stage, Status.name)
+    try:
+        with open(path) as fd:
+            status = json.load(fd)
+    except (OSError, ValueError):
+        raise ValueError('%s has not been run in %s' % (stage, source))
+    if status['node_status'] != Status.states['succeeded']:
+        raise ValueError('%s has not succeeded in %s' % (stage, source))
+    return os.stat(path).st_mtime
+
+
+def fork_session(source, target, upstream):
+    """
+    forks a session's outputs after the upstream stages.  Files which
+    already exist in target are kept, so that a fork may be resumed.
+    :param source: session output folder, e.g. output_dir/sub-X/ses-Y
+    :param target: session output folder of the fork.
+    :param upstream: names of the stages before the fork point, in order.
+    :return: dict of number of files by link method, and of newer files
+    left out.
+    """
+    cutoff = get_cutoff(source, upstream)
+    link = Linker()
+    newer = 0
+    files = os.path.join(source, 'files')
+    for root, dirs, filenames in os.walk(files):
+        folder = os.path.join(target, 'files', os.path.relpath(root, files))
+        for filename in filenames:
+            src = os.path.join(root, filename)
+            dst = os.path.join(folder, filename)
+            if os.path.lexists(dst):
+                continue
+            if os.lstat(src).st_mtime > cutoff:
+                newer += 1
+                continue
+            # folders are only created for linked files, so that none is
+            # left behind from later stages, e.g. the FreeSurfer subject.
+            os.makedirs(folder, exist_ok=True)
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), dst)
+            else:
+                link(src, dst)
+
+    # logs and status files are rewritten in place, so are copied.
+    os.makedirs(os.path.join(target, 'logs'), exist_ok=True)
+    for stage in upstream:
+        logs = os.path.join(source, 'logs', stage)
+        for root, dirs, filenames in os.walk(logs):
+            folder = os.path.join(target, 'logs', stage,
+                                  os.path.relpath(root, logs))
+            os.makedirs(folder, exist_ok=True)
+            for filename in filenames:
+                shutil.copy2(os.path.join(root, filename), folder)
+
+    counts = dict(link.counts, newer=newer)
+    record = {'source': os.path.abspath(source), 'stages': upstream,
+              'cutoff': cutoff, 'created': time.time(), 'files': counts}
+    with open(os.path.join(target, 'logs', RECORD), 'w') as fd:
+        json.dump(record, fd, indent=4)
+    print('forked %s after %s: %d reflinked, %d copied, %d newer files left '
+          'out' % (source, upstream[-1], counts['reflink'], counts['copy'],
+                   newer))
+    return counts
@@ -1,12 +1,16 @@
+import glob
+import gzip
+import json
 import os
 import re
+import struct
+import zlib
 
 from itertools import product
 
-from bids.layout import BIDSLayout
 
-
-def read_bids_dataset(bids_input, subject_list=None, session_list=None, collect_on_subject=False):
+def read_bids_dataset(bids_input, subject_list=None, session_list=None, collect_on_subject=False,
+                      layout=None):
     """
     extracts and organizes relevant metadata from a bids dataset necessary
     for the dcan-modified hcp fmri processing pipeline.
@@ -15,27 +19,31 @@ def read_bids_dataset(bids_input, subject_list=None, session_list=None, collect_
     :param session_list: a list of session ids to filter on.
     :param collect_on_subject: collapses all sessions, for cases with
     non-longitudinal data spread across scan sessions.
+    :param layout: optional prebuilt BIDSLayout of bids_input, to avoid
+    reindexing the dataset.
     :return: bids data struct (nested dict)
     spec:
     {
       t1w: t1w filename list,
       t2w: t2w filename list,
-      t1w_metadata: bids meta data (first t1),
-      t2w_metadata: bids meta data (first t2),
+      t1w_metadata: ScanMetadata (first t1),
+      t2w_metadata: ScanMetadata (first t2),
       func: fmri filename list,
-      func_metadata: bids meta data list,
+      func_metadata: ScanMetadata list,
       fmap: {
         positive: spin echo filename list (if applicable)
         negative: spin echo filename list (if applicable)
       },
       fmap_metadata: {
-        positive: bids meta data list (if applicable)
-        negative: bids meta data list (if applicable)
+        positive: ScanMetadata list (if applicable)
+        negative: ScanMetadata list (if applicable)
       },
     }
     """
 
-    layout = BIDSLayout(bids_input, index_metadata=True)
+    if layout is None:
+        from bids.layout import BIDSLayout
+        layout = BIDSLayout(bids_input, index_metadata=True)
     subjects = layout.get_subjects()
 
     # filter subject list
@@ -88,7 +96,7 @@ def set_anatomicals(layout, subject, sessions):
     t1ws = layout.get(subject=subject, session=sessions, datatype='anat',
                       suffix='T1w', extension='.nii.gz')
     if len(t1ws):
-        t1w_metadata = layout.get_metadata(t1ws[0].path)
+        t1w_metadata = get_scan_metadata(layout, t1ws[0].path)
     else:
         print("No T1w data was found for this subject.")
         t1w_metadata = None
@@ -97,7 +105,7 @@ def set_anatomicals(layout, subject, sessions):
     t2ws = layout.get(subject=subject, session=sessions, datatype='anat',
                       suffix='T2w', extension='.nii.gz')
     if len(t2ws):
-        t2w_metadata = layout.get_metadata(t2ws[0].path)
+        t2w_metadata = get_scan_metadata(layout, t2ws[0].path)
     else:
         t2w_metadata = None
     spec = {
@@ -112,7 +120,7 @@ def set_anatomicals(layout, subject, sessions):
 def set_functionals(layout, subject, sessions):
     func = layout.get(subject=subject, session=sessions, datatype='func',
                       suffix='bold', extension='.nii.gz')
-    func_metadata = [layout.get_metadata(x.path) for x in func]
+    func_metadata = [get_scan_metadata(layout, x.path) for x in func]
 
     spec = {
         'func': [f.path for f in func],
@@ -124,17 +132,19 @@ def set_functionals(layout, subject, sessions):
 def set_fieldmaps(layout, subject, sessions):
     fmap = layout.get(subject=subject, session=sessions, datatype='fmap',
                       extension='.nii.gz')
-    fmap_metadata = [layout.get_metadata(x.path) for x in fmap]
+    fmap_metadata = [get_scan_metadata(layout, x.path) for x in fmap]
 
     # handle case spin echo
     types = [x.entities['suffix'] for x in fmap]
     indices = [i for i, x in enumerate(types) if x == 'epi']
     if len(indices):
         # @TODO read IntendedFor field to map field maps to functionals.
-        positive = [i for i, x in enumerate(fmap_metadata) if '-' not in x[
-            'PhaseEncodingDirection']]
-        negative = [i for i, x in enumerate(fmap_metadata) if '-' in x[
-            'PhaseEncodingDirection']]
+        # scans without a direction are kept as positive, for preflight to
+        # report, see preflight.check_session
+        positive = [i for i, x in enumerate(fmap_metadata) if '-' not in
+                    x.get('PhaseEncodingDirection', '')]
+        negative = [i for i, x in enumerate(fmap_metadata) if '-' in
+                    x.get('PhaseEncodingDirection', '')]
         fmap = {'positive': [fmap[i].path for i in positive],
                 'negative': [fmap[i].path for i in negative]}
         fmap_metadata = {
@@ -153,11 +163,124 @@ def set_fieldmaps(layout, subject, sessions):
     return spec
 
 
+class ScanMetadata(object):
+    """
+    the sidecar fields of a scan which the pipeline reads.  Only these are
+    kept in memory, so that many sessions may be planned in one process.
+    Supports read only dict access; any other field is read from the
+    complete sidecar, which is loaded from disk on first use.
+    """
+
+    fields = ('DwellTime', 'EffectiveEchoSpacing',
+              'ImageOrientationPatientDICOM',
+              'InPlanePhaseEncodingDirectionDICOM', 'IntendedFor',
+              'PhaseEncodingDirection', 'RepetitionTime')
+    __slots__ = ('path', '_sidecar') + fields
+
+    def __init__(self, path, metadata):
+        """
+        :param path: path to the scan's nifti.
+        :param metadata: bids metadata of the scan, of which only fields are
+        kept.
+        """
+        self.path = path
+        self._sidecar = None
+        for field in self.fields:
+            if field in metadata:
+                value = metadata[field]
+                if isinstance(value, list):
+                    value = tuple(value)
+                elif field == 'IntendedFor' and isinstance(value, str):
+                    value = (value,)
+                setattr(self, field, value)
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        return self.sidecar[key]
+
+    def __contains__(self, key):
+        if key in self.fields:
+            return hasattr(self, key)
+        return key in self.sidecar
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    @property
+    def sidecar(self):
+        """
+        :return: complete bids metadata of the scan.
+        """
+        if self._sidecar is None:
+            self._sidecar = read_sidecar(self.path)
+        return self._sidecar
+
+    def __repr__(self):
+        return 'ScanMetadata(%r, {%s})' % (self.path, ', '.join(
+            '%r: %r' % (f, getattr(self, f)) for f in self.fields
+            if hasattr(self, f)))
+
+
+def get_scan_metadata(layout, path):
+    """
+    queries the index for only the sidecar fields of a scan which the
+    pipeline reads, rather than building its complete metadata as
+    layout.get_metadata does.
+    :param layout: BIDSLayout indexed with metadata.
+    :param path: path to the scan's nifti.
+    :return: ScanMetadata
+    """
+    from bids.layout.models import Tag
+    tags = layout.session.query(Tag).filter(
+        Tag.file_path == path, Tag.entity_name.in_(ScanMetadata.fields))
+    return ScanMetadata(path, {t.entity_name: t.value for t in tags})
+
+
+def read_sidecar(filename):
+    """
+    reads the bids metadata of a nifti file, merging the json sidecars which
+    apply to it by the bids inheritance principle: from the dataset root
+    down to the file's own folder, less specific sidecars first.
+    :param filename: path to bids nifti.
+    :return: metadata dict
+    """
+    parts = os.path.basename(filename).split('.')[0].split('_')
+    suffix, entities = parts[-1], set(parts[:-1])
+    folders = []
+    folder = os.path.dirname(os.path.abspath(filename))
+    while True:
+        folders.append(folder)
+        parent = os.path.dirname(folder)
+        if parent == folder or os.path.exists(
+                os.path.join(folder, 'dataset_description.json')):
+            break
+        folder = parent
+
+    metadata = {}
+    for folder in reversed(folders):
+        sidecars = []
+        for sidecar in glob.glob(os.path.join(folder, '*%s.json' % suffix)):
+            parts = os.path.basename(sidecar)[:-len('.json')].split('_')
+            if parts[-1] == suffix and set(parts[:-1]) <= entities:
+                sidecars.append((len(parts), sidecar))
+        for _, sidecar in sorted(sidecars):
+            with open(sidecar) as fd:
+                metadata.update(json.load(fd))
+    return metadata
+
+
 def get_readoutdir(metadata):
     """
     get readout direction from bids metadata.  !!Note that this method only
     applies where the nifti orientation is RAS!!
-    :param metadata: grabbids metadata dict.
+    :param metadata: ScanMetadata or grabbids metadata dict.
     :return: unwarp dir in cartesian (world) coordinates.
     """
     iopd = metadata['ImageOrientationPatientDICOM']
@@ -279,6 +402,170 @@ def ijk_to_xyz(vec, patient_orientation=None):
     return vmap[vec]
 
 
+def read_nifti_header(filename):
+    """
+    reads the image dimensions and data layout from a nifti-1 or nifti-2
+    header without loading (or decompressing) any voxel data.
+    :param filename: path to .nii or .nii.gz file.
+    :return: dict of dims (tuple of image dimensions), datatype (nifti code),
+    bitpix (bits per voxel), pixdim (tuple of voxel sizes, one per
+    dimension), vox_offset (voxel data offset), slope and inter (scaling of
+    the voxel values, none if slope is 0) and endian ('<' or '>').
+    """
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rb') as fd:
+        header = fd.read(540)
+    for endian in '<>':
+        sizeof_hdr = struct.unpack(endian + 'i', header[:4])[0]
+        if sizeof_hdr == 348:
+            dim = struct.unpack(endian + '8h', header[40:56])
+            datatype, bitpix = struct.unpack(endian + '2h', header[70:74])
+            pixdim = struct.unpack(endian + '8f', header[76:108])
+            vox_offset = struct.unpack(endian + 'f', header[108:112])[0]
+            slope, inter = struct.unpack(endian + '2f', header[112:120])
+            break
+        elif sizeof_hdr == 540:
+            dim = struct.unpack(endian + '8q', header[16:80])
+            datatype, bitpix = struct.unpack(endian + '2h', header[12:16])
+            pixdim = struct.unpack(endian + '8d', header[104:168])
+            vox_offset = struct.unpack(endian + 'q', header[168:176])[0]
+            slope, inter = struct.unpack(endian + '2d', header[176:192])
+            break
+    else:
+        raise ValueError('not a nifti file: %s' % filename)
+    if not 0 < dim[0] <= 7:
+        raise ValueError('invalid dimensions in %s' % filename)
+    return {'dims': tuple(dim[1:dim[0] + 1]), 'datatype': datatype,
+            'bitpix': bitpix, 'pixdim': tuple(pixdim[1:dim[0] + 1]),
+            'vox_offset': int(vox_offset), 'slope': slope, 'inter': inter,
+            'endian': endian}
+
+
+def read_nifti_dims(filename):
+    """
+    :param filename: path to .nii or .nii.gz file.
+    :return: tuple of image dimensions, e.g. (x, y, z, t)
+    """
+    return read_nifti_header(filename)['dims']
+
+
+def get_nifti_volumes(dims):
+    """
+    :param dims: image dimensions, see read_nifti_dims
+    :return: number of time points of a nifti or cifti dense time series,
+    or 1 for a single volume.
+    """
+    # cifti matrices are stored along dimensions 5 and 6, time first
+    if len(dims) >= 5 and tuple(dims[:4]) == (1, 1, 1, 1):
+        return dims[4]
+    return dims[3] if len(dims) >= 4 else 1
+
+
+def _gzip_length(filename):
+    """
+    :return: uncompressed length of a gzip file, or -1 if it is truncated
+    or corrupt.
+    """
+    length = 0
+    try:
+        with gzip.open(filename, 'rb') as fd:
+            while True:
+                block = fd.read(2 ** 20)
+                if not block:
+                    return length
+                length += len(block)
+    except (OSError, EOFError, zlib.error):
+        return -1
+
+
+def get_nifti_variants(filename):
+    """
+    :param filename: path to a .nii or .nii.gz file.
+    :return: [filename, its uncompressed or compressed counterpart], or
+    [filename] for other files.
+    """
+    if filename.endswith('.nii.gz'):
+        return [filename, filename[:-3]]
+    if filename.endswith('.nii'):
+        return [filename, filename + '.gz']
+    return [filename]
+
+
+def find_output(filename):
+    """
+    :param filename: path to an expected output.
+    :return: filename, else its counterpart of the other nifti form if only
+    that exists, as when stages write uncompressed intermediates.
+    """
+    for variant in get_nifti_variants(filename):
+        if os.path.exists(variant):
+            return variant
+    return filename
+
+
+def verify_output(filename, volumes=None):
+    """
+    cheaply checks that an output file was completely written, without
+    reading its data: the file must be non-empty, a nifti must be at least
+    as long as its header says, a gzipped file's trailer must record the
+    uncompressed length of its nifti, and a time series must have the given
+    number of volumes.
+    :param filename: path to output file.
+    :param volumes: expected number of time points, if a time series.
+    :return: description of the problem, or None if the file looks complete.
+    """
+    try:
+        size = os.path.getsize(filename)
+    except OSError:
+        return 'file not found: %s' % filename
+    if not size:
+        return 'empty file: %s' % filename
+    is_nifti = filename.endswith(('.nii', '.nii.gz'))
+    if filename.endswith('.gz'):
+        with open(filename, 'rb') as fd:
+            magic = fd.read(2)
+            # shorter than a gzip header and trailer, e.g. truncated
+            if magic != b'\x1f\x8b' or size < 18:
+                return 'not a gzip file: %s' % filename
+            fd.seek(-4, os.SEEK_END)
+            isize = struct.unpack('<I', fd.read(4))[0]
+    if not is_nifti:
+        return None
+    try:
+        header = read_nifti_header(filename)
+    except (OSError, EOFError, ValueError, struct.error):
+        return 'unreadable nifti header: %s' % filename
+    dims = header['dims']
+    voxels = 1
+    for d in dims:
+        voxels *= max(d, 1)
+    length = header['vox_offset'] + voxels * header['bitpix'] // 8
+    if filename.endswith('.gz'):
+        # the trailer only covers the last member of a multi-member file,
+        # e.g. concatenated gzip files, so fall back to a full read.
+        if isize != length % 2 ** 32 and \
+                _gzip_length(filename) < length:
+            return 'truncated gzip stream: %s' % filename
+    elif size < length:
+        return 'truncated nifti: %s has %d of %d bytes' % (filename, size,
+                                                          length)
+    if volumes is not None and get_nifti_volumes(dims) not in (1, volumes):
+        return '%s has %d volumes, the input run has %d' % (
+            filename, get_nifti_volumes(dims), volumes)
+    return None
+
+
+def get_nifti_size(filename):
+    """
+    :param filename: path to .nii or .nii.gz file.
+    :return: number of voxels over all volumes, read from the header only.
+    """
+    size = 1
+    for d in read_nifti_dims(filename):
+        size *= max(d, 1)
+    return size
+
+
 def validate_license(freesurfer_license):
     fshome = os.environ['FREESURFER_HOME']
     license_txt = os.path.join(fshome, 'license.txt')
@@ -0,0 +1,169 @@
+"""
+Runtime history of pipeline stages, used to predict how long the remaining
+stages of a session will take so that sessions with the longest remaining
+critical path are started first.
+
+The history is a json lines file with one record per successful stage run:
+    {"stage": ..., "seconds": ..., "load": ..., <session features>}
+Records are appended under an flock of HISTORY.lock, as in metrics.py, so
+many processes may share one history file, e.g. in a spool directory.  Lines
+which cannot be parsed anyway, e.g. torn by a client crash on NFS, are
+skipped and counted rather than failing the scheduling.
+"""
+import fcntl
+import json
+import os
+import statistics
+
+from helpers import read_nifti_dims
+
+# stages with one subprocess per bold run, executed concurrently.
+PER_RUN_STAGES = ('FMRIVolume', 'FMRISurface', 'DCANBOLDProcessing')
+
+# prior durations in seconds, used until the history contains the stage.
+# Per-run stages are given in seconds per bold volume.
+DEFAULT_SECONDS = {
+    'PreliminaryMasking': 1800,
+    'PreFreeSurfer': 4 * 3600,
+    'FreeSurfer': 24 * 3600,
+    'PostFreeSurfer': 2 * 3600,
+    'FMRIVolume': 8.,
+    'FMRISurface': 1.,
+    'DCANBOLDProcessing': 2.,
+    'ExecutiveSummary': 600,
+    'CustomClean': 300,
+}
+
+# volumes assumed for a bold run whose header cannot be read.
+DEFAULT_VOLUMES = 300
+
+# features which must match for a record to be preferred in estimates.
+CATEGORICAL = ('t1_reg_method', 'norm_method')
+
+
+def session_features(config, ncpus=1):
+    """
+    describes a session by the features which determine stage durations.
+    :param config: ParameterSettings of the session.
+    :param ncpus: number of cores available to the session.
+    :return: json serializable dict of features.
+    """
+    volumes = []
+    for fmri in config.get_bids('func'):
+        try:
+            dims = read_nifti_dims(fmri)
+            volumes.append(dims[3] if len(dims) > 3 else 1)
+        except (OSError, ValueError):
+            volumes.append(None)
+    return {
+        't1_reg_method': config.t1_reg_method,
+        'norm_method': config.norm_method,
+        'use_t2': config.useT2,
+        'n_bold': len(volumes),
+        'volumes': volumes,
+        'ncpus': ncpus,
+    }
+
+
+def stage_load(stage_name, features):
+    """
+    size of a stage's work in the unit of DEFAULT_SECONDS.  For per-run
+    stages this is the number of volumes on the busiest core, assuming runs
+    are spread over the available cores.
+    """
+    if stage_name not in PER_RUN_STAGES:
+        return 1.
+    volumes = [v or DEFAULT_VOLUMES for v in features.get('volumes', [])]
+    if not volumes:
+        return 0.
+    cores = max(1, min(features.get('ncpus', 1), len(volumes)))
+    return float(max(max(volumes), sum(volumes) / cores))
+
+
+class History(object):
+    """
+    reads and appends stage duration records, and estimates durations.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path to the json lines history file.
+        """
+        self.path = path
+        self._cache = (None, [])
+        # lines of the file which could not be parsed
+        self.skipped = 0
+
+    def record(self, stage_name, features, seconds):
+        """
+        appends the duration of a successful stage run.
+        """
+        record = dict(features, stage=stage_name, seconds=seconds,
+                      load=stage_load(stage_name, features))
+        line = json.dumps(record) + '\n'
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.path, 'a') as fd:
+                    fd.write(line)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def records(self):
+        """
+        :return: list of all records, reread only when the file changes.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return []
+        if self._cache[0] != mtime:
+            records = []
+            skipped = 0
+            with open(self.path) as fd:
+                for line in fd:
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        skipped += 1
+                        continue
+                    if isinstance(record, dict) and 'stage' in record:
+                        records.append(record)
+                    else:
+                        skipped += 1
+            if skipped > self.skipped:
+                print('skipping %d unreadable lines of %s' % (skipped,
+                                                              self.path))
+            self.skipped = skipped
+            self._cache = (mtime, records)
+        return self._cache[1]
+
+    def estimate(self, stage_name, features):
+        """
+        predicts the wall time of a stage from the median rate (seconds per
+        unit of load) of previous runs of the stage, preferring runs with the
+        same categorical features.
+        :return: estimated seconds
+        """
+        load = stage_load(stage_name, features)
+        records = [r for r in self.records()
+                   if r['stage'] == stage_name and r.get('load')]
+        similar = [r for r in records
+                   if all(r.get(k) == features.get(k) for k in CATEGORICAL)]
+        records = similar or records
+        if records:
+            rate = statistics.median(r['seconds'] / r['load'] for r in records)
+        else:
+            rate = DEFAULT_SECONDS.get(stage_name, 0)
+        return rate * load
+
+    def critical_path(self, stage_names, features):
+        """
+        stages of a session run in sequence, so the critical path is the sum
+        of the estimated stage durations.
+        :param stage_names: remaining stages of the session.
+        :return: estimated seconds until the session completes
+        """
+        return sum(self.estimate(s, features) for s in stage_names)
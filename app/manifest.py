@@ -0,0 +1,93 @@
+"""
+Checksum manifest of a session's deliverables.  With --checksum-manifest,
+each stage's expected outputs are hashed once they have been verified, see
+Stage.teardown, so that a data release does not have to read every output
+again.  The manifest is kept in the session's log folder:
+
+    logs/manifest.json   path (relative to the session folder) to stage,
+                         size, modification time and blake2b (256 bit)
+    logs/checksums.b2    the same checksums, for b2sum -l 256 -c, run from
+                         the session folder
+
+The manifest is updated incrementally: an output whose size and modification
+time are unchanged since it was hashed is not read again, so reruns only
+hash what they rewrote.  Files are hashed memory-mapped by a pool of threads.
+"""
+import fcntl
+import json
+import os
+from multiprocessing.pool import ThreadPool
+
+from dedup import file_hash
+
+MANIFEST = 'manifest.json'
+CHECKSUMS = 'checksums.b2'
+ALGORITHM = 'blake2b-256'
+THREADS = 4
+
+
+def read_manifest(log_dir):
+    """
+    :param log_dir: session log folder.
+    :return: dict of relative path to entry, empty if there is no manifest.
+    """
+    try:
+        with open(os.path.join(log_dir, MANIFEST)) as fd:
+            return json.load(fd)['files']
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def _write(log_dir, files):
+    tmp = os.path.join(log_dir, '.%s.%d' % (MANIFEST, os.getpid()))
+    with open(tmp, 'w') as fd:
+        json.dump({'algorithm': ALGORITHM, 'files': files}, fd, indent=1,
+                  sort_keys=True)
+    os.replace(tmp, os.path.join(log_dir, MANIFEST))
+    tmp = os.path.join(log_dir, '.%s.%d' % (CHECKSUMS, os.getpid()))
+    with open(tmp, 'w') as fd:
+        for path in sorted(files):
+            fd.write('%s  %s\n' % (files[path]['blake2b'], path))
+    os.replace(tmp, os.path.join(log_dir, CHECKSUMS))
+
+
+def update_manifest(session_dir, log_dir, outputs, stage, threads=THREADS):
+    """
+    adds or refreshes the entries of outputs, and drops those of files which
+    no longer exist.
+    :param session_dir: session folder, e.g. output_dir/sub-X/ses-Y
+    :param log_dir: session log folder.
+    :param outputs: paths to existing output files.
+    :param stage: name of the stage which wrote them.
+    :param threads: number of hashing threads.
+    :return: (number of files hashed, number unchanged)
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    with open(os.path.join(log_dir, MANIFEST + '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        files = read_manifest(log_dir)
+        pending = []
+        unchanged = 0
+        for path in sorted(set(outputs)):
+            st = os.stat(path)
+            relpath = os.path.relpath(path, session_dir)
+            entry = files.get(relpath)
+            if entry and entry['size'] == st.st_size and \
+                    entry['mtime_ns'] == st.st_mtime_ns:
+                entry['stage'] = stage
+                unchanged += 1
+            else:
+                pending.append((path, relpath, st))
+        if pending:
+            with ThreadPool(processes=max(1, min(threads,
+                                                 len(pending)))) as pool:
+                digests = pool.map(file_hash, [p for p, _, _ in pending],
+                                   chunksize=1)
+            for (path, relpath, st), digest in zip(pending, digests):
+                files[relpath] = {'stage': stage, 'size': st.st_size,
+                                  'mtime_ns': st.st_mtime_ns,
+                                  'blake2b': digest}
+        files = {relpath: entry for relpath, entry in files.items()
+                 if os.path.isfile(os.path.join(session_dir, relpath))}
+        _write(log_dir, files)
+    return len(pending), unchanged
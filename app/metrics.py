@@ -0,0 +1,227 @@
+"""
+Pipeline metrics in the Prometheus text exposition format, written to a file
+for node_exporter's textfile collector, e.g.
+
+    --metrics-file /var/lib/node_exporter/textfile/nhp_abcd_bids.prom
+
+Every pipeline process on a node (plain runs, spool workers, server jobs and
+their pool processes) may share one metrics file: updates are serialized by
+a lock file, the cumulative state is kept beside the .prom file as json, and
+the .prom file is replaced atomically, so scrapes never see a partial file.
+Runs in flight and queued stages are tracked per process id and dropped once
+the process has exited, so the file should be on node-local storage.
+
+Like timing spans, recording is a no-op until a metrics file is set.
+"""
+import contextlib
+import fcntl
+import json
+import os
+import time
+
+PREFIX = 'nhp_pipeline'
+
+# upper bounds of the stage duration histogram buckets, in seconds
+DURATION_BUCKETS = (60, 300, 900, 1800, 3600, 7200, 14400, 28800, 57600,
+                    86400, 172800)
+
+_path = None
+
+
+def set_metrics_file(path):
+    """
+    :param path: .prom file to maintain, or None to stop recording.
+    """
+    global _path
+    _path = os.path.abspath(path) if path else None
+    if _path:
+        os.makedirs(os.path.dirname(_path), exist_ok=True)
+
+
+def _alive(pid):
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@contextlib.contextmanager
+def _locked_state():
+    """
+    yields the cumulative metrics state for modification, then saves it and
+    rewrites the .prom file, all under an exclusive lock.
+    """
+    with open(_path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            try:
+                with open(_path + '.json') as fd:
+                    state = json.load(fd)
+            except (OSError, ValueError):
+                state = {}
+            yield state
+            for key in ('in_flight', 'queued'):
+                state[key] = {pid: v for pid, v in
+                              state.get(key, {}).items() if _alive(pid)}
+            state['updated'] = time.time()
+            _replace(_path + '.json', json.dumps(state))
+            _replace(_path, render(state))
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _replace(path, text):
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as fd:
+        fd.write(text)
+    os.replace(tmp, path)
+
+
+def _add(table, key, value):
+    table[key] = table.get(key, 0) + value
+
+
+def stage_started(stage):
+    """
+    :param stage: name of the stage now running in this process.
+    """
+    if not _path:
+        return
+    with _locked_state() as state:
+        in_flight = state.setdefault('in_flight', {})
+        _add(in_flight.setdefault(str(os.getpid()), {}), stage, 1)
+
+
+def stage_finished(stage, seconds, succeeded):
+    """
+    :param stage: name of the stage which this process has finished.
+    :param seconds: wall time of the stage.
+    :param succeeded: final status of the stage.
+    """
+    if not _path:
+        return
+    with _locked_state() as state:
+        running = state.setdefault('in_flight', {}).get(str(os.getpid()), {})
+        if running.get(stage):
+            running[stage] -= 1
+        histogram = state.setdefault('durations', {}).setdefault(
+            stage, {'buckets': [0] * len(DURATION_BUCKETS), 'sum': 0.,
+                    'count': 0})
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+        if not succeeded:
+            _add(state.setdefault('failures', {}), stage, 1)
+
+
+def subprocess_finished(stage, usage):
+    """
+    :param stage: name of the stage which ran the subprocess.
+    :param usage: resource usage of the subprocess and its descendants, as
+    returned by os.wait4.
+    """
+    if not _path:
+        return
+    with _locked_state() as state:
+        _add(state.setdefault('subprocesses', {}), stage, 1)
+        _add(state.setdefault('cpu_seconds', {}), stage,
+             usage.ru_utime + usage.ru_stime)
+        # ru_maxrss is in KiB on linux
+        peak = state.setdefault('peak_rss_bytes', {})
+        peak[stage] = max(peak.get(stage, 0), usage.ru_maxrss * 1024)
+        # ru_oublock counts 512 byte blocks written to storage
+        _add(state.setdefault('written_bytes', {}), stage,
+             usage.ru_oublock * 512)
+
+
+def set_queued(count):
+    """
+    :param count: number of stages this process has yet to run.
+    """
+    if not _path:
+        return
+    with _locked_state() as state:
+        state.setdefault('queued', {})[str(os.getpid())] = count
+
+
+def set_spool_counts(counts):
+    """
+    :param counts: number of spool items by state, see spool.Spool.counts
+    """
+    if not _path:
+        return
+    with _locked_state() as state:
+        state['spool'] = counts
+
+
+def _labels(**labels):
+    escaped = ('%s="%s"' % (k, str(v).replace('\\', r'\\')
+                            .replace('"', r'\"').replace('\n', r'\n'))
+               for k, v in sorted(labels.items()))
+    return '{%s}' % ','.join(escaped) if labels else ''
+
+
+def render(state):
+    """
+    :param state: cumulative metrics state.
+    :return: text exposition of the state.
+    """
+    lines = []
+
+    def metric(name, kind, description, samples):
+        lines.append('# HELP %s_%s %s' % (PREFIX, name, description))
+        lines.append('# TYPE %s_%s %s' % (PREFIX, name, kind))
+        for suffix, labels, value in samples:
+            lines.append('%s_%s%s%s %s' % (PREFIX, name, suffix,
+                                           _labels(**labels), repr(value)))
+
+    samples = []
+    for stage, histogram in sorted(state.get('durations', {}).items()):
+        for bound, count in zip(DURATION_BUCKETS, histogram['buckets']):
+            samples.append(('_bucket', {'stage': stage, 'le': bound}, count))
+        samples.append(('_bucket', {'stage': stage, 'le': '+Inf'},
+                        histogram['count']))
+        samples.append(('_sum', {'stage': stage}, histogram['sum']))
+        samples.append(('_count', {'stage': stage}, histogram['count']))
+    metric('stage_duration_seconds', 'histogram',
+           'Wall time of completed stage runs.', samples)
+
+    in_flight = {}
+    for running in state.get('in_flight', {}).values():
+        for stage, count in running.items():
+            _add(in_flight, stage, count)
+    metric('stage_runs_in_flight', 'gauge', 'Stages currently running.',
+           [('', {'stage': k}, v) for k, v in sorted(in_flight.items())])
+    metric('stage_failures_total', 'counter', 'Failed stage runs.',
+           [('', {'stage': k}, v)
+            for k, v in sorted(state.get('failures', {}).items())])
+    metric('queued_stages', 'gauge',
+           'Stages yet to run in the sessions of running pipelines.',
+           [('', {}, sum(state.get('queued', {}).values()))])
+    metric('spool_items', 'gauge',
+           'Spool work items by state, as last seen by a worker.',
+           [('', {'state': k}, v)
+            for k, v in sorted(state.get('spool', {}).items())])
+
+    for key, name, description in (
+            ('subprocesses', 'subprocesses_total',
+             'Completed stage subprocesses.'),
+            ('cpu_seconds', 'child_cpu_seconds_total',
+             'User and system CPU time of stage subprocesses.'),
+            ('peak_rss_bytes', 'child_peak_rss_bytes',
+             'Largest resident set size of any stage subprocess.'),
+            ('written_bytes', 'written_bytes_total',
+             'Bytes written to storage by stage subprocesses.')):
+        metric(name, 'gauge' if key == 'peak_rss_bytes' else 'counter',
+               description, [('', {'stage': k}, v)
+                             for k, v in sorted(state.get(key, {}).items())])
+
+    metric('last_update_timestamp_seconds', 'gauge',
+           'Time of the last metrics update.',
+           [('', {}, state.get('updated', 0.))])
+    return '\n'.join(lines) + '\n'
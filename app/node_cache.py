@@ -0,0 +1,171 @@
+"""
+Node-wide cache of templates and configuration files in RAM-backed or local
+storage.  Every session reads the same Yerkes19 templates, surface and
+grayordinate atlases, FreeSurfer GCA and configuration files, usually from
+network storage.  With --node-cache DIR (e.g. /dev/shm/nhp-abcd-bids-pipeline
+or a local SSD), the ones a session's settings point at are copied once to
+DIR, read-only, and the session's settings are pointed at the copies.
+
+The copies are shared by every pipeline process on the node.  Each process
+holds a reference, DIR/refs/<pid>, for as long as it runs; the last process
+to release its reference removes the copies, so RAM is freed once the node
+is done.  References of processes which died without releasing them are
+pruned.  Processes which do not exit normally, e.g. spool workers' children,
+which leave by os._exit, release their references with release_all.  A copy
+is keyed by its source's path, size and modification time, so an updated
+template is copied anew.  Sources which cannot be copied, e.g.
+for want of space, are read from their original location.
+"""
+import atexit
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import stat
+
+REFS = 'refs'
+LOCK = '.lock'
+# environment variables naming the folders of shared, read-only inputs
+ROOTS = ('HCPPIPEDIR_Templates', 'HCPPIPEDIR_Config')
+# caches this process holds a reference on
+_held = []
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _read_only(path):
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            filename = os.path.join(root, name)
+            mode = os.stat(filename).st_mode
+            os.chmod(filename, mode & ~(stat.S_IWUSR | stat.S_IWGRP |
+                                        stat.S_IWOTH))
+    if os.path.isfile(path):
+        os.chmod(path, os.stat(path).st_mode & ~(
+            stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+
+class NodeCache(object):
+
+    def __init__(self, root):
+        """
+        :param root: node local cache directory, e.g. /dev/shm/...
+        """
+        self.root = root
+        self.copies = {}
+        self.held = False
+        os.makedirs(os.path.join(root, REFS), exist_ok=True)
+
+    def _lock(self):
+        fd = open(os.path.join(self.root, LOCK), 'a')
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def _live_refs(self):
+        """
+        :return: pids holding a reference, removing those of dead processes.
+        """
+        pids = []
+        for name in os.listdir(os.path.join(self.root, REFS)):
+            if name.isdigit() and _alive(int(name)):
+                pids.append(int(name))
+            else:
+                os.remove(os.path.join(self.root, REFS, name))
+        return pids
+
+    def acquire(self):
+        """
+        takes a reference on the cache for this process, released at exit.
+        """
+        if self.held:
+            return
+        with self._lock():
+            self._live_refs()
+            open(os.path.join(self.root, REFS, str(os.getpid())), 'w').close()
+        self.held = True
+        _held.append(self)
+        atexit.register(self.release)
+
+    def release(self):
+        """
+        drops this process' reference, removing the copies if it was the
+        last.
+        """
+        if not self.held:
+            return
+        self.held = False
+        _held.remove(self)
+        with self._lock():
+            try:
+                os.remove(os.path.join(self.root, REFS, str(os.getpid())))
+            except OSError:
+                pass
+            if not self._live_refs():
+                for name in os.listdir(self.root):
+                    if name in (REFS, LOCK):
+                        continue
+                    shutil.rmtree(os.path.join(self.root, name),
+                                  ignore_errors=True)
+
+    def copy(self, path):
+        """
+        :param path: file or folder to cache.
+        :return: path to the node local copy, or path if it cannot be made.
+        """
+        if path in self.copies:
+            return self.copies[path]
+        st = os.stat(path)
+        key = hashlib.sha1(('%s:%d:%d' % (os.path.realpath(path), st.st_size,
+                                          st.st_mtime_ns)).encode())
+        folder = os.path.join(self.root, key.hexdigest()[:16])
+        local = os.path.join(folder, os.path.basename(path.rstrip(os.sep)))
+        with self._lock():
+            if not os.path.exists(folder):
+                tmp = '%s.tmp-%d' % (folder, os.getpid())
+                try:
+                    os.makedirs(tmp)
+                    target = os.path.join(tmp, os.path.basename(local))
+                    if os.path.isdir(path):
+                        shutil.copytree(path, target)
+                    else:
+                        shutil.copy2(path, target)
+                    _read_only(target)
+                    os.rename(tmp, folder)
+                except OSError as e:
+                    shutil.rmtree(tmp, ignore_errors=True)
+                    print('not caching %s on the node: %s' % (path, e))
+                    local = path
+        self.copies[path] = local
+        return local
+
+    def localize(self, config):
+        """
+        points a session's template and configuration paths at node local
+        copies.
+        :param config: ParameterSettings
+        """
+        self.acquire()
+        roots = [os.path.join(os.environ[r], '') for r in ROOTS
+                 if os.environ.get(r)]
+        copies = {}
+        for item, value in config.get_params().items():
+            if isinstance(value, str) and value.startswith(tuple(roots)) \
+                    and os.path.exists(value):
+                copies[value] = self.copy(value)
+        config.set_local_copies(copies)
+
+
+def release_all():
+    """
+    releases every reference this process holds, for processes whose exit
+    does not run atexit handlers.
+    """
+    for cache in list(_held):
+        cache.release()
@@ -1,12 +1,20 @@
+import contextlib
+import functools
 import inspect
 import json
 import multiprocessing as mp
+import queue
 import subprocess
+import time
 
 import os
 
-from helpers import (get_contrast_agent, get_fmriname, get_readoutdir,
-                     get_relpath, get_taskname, ijk_to_xyz)
+from helpers import (find_output, get_contrast_agent, get_fmriname,
+                     get_nifti_size, get_nifti_variants, get_nifti_volumes,
+                     get_readoutdir, get_relpath, get_taskname, ijk_to_xyz,
+                     read_nifti_dims, verify_output)
+import metrics
+from profiling import span
 
 
 class ParameterSettings(object):
@@ -133,20 +141,22 @@ class ParameterSettings(object):
         :param output_directory: output directory for pipeline
         """
 
-        # input bids data struct
-        self.bids_data = bids_data
+        # the functional and field map scans, see get_bids.  The rest of the
+        # bids data struct is read into parameters below and not kept.
+        self._bids = {key: bids_data[key] for key in
+                      ('func', 'func_metadata', 'fmap', 'fmap_metadata')}
         # @ parameters read from bids @ #
-        self.t1w = self.bids_data['t1w']
+        self.t1w = bids_data['t1w']
         self.t1samplespacing = \
-            '%.12f' % self.bids_data['t1w_metadata']['DwellTime']
+            '%.12f' % bids_data['t1w_metadata']['DwellTime']
         self.t1samplespacing = self.t1samplespacing.rstrip('0')
 
 
-        if 'T2w' in self.bids_data['types']:
+        if 'T2w' in bids_data['types']:
             self.useT2 = 'true'
-            self.t2w = self.bids_data['t2w']
+            self.t2w = bids_data['t2w']
             self.t2samplespacing = \
-                '%.12f' % self.bids_data['t2w_metadata']['DwellTime']
+                '%.12f' % bids_data['t2w_metadata']['DwellTime']
             self.t2samplespacing = self.t2samplespacing.rstrip('0')
         else:
             self.useT2 = 'false'
@@ -155,16 +165,16 @@ class ParameterSettings(object):
 
         # distortion correction method: TOPUP, FIELDMAP, or NONE, inferred
         # from files, defaults to spin echo (topup) if both field maps exist
-        self.unwarpdir = get_readoutdir(self.bids_data['t1w_metadata'])
-        if 'epi' in self.bids_data['types']:
+        self.unwarpdir = get_readoutdir(bids_data['t1w_metadata'])
+        if 'epi' in bids_data['types']:
             self.dcmethod = 'TOPUP'
             # spin echo field map spacing @TODO read during volume per fmap?
-            self.echospacing = self.bids_data['fmap_metadata']['positive'][0][
+            self.echospacing = bids_data['fmap_metadata']['positive'][0][
                 'EffectiveEchoSpacing']
             self.echospacing = ('%.12f' % self.echospacing).rstrip('0')
             # distortion correction phase encoding direction
             self.seunwarpdir = ijk_to_xyz(
-                self.bids_data['func_metadata'][0]['PhaseEncodingDirection'])
+                bids_data['func_metadata'][0]['PhaseEncodingDirection'])
 
             # set unused fmap parameters to none
             self.fmapmag = self.fmapphase = self.fmapgeneralelectric = \
@@ -172,7 +182,7 @@ class ParameterSettings(object):
                 self.fmapmagbrain = None
             # @TODO decide on bfcmethod for fmri data.
 
-        elif 'magnitude' in self.bids_data['types']:
+        elif 'magnitude' in bids_data['types']:
             self.dcmethod = 'FIELDMAP'
             # gradient field map delta TE
             self.echodiff = None  # @TODO
@@ -203,8 +213,8 @@ class ParameterSettings(object):
         # @ output files @ #
         self.path = os.path.join(output_directory, 'files')
         self.logs = os.path.join(output_directory, 'logs')
-        self.subject = self.bids_data['subject']
-        self.session = self.bids_data['session']
+        self.subject = bids_data['subject']
+        self.session = bids_data['session']
 
         # Exec summ doesn't need this anymore. KJS 11/6/18
         #deriv_root = self.path.split('/')[:-3]
@@ -232,6 +242,9 @@ class ParameterSettings(object):
         # FreeSurfer single pass pial 
         self.single_pass_pial = 'false'
 
+        # bold runs in execution order, see get_bold_runs
+        self._bold_runs = None
+
     def __getitem__(self, item):
         return self._params()[item]
 
@@ -268,16 +281,39 @@ class ParameterSettings(object):
 
     def get_bids(self, *args):
         """
-        get data from bids struct
+        get functional or field map data from the bids struct
         :param args: list of nested dict keys, e.g. one must provide 'fmap',
         'positive' to retrieve the positive spin echo field maps.
         :return: bids data
         """
-        val = self.bids_data
+        val = self._bids
         for arg in args:
             val = val[arg]
         return val
 
+    def get_bold_runs(self):
+        """
+        pairs each bold run with its metadata, ordered for execution by the
+        per-run stages.  Within a stage runs are executed concurrently, so
+        the largest runs (by number of voxels over all volumes, read from the
+        nifti header) are submitted first to keep them from dominating the
+        stage's run time.  Runs with a contrast agent follow all other runs,
+        so that registration assist references are processed first.
+        :return: list of (filename, metadata) tuples
+        """
+        if self._bold_runs is None:
+            def size(filename):
+                try:
+                    return get_nifti_size(filename)
+                except (OSError, ValueError):
+                    return 0
+            runs = list(zip(self.get_bids('func'),
+                            self.get_bids('func_metadata')))
+            sizes = {fmri: size(fmri) for fmri, _ in runs}
+            self._bold_runs = sorted(runs, key=lambda x: (
+                int('_ce-' in x[0]), -sizes[x[0]], x[0]))
+        return self._bold_runs
+
     def set_study_templates(self, study_template, study_template_brain):
         """
         set template for intermediate registration steps.
@@ -312,7 +348,17 @@ class ParameterSettings(object):
         :return: None
         """
         self.multitemplatedir = multi_template_dir
-    
+
+    def set_local_copies(self, copies):
+        """
+        points formatted template and configuration paths at local copies.
+        :param copies: dictionary of path to its local copy, see node_cache.py
+        :return: None
+        """
+        for item, value in self.get_params().items():
+            if isinstance(value, str) and value in copies:
+                setattr(self, item, copies[value])
+
     def set_hypernormalization_method(self, norm_method):
         self.norm_method = norm_method
     
@@ -476,15 +522,19 @@ class Stage(object):
     remove_expected_outputs_active = True
     parallel_execution_active = True
     ignore_expected_outputs = False
+    checksum_manifest_active = False
+    # threads compressing the expected outputs in teardown, 0 for none
+    compress_outputs_ncpus = 0
 
     def __init__(self, config):
         self.config = config
         self.kwargs = config.get_params()
-        self.status = Status(self._get_log_dir())
-        here = os.path.dirname(os.path.realpath(__file__))
-        with open(os.path.join(here, 'pipeline_expected_outputs.json')) as fd:
-            jso = json.load(fd)
-            self.expected_outputs_spec = jso[self.__class__.__name__]
+        # created on first use, so that stages may be planned without
+        # touching the output directory, see planner.py
+        self._status = None
+        # stages like CustomClean have no expected outputs
+        self.expected_outputs_spec = \
+            load_expected_outputs().get(self.__class__.__name__, [])
 
     def __str__(self):
         cmdline = self.cmdline()
@@ -496,6 +546,12 @@ class Stage(object):
             string = ' \\\n    '.join(cmdline.split())
         return string
 
+    @property
+    def status(self):
+        if self._status is None:
+            self._status = Status(self._get_log_dir())
+        return self._status
+
     @classmethod
     def deactivate_runtime_calls(cls):
         """
@@ -519,6 +575,14 @@ class Stage(object):
     def activate_ignore_expected_outputs(cls):
         cls.ignore_expected_outputs = True
 
+    @classmethod
+    def activate_checksum_manifest(cls):
+        cls.checksum_manifest_active = True
+
+    @classmethod
+    def activate_output_compression(cls, ncpus=1):
+        cls.compress_outputs_ncpus = max(1, ncpus)
+
     def _get_log_dir(self):
         """
         returns the subject's log directory for this stage
@@ -531,36 +595,109 @@ class Stage(object):
 
     def check_expected_outputs(self):
         """
-        checks the existence of the expected outputs for this stage.
+        checks that the expected outputs for this stage exist and were
+        completely written, see helpers.verify_output.  Time series outputs
+        of each bold run must have as many volumes as the run.  A nifti
+        output may be in either its .nii or .nii.gz form.
         :return: True if all outputs exist, else False.
         """
         if not self.check_expected_outputs_active:
             return True
 
-        outputs = self.get_expected_outputs()
-        checklist = [os.path.exists(p) for p in outputs]
-        if not all(checklist):
+        with span('check expected outputs', stage=self.__class__.__name__):
+            problems = [verify_output(find_output(p)) for p in
+                        self.get_expected_outputs(runs=False)]
+            for fmri, _ in self._get_output_runs():
+                problems += self.check_run_outputs(fmri)
+            problems = [p for p in problems if p]
+        if problems:
             print('missing expected outputs from %s' %
                   self.__class__.__name__)
-            dne_list = [f for i, f in enumerate(outputs) if not checklist[i]]
-            for f in dne_list:
-                print('file not found: %s' % f)
+            for problem in problems:
+                print(problem)
             if self.ignore_expected_outputs:
                 return False
 
         return True
 
-    def get_expected_outputs(self):
+    def check_run_outputs(self, fmri):
+        """
+        checks the expected outputs of a single bold run.
+        :param fmri: path to the bold run.
+        :return: list of problems, empty if the run's outputs are complete.
+        """
+        try:
+            volumes = get_nifti_volumes(read_nifti_dims(fmri))
+        except (OSError, EOFError, ValueError):
+            volumes = None
+        problems = [verify_output(find_output(p), volumes) for p in
+                    self.get_run_expected_outputs(get_fmriname(fmri))]
+        return [p for p in problems if p]
+
+    def _get_output_runs(self):
+        """
+        :return: bold runs with templated expected outputs, see get_bold_runs
+        """
+        if any('{fmriname}' in p for p in self.expected_outputs_spec):
+            return self.config.get_bold_runs()
+        return []
+
+    def _format_output(self, template, **kwargs):
+        return template.format(**dict(os.environ, **dict(self.kwargs,
+                                                         **kwargs)))
+
+    def get_expected_outputs(self, runs=True):
         """
-        formats and returns expected outputs.  Must be overridden for
-        expected outputs of concurrent executions.
+        formats and returns expected outputs.  Outputs containing {fmriname}
+        are expected for every bold run.
+        :param runs: include the outputs of each bold run.
         :return: formatted list of expected outputs
         """
-        expected_outputs = [p.format(**self.kwargs)
-                            for p in self.expected_outputs_spec]
+        expected_outputs = [self._format_output(p)
+                            for p in self.expected_outputs_spec
+                            if '{fmriname}' not in p]
+        if runs:
+            for fmri, _ in self._get_output_runs():
+                expected_outputs += self.get_run_expected_outputs(
+                    get_fmriname(fmri))
         expected_outputs += self.get_conditional_expected_outputs()
         return expected_outputs
 
+    def compress_outputs(self):
+        """
+        compresses this stage's expected outputs which were written
+        uncompressed, before the next stage reads them, see compression.py
+        :return: None
+        """
+        from compression import compress_outputs
+        with span('compression', stage=self.__class__.__name__):
+            compress_outputs(self.get_expected_outputs(),
+                             self.compress_outputs_ncpus)
+
+    def update_manifest(self):
+        """
+        records the checksums of this stage's existing expected outputs in
+        the session's manifest, see manifest.py
+        :return: None
+        """
+        from manifest import update_manifest
+        outputs = [find_output(p) for p in self.get_expected_outputs()]
+        with span('checksum manifest', stage=self.__class__.__name__):
+            hashed, unchanged = update_manifest(
+                os.path.dirname(self.kwargs['path']), self.kwargs['logs'],
+                [p for p in outputs if os.path.isfile(p)],
+                self.__class__.__name__)
+        print('checksummed %d outputs of %s, %d unchanged' % (
+            hashed, self.__class__.__name__, unchanged))
+
+    def get_run_expected_outputs(self, fmriname):
+        """
+        :param fmriname: name of a bold run, see helpers.get_fmriname
+        :return: formatted list of the run's expected outputs
+        """
+        return [self._format_output(p, fmriname=fmriname)
+                for p in self.expected_outputs_spec if '{fmriname}' in p]
+
     def get_conditional_expected_outputs(self):
         """
         this method includes any logic which needs to be used to determine
@@ -578,7 +715,8 @@ class Stage(object):
         """
         if not self.remove_expected_outputs_active:
             return
-        outputs = self.get_expected_outputs()
+        outputs = [v for p in self.get_expected_outputs()
+                   for v in get_nifti_variants(p)]
         checklist = [os.path.isfile(p) for p in outputs]
         if any(checklist):
             print('found outputs from an earlier run of %s' %
@@ -622,6 +760,10 @@ class Stage(object):
             if self.status['node_status'] != Status.states['succeeded']:
                 raise Exception('error caught during stage: %s' %
                                 self.__class__.__name__)
+            if self.compress_outputs_ncpus:
+                self.compress_outputs()
+            if self.checksum_manifest_active:
+                self.update_manifest()
 
     @property
     def args(self):
@@ -649,6 +791,20 @@ class Stage(object):
         script = self.script.format(**os.environ)
         return ' '.join((script, self.args))
 
+    def setup_cmdline(self):
+        """
+        command run by setup before the main script, if any.
+        :return: command line string or None
+        """
+        return None
+
+    def teardown_cmdline(self):
+        """
+        command run by teardown after the main script, if any.
+        :return: command line string or None
+        """
+        return None
+
     def run(self, ncpus=1):
         """
         runs this stage
@@ -656,7 +812,22 @@ class Stage(object):
         for multithreaded computation.
         :return: None
         """
-        self.setup()
+        name = self.__class__.__name__
+        start = time.time()
+        if self.call_active:
+            metrics.stage_started(name)
+        try:
+            with span('stage', stage=name):
+                self._run(ncpus)
+        finally:
+            if self.call_active:
+                metrics.stage_finished(name, time.time() - start,
+                                       self.status.succeeded())
+
+    def _run(self, ncpus):
+        name = self.__class__.__name__
+        with span('setup', stage=name):
+            self.setup()
         # a generator cmdline supports parallel execution
         if inspect.isgeneratorfunction(self.cmdline):
             cmdlist = []
@@ -666,25 +837,73 @@ class Stage(object):
                                        self.kwargs['fmriname'] + '.out')
                 err_log = os.path.join(log_dir,
                                        self.kwargs['fmriname'] + '.err')
-                cmdlist.append((cmd, out_log, err_log))
+                cmdlist.append((self.kwargs['fmriname'],
+                                self.kwargs.get('fmri_dependencies', []),
+                                (cmd, out_log, err_log)))
             if not self.parallel_execution_active:
                 ncpus = 1
-            with mp.Pool(processes=ncpus) as pool:
-                result = pool.starmap(self.call, cmdlist)
+            result = self._run_concurrent(cmdlist, ncpus)
         else:
             cmd = self.cmdline()
             log_dir = self._get_log_dir()
             out_log = os.path.join(log_dir, self.__class__.__name__ + '.out')
             err_log = os.path.join(log_dir, self.__class__.__name__ + '.err')
             result = self.call(cmd, out_log, err_log, num_threads=ncpus)
-        self.teardown(result)
+        with span('teardown', stage=name):
+            self.teardown(result)
+
+    def _run_concurrent(self, cmdlist, ncpus):
+        """
+        runs commands on a pool of ncpus processes, in the order given, except
+        that a command is only started once all the commands it depends upon
+        have succeeded.  Commands whose dependencies failed are not run.
+        :param cmdlist: list of (name, names of dependencies, call arguments)
+        :param ncpus: number of concurrent processes.
+        :return: list of exit statuses, parallel to cmdlist
+        """
+        results = {}
+        pending = list(cmdlist)
+        finished = queue.Queue()
+        running = 0
+        with mp.Pool(processes=ncpus) as pool:
+            while pending or running:
+                for job in list(pending):
+                    name, dependencies, args = job
+                    if not all(d in results for d in dependencies):
+                        continue
+                    pending.remove(job)
+                    failed = [d for d in dependencies if results[d] != 0]
+                    if failed:
+                        print('not running %s, which depends upon failed %s'
+                              % (name, ', '.join(failed)))
+                        results[name] = 1
+                        continue
+                    pool.apply_async(
+                        self.call, args,
+                        callback=lambda r, n=name: finished.put((n, r)),
+                        error_callback=lambda e, n=name: finished.put((n, e)))
+                    running += 1
+                if not running:
+                    if pending:
+                        raise ValueError('unsatisfiable dependencies in %s'
+                                         % self.__class__.__name__)
+                    break
+                name, result = finished.get()
+                running -= 1
+                if isinstance(result, BaseException):
+                    raise result
+                results[name] = result
+        return [results[name] for name, _, _ in cmdlist]
 
     def call(self, *args, **kwargs):
         """
         runs command if call is active.
         """
         if self.call_active:
-            return _call(*args, **kwargs)
+            log = os.path.splitext(os.path.basename(args[1]))[0]
+            name = self.__class__.__name__
+            with span('subprocess', stage=name, task=log):
+                return _call(*args, stage=name, **kwargs)
         else:
             return 0  # "success"
 
@@ -780,6 +999,16 @@ class PreFreeSurfer(Stage):
         else:
             self.kwargs['asegdir'] = os.path.dirname(self.kwargs['aseg'])
 
+    def set_templates_dir(self, multi_template_dir):
+        """
+        set template dir for joint label fusion (JLF), e.g. to a selection
+        of the study's atlases, see atlas_selection.py
+        :param multi_template_dir: multi template directory for T1w JLF
+        segmentation
+        :return: None
+        """
+        self.kwargs['multitemplatedir'] = multi_template_dir
+
     def _get_intended_sefmaps(self):
         """
         search for IntendedFor field from sidecar json, else give the first
@@ -852,7 +1081,12 @@ class FreeSurfer(Stage):
 
     @property
     def args(self):
-        return self.spec.format(**self.kwargs)
+        # written by PreFreeSurfer in either nifti form, see
+        # --uncompressed-intermediates
+        kwargs = dict(self.kwargs)
+        for key in ('t1_restore', 't1_restore_brain', 't2_restore', 'aseg'):
+            kwargs[key] = find_output(kwargs[key])
+        return self.spec.format(**kwargs)
 
 
 class PostFreeSurfer(Stage):
@@ -958,16 +1192,29 @@ class FMRIVolume(Stage):
                                     intended_idx['negative'])
 
     def set_registration_assist(self, moving, reference):
+        """
+        registers the moving run using the registration of the reference
+        run.  The moving run waits for the reference run to complete, while
+        all other runs are processed concurrently.
+        :param moving: fmriname of the moving run.
+        :param reference: name of the reference run, e.g. task-rest01
+        """
+        names = [get_fmriname(f) for f, _ in self.config.get_bold_runs()]
+        parts = set(reference.split('_'))
+        # sessions without the moving run are processed as usual
+        if moving in names and not any(
+                parts <= set(name.split('_')) and name != moving
+                for name in names):
+            # the moving run would not wait for a reference to register to
+            raise ValueError('registration assist: reference %s matches no '
+                             'bold run other than %s, choose from %s' % (
+                                 reference, moving, ', '.join(names)))
         self.kwargs['regast_moving'] = moving
         self.kwargs['regast_reference'] = reference
-        self.deactivate_parallel_execution()
 
     @property
     def args(self):
-        fmri_data = sorted(self.config.get_bids('func'),
-            key=lambda x: (int('_ce-' in x), x))
-        for fmri, meta in zip(fmri_data,
-                              self.config.get_bids('func_metadata')):
+        for fmri, meta in self.config.get_bold_runs():
             # set ts parameters
             self.kwargs['fmritcs'] = fmri
             self.kwargs['fmriname'] = get_fmriname(fmri)
@@ -988,8 +1235,15 @@ class FMRIVolume(Stage):
             if self.kwargs.get('regast_moving', None) == self.kwargs[
                    'fmriname']:
                 self.kwargs['prevreg'] = self.kwargs['regast_reference']
+                # wait for the reference run(s) to be registered first
+                parts = set(self.kwargs['prevreg'].split('_'))
+                self.kwargs['fmri_dependencies'] = [
+                    get_fmriname(f) for f, _ in self.config.get_bold_runs()
+                    if parts <= set(get_fmriname(f).split('_')) and
+                    get_fmriname(f) != self.kwargs['fmriname']]
             else:
                 self.kwargs['prevreg'] = ''
+                self.kwargs['fmri_dependencies'] = []
 
             # None to NONE
             kw = {k: (v if v is not None else "NONE")
@@ -1026,7 +1280,7 @@ class FMRISurface(Stage):
 
     @property
     def args(self):
-        for fmri in self.config.get_bids('func'):
+        for fmri, _ in self.config.get_bold_runs():
             self.kwargs['fmriname'] = get_fmriname(fmri)
             yield self.spec.format(**self.kwargs)
 
@@ -1062,6 +1316,7 @@ class DCANBOLDProcessing(Stage):
 
     def __init__(self, config):
         super(__class__, self).__init__(config)
+        self.shared_setup = False
 
     def set_bandstop_filter(self, lower_bound, upper_bound,
                             filter_type='notch'):
@@ -1069,27 +1324,26 @@ class DCANBOLDProcessing(Stage):
         self.kwargs['band_stop_min'] = lower_bound
         self.kwargs['band_stop_max'] = upper_bound
 
-    def setup(self):
+    def set_workspace(self, path, logs):
         """
-        make ventricle and white matter masks.
-        :return:
+        runs this stage in another output folder, whose inputs are linked from
+        the session's, see sweep.py.  The masks made by setup are shared with
+        the session, so setup is not repeated.
+        :param path: output folder, in place of the session's "files"
+        :param logs: log folder, in place of the session's "logs"
         """
-        super(__class__, self).setup()
+        self.kwargs['path'] = path
+        self.kwargs['logs'] = logs
+        self.shared_setup = True
+
+    def setup_cmdline(self):
         script = self.script.format(**os.environ)
         args = self.spec.format(**self.kwargs)
         cmd = ' '.join((script, args))
         cmd += ' --setup'
-        log_dir = self._get_log_dir()
-        out_log = os.path.join(log_dir, self.__class__.__name__ + '_setup.out')
-        err_log = os.path.join(log_dir, self.__class__.__name__ + '_setup.err')
-        result = self.call(cmd, out_log, err_log)
+        return cmd
 
-    def teardown(self, result=0):
-        """
-        concatenate dtseries, parcellate, create grayplots.
-        :param result:
-        :return:
-        """
+    def teardown_cmdline(self):
         fmris = [get_fmriname(fmri) for fmri in self.config.get_bids('func')]
         fmrisets = list(set([get_taskname(fmri)
                               for fmri in self.config.get_bids('func')]))
@@ -1102,7 +1356,29 @@ class DCANBOLDProcessing(Stage):
         for fmriset in fmrisets:
             fmrilist = sorted([ fmri for fmri in fmris if fmriset in fmri ])
             cmd += ' --tasklist ' + ','.join(fmrilist)
+        return cmd
 
+    def setup(self):
+        """
+        make ventricle and white matter masks.
+        :return:
+        """
+        super(__class__, self).setup()
+        if self.shared_setup:
+            return
+        cmd = self.setup_cmdline()
+        log_dir = self._get_log_dir()
+        out_log = os.path.join(log_dir, self.__class__.__name__ + '_setup.out')
+        err_log = os.path.join(log_dir, self.__class__.__name__ + '_setup.err')
+        result = self.call(cmd, out_log, err_log)
+
+    def teardown(self, result=0):
+        """
+        concatenate dtseries, parcellate, create grayplots.
+        :param result:
+        :return:
+        """
+        cmd = self.teardown_cmdline()
         log_dir = self._get_log_dir()
         out_log = os.path.join(log_dir, self.__class__.__name__ + '_teardown.out')
         err_log = os.path.join(log_dir, self.__class__.__name__ + '_teardown.err')
@@ -1112,7 +1388,7 @@ class DCANBOLDProcessing(Stage):
 
     @property
     def args(self):
-        for fmri in self.config.get_bids('func'):
+        for fmri, _ in self.config.get_bold_runs():
             self.kwargs['fmriname'] = get_fmriname(fmri)
             yield self.spec.format(**self.kwargs)
 
@@ -1148,23 +1424,80 @@ class CustomClean(Stage):
     spec = ' --dir={path}' \
            ' --json={input_json}'
 
-    def __init__(self, config, input_json):
+    def __init__(self, config, input_json, native=False):
+        """
+        :param native: remove the outputs in process rather than with the
+        cleaning script, see clean.py
+        """
         super(__class__, self).__init__(config)
         self.kwargs['input_json'] = input_json
+        self.native = native
+
+    def __str__(self):
+        if self.native:
+            return 'native clean of %s with %s' % (self.kwargs['path'],
+                                                  self.kwargs['input_json'])
+        return super(__class__, self).__str__()
 
     @property
     def args(self):
         return self.spec.format(**self.kwargs)
 
+    def call(self, *args, **kwargs):
+        if not (self.native and self.call_active):
+            return super(__class__, self).call(*args, **kwargs)
+        from clean import clean_sessions, load_patterns
+        _, out_log, err_log = args
+        with span('subprocess', stage=self.__class__.__name__,
+                  task='CustomClean'), \
+                open(out_log, 'w') as out, open(err_log, 'w') as err, \
+                contextlib.redirect_stdout(out), \
+                contextlib.redirect_stderr(err):
+            try:
+                errors = clean_sessions(
+                    [self.kwargs['path']],
+                    load_patterns(self.kwargs['input_json']),
+                    kwargs.get('num_threads', 1))
+            except (OSError, ValueError) as e:
+                print(e, file=err)
+                return 1
+        return 1 if errors else 0
+
+
+@functools.lru_cache(maxsize=None)
+def load_expected_outputs():
+    """
+    reads pipeline_expected_outputs.json once per process.
+    :return: dict of stage name to list of formattable expected outputs.
+    """
+    here = os.path.dirname(os.path.realpath(__file__))
+    with open(os.path.join(here, 'pipeline_expected_outputs.json')) as fd:
+        return json.load(fd)
 
-def _call(cmd, out_log, err_log, num_threads=1):
+
+def _call(cmd, out_log, err_log, num_threads=1, stage=None):
     env = os.environ.copy()
     if num_threads > 1:
         # set parallel environment variables
         env['OMP_NUM_THREADS'] = str(num_threads)
         env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(num_threads)
     with open(out_log, 'w') as out, open(err_log, 'w') as err:
-        result = subprocess.call(cmd.split(), stdout=out, stderr=err, env=env)
+        proc = subprocess.Popen(cmd.split(), stdout=out, stderr=err, env=env)
+        try:
+            # wait4 rather than wait, for the resource usage of the script
+            # and everything it ran.
+            _, status, usage = os.wait4(proc.pid, 0)
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+        if os.WIFSIGNALED(status):
+            result = -os.WTERMSIG(status)
+        else:
+            result = os.WEXITSTATUS(status)
+        proc.returncode = result
+        if stage:
+            metrics.subprocess_finished(stage, usage)
         if type(result) is list:
             if all(v == 0 for v in result):
                 result = 0
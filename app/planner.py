@@ -0,0 +1,230 @@
+"""
+Exports the commands of a pipeline run as a dependency graph for an external
+workflow engine, instead of running them.  Planning has no side effects: no
+stage is run, and no log directory or status file is created.
+
+Each session contributes one job per stage command: setup and teardown
+commands, the main script of a whole-session stage, or the script of one
+bold run of a per-run stage.  A run of a per-run stage waits only for the
+same run in the preceding per-run stage (and for the runs it is registered
+to, see --registration-assist), so runs flow through FMRIVolume, FMRISurface
+and DCANBOLDProcessing independently.  Every job writes its logs where a
+normal run would, and touches a .done stamp in the same folder on success.
+
+Formats:
+    make       a Makefile, e.g. for make -j 8 -f Makefile
+    snakemake  a Snakefile, e.g. for snakemake --cores 8 -s Snakefile
+    bash       a serial bash script which stops at the first failure
+"""
+import inspect
+import os
+import re
+import shlex
+
+# environment variables exported by plans, by name or prefix, as read by
+# the pipeline's scripts and the neuroimaging tools they call.
+ENVIRONMENT = ('PATH', 'LD_LIBRARY_PATH', 'PYTHONPATH', 'PERL5LIB', 'TMPDIR',
+               'SCRATCHDIR', 'SUBJECTS_DIR')
+ENVIRONMENT_PREFIXES = ('HCPPIPEDIR', 'FSL', 'FREESURFER', 'FS_', 'CARET7',
+                        'ANTS', 'MSM', 'DCANBOLDPROC', 'EXECSUM',
+                        'CUSTOMCLEAN', 'MATLAB', 'MCR', 'WORKBENCH', 'OMP_',
+                        'ITK_')
+
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS')
+
+
+class Job(object):
+    """
+    a single command of the plan.
+    """
+
+    __slots__ = ('name', 'command', 'dependencies', 'log_dir', 'log',
+                 'threads')
+
+    def __init__(self, name, command, dependencies, log_dir, log, threads=1):
+        """
+        :param name: unique job name, e.g. sub-01_ses-01.FMRIVolume.task-rest
+        :param command: command line, split on whitespace as by _call
+        :param dependencies: names of the jobs which must succeed first.
+        :param log_dir: folder of the job's logs.
+        :param log: log file name, without extension.
+        :param threads: number of threads the command may use.
+        """
+        self.name = name
+        self.command = command
+        self.dependencies = list(dependencies)
+        self.log_dir = log_dir
+        self.log = log
+        self.threads = threads
+
+    @property
+    def stamp(self):
+        return os.path.join(self.log_dir, self.log + '.done')
+
+    def shell(self):
+        """
+        :return: the job as a shell command, with logs redirected as in a
+        normal run.
+        """
+        command = ' '.join(shlex.quote(x) for x in self.command.split())
+        if self.threads > 1:
+            command = ' '.join('%s=%d' % (v, self.threads)
+                               for v in THREAD_VARIABLES) + ' ' + command
+        return '%s > %s 2> %s' % (
+            command, shlex.quote(os.path.join(self.log_dir, self.log + '.out')),
+            shlex.quote(os.path.join(self.log_dir, self.log + '.err')))
+
+
+def plan_session(label, stages, ncpus=1):
+    """
+    lists the jobs of one session.
+    :param label: session label, e.g. sub-01_ses-01
+    :param stages: the session's stages in execution order.
+    :param ncpus: threads for whole-session stages, as with --ncpus.
+    :return: list of Jobs, dependencies first.
+    """
+    jobs = []
+    previous = []
+    previous_runs = {}
+    for stage in stages:
+        name = stage.__class__.__name__
+        log_dir = os.path.join(stage.kwargs['logs'], name)
+
+        def add(task, command, dependencies, threads=1, log=None):
+            job = Job('%s.%s' % (label, task), command, dependencies,
+                      log_dir, log or task.split('.')[-1], threads)
+            jobs.append(job)
+            return job.name
+
+        # runs are listed first: as in a normal run, where printing the
+        # stage walks its commands, setup commands see the last run's kwargs.
+        per_run = inspect.isgeneratorfunction(stage.cmdline)
+        runs = []
+        if per_run:
+            for cmd in stage.cmdline():
+                runs.append((stage.kwargs['fmriname'], cmd, list(
+                    stage.kwargs.get('fmri_dependencies', []))))
+
+        start = previous
+        setup = stage.setup_cmdline()
+        if setup:
+            start = [add(name + '.setup', setup, previous,
+                         log=name + '_setup')]
+
+        if per_run:
+            names = {fmriname: '%s.%s.%s' % (label, name, fmriname)
+                     for fmriname, _, _ in runs}
+            finished = []
+            for fmriname, cmd, dependencies in runs:
+                dependencies = [names[d] for d in dependencies]
+                if fmriname in previous_runs:
+                    dependencies.append(previous_runs[fmriname])
+                    if setup:
+                        dependencies += start
+                else:
+                    dependencies += start
+                finished.append(add('%s.%s' % (name, fmriname), cmd,
+                                    dependencies))
+            previous_runs = dict(zip(names, finished))
+        else:
+            finished = [add(name, stage.cmdline(), start, threads=ncpus)]
+            previous_runs = {}
+
+        teardown = stage.teardown_cmdline()
+        if teardown:
+            finished = [add(name + '.teardown', teardown, finished,
+                            log=name + '_teardown')]
+            previous_runs = {}
+        previous = finished
+    return jobs
+
+
+def get_environment():
+    """
+    :return: the variables of the current environment which plans export.
+    """
+    return {k: v for k, v in sorted(os.environ.items())
+            if k in ENVIRONMENT or k.startswith(ENVIRONMENT_PREFIXES)}
+
+
+def _rule_name(name):
+    return re.sub(r'\W', '_', name)
+
+
+def write_makefile(fd, jobs, environment):
+    fd.write('# generated by nhp-abcd-bids-pipeline --export-plan\n')
+    fd.write('SHELL := /bin/bash\n')
+    for key, value in environment.items():
+        fd.write('export %s := %s\n' % (key, value.replace('$', '$$')))
+    stamps = {job.name: job.stamp for job in jobs}
+    fd.write('\n.PHONY: all\nall: %s\n' % ' \\\n    '.join(
+        stamps[job.name] for job in jobs))
+    for job in jobs:
+        fd.write('\n# %s\n' % job.name)
+        fd.write('%s: %s\n' % (job.stamp, ' '.join(
+            stamps[d] for d in job.dependencies)))
+        fd.write('\tmkdir -p %s\n' % shlex.quote(job.log_dir))
+        fd.write('\t%s\n' % job.shell().replace('$', '$$'))
+        fd.write('\ttouch $@\n')
+
+
+def write_snakefile(fd, jobs, environment):
+    fd.write('# generated by nhp-abcd-bids-pipeline --export-plan\n')
+    fd.write('import os\n\n')
+    for key, value in environment.items():
+        fd.write('os.environ[%r] = %r\n' % (key, value))
+    stamps = {job.name: job.stamp for job in jobs}
+    fd.write('\nrule all:\n    input:\n')
+    for job in jobs:
+        fd.write('        %r,\n' % job.stamp)
+    for job in jobs:
+        fd.write('\n# %s\nrule %s:\n' % (job.name, _rule_name(job.name)))
+        if job.dependencies:
+            fd.write('    input:\n')
+            for dependency in job.dependencies:
+                fd.write('        %r,\n' % stamps[dependency])
+        fd.write('    output:\n        touch(%r)\n' % job.stamp)
+        fd.write('    threads: %d\n' % job.threads)
+        command = 'mkdir -p %s && %s' % (shlex.quote(job.log_dir),
+                                         job.shell())
+        # snakemake formats shell commands, so braces are escaped
+        fd.write('    shell:\n        %r\n' % command.replace(
+            '{', '{{').replace('}', '}}'))
+
+
+def write_bash(fd, jobs, environment):
+    fd.write('#!/bin/bash\n')
+    fd.write('# generated by nhp-abcd-bids-pipeline --export-plan\n')
+    fd.write('set -e\n\n')
+    for key, value in environment.items():
+        fd.write('export %s=%s\n' % (key, shlex.quote(value)))
+    for job in jobs:
+        fd.write('\n# %s\n' % job.name)
+        fd.write('if [ ! -e %s ]; then\n' % shlex.quote(job.stamp))
+        fd.write('    mkdir -p %s\n' % shlex.quote(job.log_dir))
+        fd.write('    %s\n' % job.shell())
+        fd.write('    touch %s\n' % shlex.quote(job.stamp))
+        fd.write('fi\n')
+
+
+FORMATS = {
+    'make': write_makefile,
+    'snakemake': write_snakefile,
+    'bash': write_bash,
+}
+
+
+def write_plan(path, plan_format, jobs, environment=None):
+    """
+    :param path: output file.
+    :param plan_format: one of FORMATS.
+    :param jobs: Jobs of all sessions, see plan_session
+    :param environment: variables to export, default get_environment()
+    """
+    if environment is None:
+        environment = get_environment()
+    with open(path, 'w') as fd:
+        FORMATS[plan_format](fd, jobs, environment)
+    if plan_format == 'bash':
+        os.chmod(path, 0o755)
+    print('wrote %d jobs to %s' % (len(jobs), path))
@@ -0,0 +1,161 @@
+"""
+Preflight validation of the inputs of every session before any stage runs.
+Only sidecar metadata and nifti headers are read, never voxel data, so all
+sessions of a cohort can be checked in a few seconds.  The checks mirror the
+fields read by ParameterSettings and the stages, so that a session which
+passes will not fail for want of them hours into PreFreeSurfer or
+FMRIVolume.
+"""
+import json
+import os
+from multiprocessing.pool import ThreadPool
+
+from helpers import get_fmriname, get_readoutdir, ijk_to_xyz, read_nifti_dims
+
+REPORT = 'preflight.json'
+
+# header reads are io bound, mostly waiting on the filesystem.
+THREADS = 16
+
+
+def _dims(filename, errors):
+    try:
+        return read_nifti_dims(filename)
+    except (OSError, EOFError, ValueError) as e:
+        errors.append('unreadable nifti header %s: %s' % (filename, e))
+        return None
+
+
+def _number(metadata, field, label, errors):
+    value = metadata.get(field)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        errors.append('%s: %s is %s, expected a number' %
+                      (label, field, 'missing' if value is None else
+                       repr(value)))
+
+
+def _phase_encoding(metadata, label, errors):
+    try:
+        ijk_to_xyz(metadata['PhaseEncodingDirection'])
+    except KeyError:
+        errors.append('%s: PhaseEncodingDirection is %s' % (
+            label, repr(metadata.get('PhaseEncodingDirection', 'missing'))))
+
+
+def check_session(session):
+    """
+    checks the inputs of one session.
+    :param session: bids data struct, see helpers.read_bids_dataset
+    :return: list of error messages, empty if the session may run.
+    """
+    errors = []
+
+    # anatomicals, see ParameterSettings.__init__
+    if not session['t1w'] or session['t1w_metadata'] is None:
+        return ['no T1w image']
+    t1w = session['t1w_metadata']
+    _number(t1w, 'DwellTime', 'T1w', errors)
+    try:
+        get_readoutdir(t1w)
+    except KeyError as e:
+        errors.append('T1w: %s is missing, needed for the readout '
+                      'direction' % e)
+    except (ValueError, TypeError, IndexError) as e:
+        errors.append('T1w: invalid DICOM orientation fields: %s' % e)
+    for filename in session['t1w']:
+        dims = _dims(filename, errors)
+        if dims is not None and len(dims) != 3:
+            errors.append('T1w %s is %dD, expected 3D' % (filename, len(dims)))
+    if 'T2w' in session['types']:
+        if session['t2w_metadata'] is None:
+            errors.append('T2w listed but no T2w image found')
+        else:
+            _number(session['t2w_metadata'], 'DwellTime', 'T2w', errors)
+        for filename in session['t2w']:
+            dims = _dims(filename, errors)
+            if dims is not None and len(dims) != 3:
+                errors.append('T2w %s is %dD, expected 3D' %
+                              (filename, len(dims)))
+
+    # bold runs, see FMRIVolume
+    for filename, metadata in zip(session['func'],
+                                  session['func_metadata']):
+        label = os.path.basename(filename)
+        try:
+            get_fmriname(filename)
+        except AttributeError:
+            errors.append('%s: no task entity in the filename' % label)
+        _phase_encoding(metadata, label, errors)
+        dims = _dims(filename, errors)
+        if dims is not None and (len(dims) != 4 or dims[3] < 2):
+            errors.append('%s has dimensions %s, expected a 4D time series'
+                          % (label, 'x'.join(str(d) for d in dims)))
+
+    # spin echo field maps
+    if 'epi' in session['types']:
+        fmap, fmap_metadata = session['fmap'], session['fmap_metadata']
+        if isinstance(fmap, dict):
+            for direction in ('positive', 'negative'):
+                for filename, metadata in zip(fmap[direction],
+                                              fmap_metadata[direction]):
+                    _phase_encoding(metadata, os.path.basename(filename),
+                                    errors)
+        if not isinstance(fmap, dict) or not fmap['positive'] or \
+                not fmap['negative']:
+            errors.append('spin echo field maps need both a positive and a '
+                          'negative phase encoding direction')
+        else:
+            _number(fmap_metadata['positive'][0], 'EffectiveEchoSpacing',
+                    os.path.basename(fmap['positive'][0]), errors)
+            for positive, negative in zip(fmap['positive'],
+                                          fmap['negative']):
+                pdims = _dims(positive, errors)
+                ndims = _dims(negative, errors)
+                if pdims and ndims and pdims[:3] != ndims[:3]:
+                    errors.append('spin echo pair %s and %s differ in '
+                                  'dimensions: %s vs %s' % (
+                                      os.path.basename(positive),
+                                      os.path.basename(negative),
+                                      pdims, ndims))
+        if not session['func']:
+            # the distortion correction direction is read from the first run
+            errors.append('spin echo field maps but no bold runs')
+    return errors
+
+
+def preflight(sessions, threads=THREADS):
+    """
+    checks sessions concurrently.
+    :param sessions: list of bids data structs.
+    :param threads: number of concurrent checks.
+    :return: report dict, with an entry per session in the given order.
+    """
+    with ThreadPool(processes=max(1, min(threads, len(sessions)))) as pool:
+        results = pool.map(check_session, sessions)
+    entries = [{'subject': session['subject'],
+                'session': session['session'],
+                'ok': not errors,
+                'errors': errors}
+               for session, errors in zip(sessions, results)]
+    return {'checked': len(entries),
+            'excluded': sum(1 for e in entries if not e['ok']),
+            'sessions': entries}
+
+
+def write_report(report, output_dir):
+    """
+    writes the report to output_dir/preflight.json and prints the errors.
+    :return: path to the report.
+    """
+    path = os.path.join(output_dir, REPORT)
+    with open(path, 'w') as fd:
+        json.dump(report, fd, indent=4)
+    for entry in report['sessions']:
+        if not entry['ok']:
+            print('preflight: excluding sub-%s ses-%s:' %
+                  (entry['subject'], entry['session']))
+            for error in entry['errors']:
+                print('    %s' % error)
+    print('preflight: %d of %d sessions passed, report written to %s' %
+          (report['checked'] - report['excluded'], report['checked'], path))
+    return path
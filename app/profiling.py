@@ -0,0 +1,230 @@
+"""
+Profiling hooks: cProfile and tracemalloc around a pipeline run, and named
+timing spans around its phases.
+
+Spans are recorded with span() anywhere in the pipeline and are no-ops
+unless recording has been enabled.  Once a session's log file is set, spans
+are appended to it as json lines, so spans recorded in forked pool processes
+end up in the same file as those of the main process.  Spans recorded before
+the log file is set, e.g. during bids discovery, are kept until it is.  A
+session's log is shared by every run of the session, e.g. the spool worker
+runs of its stages, and only restarted when a run starts from the session's
+first stage, see restart_session.
+"""
+import contextlib
+import io
+import json
+import os
+import threading
+import time
+
+_enabled = False
+# when spans were enabled, i.e. this run started
+_enabled_at = None
+_log_path = None
+_pending = []
+
+
+def enable_spans():
+    global _enabled, _enabled_at
+    _enabled = True
+    _enabled_at = time.time()
+
+
+def set_span_log(path):
+    """
+    directs spans to a json lines file, writing any spans recorded so far.
+    :param path: span log of the current session.
+    """
+    global _log_path
+    _log_path = path
+    while _pending:
+        _write(_pending.pop(0))
+
+
+def _write(record):
+    if _log_path is None:
+        _pending.append(record)
+        return
+    line = (json.dumps(record) + '\n').encode()
+    fd = os.open(_log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def set_session(logs):
+    """
+    appends spans to the span log in the profile folder of a session's logs.
+    :param logs: the session's log directory.
+    """
+    folder = os.path.join(logs, Profiler.folder)
+    os.makedirs(folder, exist_ok=True)
+    set_span_log(os.path.join(folder, 'spans.jsonl'))
+
+
+def restart_session():
+    """
+    drops the spans of earlier runs from the current span log, keeping those
+    of this run, once the session is run from its first stage.
+    """
+    if _log_path is None or not os.path.exists(_log_path):
+        return
+    records = [r for r in read_spans(_log_path) if r['start'] >= _enabled_at]
+    tmp = '%s.%d.tmp' % (_log_path, os.getpid())
+    with open(tmp, 'w') as fd:
+        for record in records:
+            fd.write(json.dumps(record) + '\n')
+    os.replace(tmp, _log_path)
+
+
+def record_span(name, start, end, **attrs):
+    """
+    records a span which has already been timed.
+    """
+    if _enabled:
+        _write(dict(attrs, name=name, start=start, end=end, pid=os.getpid(),
+                    tid=threading.get_ident()))
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """
+    times the enclosed block as a named span.
+    :param name: phase name, e.g. "setup".
+    :param attrs: json serializable details, e.g. stage name.
+    """
+    if not _enabled:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        record_span(name, start, time.time(), **attrs)
+
+
+def timed_iter(name, iterable, **attrs):
+    """
+    yields from iterable, recording the time taken to produce each item as a
+    span, e.g. for lazily evaluated bids discovery.
+    """
+    iterator = iter(iterable)
+    while True:
+        start = time.time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        record_span(name, start, time.time(), **attrs)
+        yield item
+
+
+def read_spans(path):
+    """
+    :return: list of span records in a span log.
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path) as fd:
+        return [json.loads(line) for line in fd if line.strip()]
+
+
+class Profiler(object):
+    """
+    profiles the main process of a pipeline run, per session.  Results are
+    written to logs/profile in the session's output directory:
+
+        interface.pstats  cProfile statistics, e.g. for snakeviz
+        spans.jsonl       timing spans of pipeline phases
+        summary.txt       span totals, top functions by cumulative time and,
+                          with memory profiling, top allocation sites
+    """
+
+    folder = 'profile'
+
+    def __init__(self, top=30, memory=False):
+        """
+        :param top: number of functions and allocation sites in summary.txt
+        :param memory: also trace memory allocations with tracemalloc.
+        """
+        # imported here, as the pipeline imports this module for spans.
+        import cProfile
+        self.top = top
+        self.memory = memory
+        self._new_profile = cProfile.Profile
+        self.profile = self._new_profile()
+
+    def start(self):
+        enable_spans()
+        if self.memory:
+            import tracemalloc
+            tracemalloc.start()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        if self.memory:
+            import tracemalloc
+            tracemalloc.stop()
+
+    @contextlib.contextmanager
+    def session(self, logs, append=False):
+        """
+        writes the results for the session when the block exits, including
+        by an exception, then restarts profiling for the next session.
+        :param logs: the session's log directory.
+        :param append: add to the statistics of earlier runs of the session,
+        e.g. spool worker runs of its earlier stages.
+        """
+        try:
+            yield
+        finally:
+            self.profile.disable()
+            self.dump(os.path.join(logs, self.folder), append)
+            self.profile = self._new_profile()
+            if self.memory:
+                import tracemalloc
+                tracemalloc.clear_traces()
+            self.profile.enable()
+
+    def dump(self, folder, append=False):
+        import pstats
+        import tracemalloc
+        filename = os.path.join(folder, 'interface.pstats')
+        stats = pstats.Stats(self.profile)
+        if append and os.path.exists(filename):
+            stats.add(filename)
+        stats.dump_stats(filename)
+        stream = io.StringIO()
+
+        totals = {}
+        for record in read_spans(os.path.join(folder, 'spans.jsonl')):
+            if record.get('counter'):
+                continue
+            count, seconds = totals.get(record['name'], (0, 0.))
+            totals[record['name']] = (count + 1,
+                                      seconds + record['end'] -
+                                      record['start'])
+        stream.write('timing spans\n')
+        stream.write('%-40s %8s %12s\n' % ('span', 'count', 'seconds'))
+        for name, (count, seconds) in sorted(totals.items(),
+                                             key=lambda x: -x[1][1]):
+            stream.write('%-40s %8d %12.3f\n' % (name, count, seconds))
+
+        stream.write('\ntop %d functions by cumulative time\n' % self.top)
+        stats.stream = stream
+        stats.sort_stats('cumulative').print_stats(self.top)
+
+        if self.memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            stream.write('traced memory: current %.1f MiB, peak %.1f MiB\n'
+                         % (current / 2 ** 20, peak / 2 ** 20))
+            stream.write('top %d allocation sites\n' % self.top)
+            snapshot = tracemalloc.take_snapshot()
+            for stat in snapshot.statistics('lineno')[:self.top]:
+                stream.write('%s\n' % stat)
+
+        with open(os.path.join(folder, 'summary.txt'), 'w') as fd:
+            fd.write(stream.getvalue())
@@ -28,52 +28,98 @@ Neuroinform. 2014 Apr 28;8:44. doi: 10.3389/fninf.2014.00044. eCollection 2014.
 __version__ = "0.2.12"
 
 import argparse
+import contextlib
+import importlib.util
 import os
+import sys
+import time
 
-from helpers import read_bids_dataset, validate_license
-from pipelines import (ParameterSettings, PreliminaryMasking, PreFreeSurfer,
-                       FreeSurfer, PostFreeSurfer, FMRIVolume, FMRISurface,
-                       DCANBOLDProcessing, ExecutiveSummary, CustomClean)
+from helpers import find_output, read_bids_dataset, validate_license
 
 # debug
 # import debug
 
+# alternative run modes, selected by the first command line argument, and the
+# module implementing each of them.
+MODES = {
+    'worker': 'spool',
+    'serve': 'server',
+    'client': 'server',
+    'trace': 'tracing',
+    'dedup': 'dedup',
+    'clean': 'clean',
+    'archive': 'archive',
+}
+
 
 def _cli():
     """
     command line interface
     :return:
     """
+    if len(sys.argv) > 1 and sys.argv[1] in MODES:
+        module = importlib.import_module(MODES[sys.argv[1]])
+        return module._cli(sys.argv[1], sys.argv[2:])
+
     parser = generate_parser()
     args = parser.parse_args()
 
-    return interface(args.bids_dir,
-                     args.output_dir,
-                     args.aseg,
-                     args.subject_list,
-                     args.session_list,
-                     args.collect,
-                     args.ncpus,
-                     args.stage,
-                     args.bandstop,
-                     args.max_cortical_thickness,
-                     args.check_outputs_only,
-                     args.t1_brain_mask,
-                     args.t2_brain_mask,
-                     args.study_template,
-                     args.t1_reg_method,
-                     args.cleaning_json,
-                     args.print,
-                     args.ignore_expected_outputs,
-                     args.multi_template_dir,
-                     args.norm_method,
-                     args.norm_gm_std_dev_scale,
-                     args.norm_wm_std_dev_scale,
-                     args.norm_csf_std_dev_scale,
-                     args.make_white_from_norm_t1,
-                     args.single_pass_pial,
-                     args.registration_assist,
-                     args.freesurfer_license)
+    return interface(**get_interface_kwargs(args))
+
+
+def get_interface_kwargs(args):
+    """
+    maps parsed command line arguments onto the parameters of interface.
+    :param args: namespace returned by generate_parser().parse_args
+    :return: dict of keyword arguments for interface
+    """
+    return dict(bids_dir=args.bids_dir,
+                output_dir=args.output_dir,
+                aseg=args.aseg,
+                subject_list=args.subject_list,
+                session_list=args.session_list,
+                collect=args.collect,
+                ncpus=args.ncpus,
+                start_stage=args.stage,
+                bandstop_params=args.bandstop,
+                max_cortical_thickness=args.max_cortical_thickness,
+                check_only=args.check_outputs_only,
+                preflight=args.preflight or args.preflight_only,
+                preflight_only=args.preflight_only,
+                t1_brain_mask=args.t1_brain_mask,
+                t2_brain_mask=args.t2_brain_mask,
+                study_template=args.study_template,
+                t1_reg_method=args.t1_reg_method,
+                cleaning_json=args.cleaning_json,
+                native_clean=args.native_clean,
+                checksum_manifest=args.checksum_manifest,
+                print_commands=args.print,
+                ignore_expected_outputs=args.ignore_expected_outputs,
+                multi_template_dir=args.multi_template_dir,
+                norm_method=args.norm_method,
+                norm_gm_std_dev_scale=args.norm_gm_std_dev_scale,
+                norm_wm_std_dev_scale=args.norm_wm_std_dev_scale,
+                norm_csf_std_dev_scale=args.norm_csf_std_dev_scale,
+                make_white_from_norm_t1=args.make_white_from_norm_t1,
+                single_pass_pial=args.single_pass_pial,
+                registration_assist=args.registration_assist,
+                freesurfer_license=args.freesurfer_license,
+                spool=args.spool,
+                schedule=args.schedule,
+                history=args.history,
+                profile=args.profile or args.profile_memory,
+                profile_memory=args.profile_memory,
+                trace=args.trace or args.trace_counters is not None,
+                trace_counters=args.trace_counters,
+                metrics_file=args.metrics_file,
+                export_plan=args.export_plan,
+                dbp_sweep=args.dbp_sweep,
+                fork_from=args.fork_from,
+                template_cache=args.template_cache,
+                jlf_top_k=args.jlf_top_k,
+                node_cache=args.node_cache,
+                uncompressed_intermediates=args.uncompressed_intermediates,
+                dedup_store=args.dedup_store)
 
 
 def generate_parser(parser=None):
@@ -207,6 +253,40 @@ def generate_parser(parser=None):
              'successfully to delete pipeline outputs based on '
              'the file structure specified in the custom-clean json.'
     )
+    extras.add_argument(
+        '--native-clean', action='store_true', dest='native_clean',
+        help='remove the --custom-clean outputs in process, with --ncpus '
+             'threads, rather than with the dcan cleaning script. The json '
+             'must list the paths to remove, see clean.py. Finished '
+             'sessions may be cleaned, or dry-run, all at once with: '
+             'nhp-abcd-bids-pipeline clean JSON OUTPUT_DIR'
+    )
+    extras.add_argument(
+        '--dbp-sweep', nargs='+', metavar='PARAM=V1,V2',
+        dest='dbp_sweep',
+        help='run DCANBOLDProcessing once for every combination of the '
+             'given values, concurrently up to --ncpus, each in its own '
+             'workspace under sub-X/ses-Y/sweep, sharing the outputs of the '
+             'earlier stages and a single DCANBOLDProcessing setup. Stages '
+             'after DCANBOLDProcessing are not run. PARAM is one of '
+             'fd_threshold, filter_order, lower_bpf, upper_bpf, '
+             'motion_filter_type, motion_filter_order, motion_filter_option, '
+             'brain_radius, skip_seconds, contiguous_frames or bandstop, the '
+             'values of the latter given as MIN:MAX, e.g. --stage '
+             'DCANBOLDProcessing --dbp-sweep fd_threshold=0.2,0.3 '
+             'bandstop=18.582:25.726,12:18'
+    )
+    extras.add_argument(
+        '--fork-from', metavar='SOURCE_DIR', dest='fork_from',
+        help='fork each session from the output directory of an earlier '
+             'run, then run it from --stage onward (default FreeSurfer) '
+             'with the options given, e.g. another '
+             '--hyper-normalization-method. The outputs of the stages '
+             'before --stage are reflinked from SOURCE_DIR into '
+             'output_dir where the filesystem supports it, else copied. '
+             'SOURCE_DIR is not written to, so several forks may run at '
+             'once.'
+    )
     parser.add_argument(
         '--aseg', type=str, dest='aseg',
         default=None,
@@ -260,6 +340,19 @@ def generate_parser(parser=None):
         'runtime options',
         description='special changes to runtime behaviors. Debugging features.'
     )
+    runopts.add_argument(
+        '--preflight', action='store_true',
+        help='before running any session, check the sidecar fields and '
+             'nifti headers which the pipeline reads for every session, '
+             'without loading any image data. Sessions which fail are '
+             'excluded, and a report is written to OUTPUT_DIR/'
+             'preflight.json.'
+    )
+    runopts.add_argument(
+        '--preflight-only', action='store_true',
+        help='run the --preflight checks then exit, with a non-zero status '
+             'if any session failed.'
+    )
     runopts.add_argument(
         '--check-outputs-only', action='store_true',
         help='checks for the existence of outputs for each stage then exit. '
@@ -273,6 +366,116 @@ def generate_parser(parser=None):
         '--ignore-expected-outputs', action='store_true',
         help='continues pipeline even if some expected outputs are missing.'
     )
+    runopts.add_argument(
+        '--profile', action='store_true',
+        help='profile the pipeline with cProfile and record the time spent in '
+             'bids discovery, parameter and stage construction, stage setup, '
+             'each subprocess, teardown and expected output checks. Results '
+             'are written to logs/profile in each session\'s output folder.'
+    )
+    runopts.add_argument(
+        '--profile-memory', action='store_true', dest='profile_memory',
+        help='as --profile, additionally tracing memory allocations with '
+             'tracemalloc.'
+    )
+    runopts.add_argument(
+        '--trace', action='store_true',
+        help='write a timeline of each session\'s stages, subprocesses and '
+             'worker slots to logs/profile/trace.json in the Chrome Trace '
+             'Event format, for chrome://tracing or ui.perfetto.dev. Merge '
+             'sessions with: nhp-abcd-bids-pipeline trace OUTPUT_DIR '
+             'TRACE_JSON'
+    )
+    runopts.add_argument(
+        '--trace-counters', type=float, metavar='SECONDS',
+        dest='trace_counters',
+        help='as --trace, additionally sampling the cores in use and the '
+             'memory of the pipeline\'s processes every SECONDS.'
+    )
+    runopts.add_argument(
+        '--metrics-file', metavar='PROM_FILE', dest='metrics_file',
+        help='keep stage durations, runs in flight, queued stages, failures '
+             'and the cpu time, peak memory and bytes written by stage '
+             'subprocesses in this file, in the Prometheus text format, for '
+             'node_exporter\'s textfile collector. May be shared by all '
+             'pipelines on a node.'
+    )
+    runopts.add_argument(
+        '--export-plan', nargs=2, metavar=('FORMAT', 'FILE'),
+        dest='export_plan',
+        help='instead of running, write the commands of every selected '
+             'stage and bold run to FILE as a dependency graph for an '
+             'external workflow engine, FORMAT being one of make, snakemake '
+             'or bash. Stages which only depend on the same bold run start '
+             'as soon as it is done. Nothing is run or written to the output '
+             'directory, see planner.py'
+    )
+    runopts.add_argument(
+        '--template-cache', metavar='CACHE_DIR', dest='template_cache',
+        help='snapshot the --study-template and --multi-template-dir '
+             'atlases once to this directory, unchanged and keyed by the '
+             'hashes of their contents, and use the snapshot in every '
+             'session. May be shared by all runs of a cohort, concurrent '
+             'runs wait for the first to finish copying, see cache.py'
+    )
+    runopts.add_argument(
+        '--node-cache', metavar='DIR', dest='node_cache',
+        help='copy the templates, atlases and configuration files read by '
+             'each session to this node local directory, e.g. /dev/shm/'
+             'nhp-abcd-bids-pipeline or a local SSD, and read them from '
+             'there. The copies are shared by all pipeline processes on the '
+             'node and removed when the last of them exits, see '
+             'node_cache.py'
+    )
+    runopts.add_argument(
+        '--uncompressed-intermediates', action='store_true',
+        dest='uncompressed_intermediates',
+        help='run stages with FSLOUTPUTTYPE=NIFTI, so that intermediate '
+             'images are written uncompressed, then compress only each '
+             'stage\'s expected outputs, with all --ncpus, once it has run. '
+             'Other intermediates stay uncompressed in the output '
+             'directory, typically 2-3 times their compressed size, see '
+             'compression.py'
+    )
+    runopts.add_argument(
+        '--dedup-store', metavar='STORE_DIR', dest='dedup_store',
+        help='once a session\'s last stage has run, make its output files '
+             'which are identical to those of other sessions share their '
+             'data with objects of this content store, on the same '
+             'filesystem, by reflinks, else, for expected outputs, by hard '
+             'links. Hard linked sessions cannot be forked. Verify '
+             'the store and report the space saved with: '
+             'nhp-abcd-bids-pipeline dedup --verify STORE_DIR, see dedup.py'
+    )
+    runopts.add_argument(
+        '--checksum-manifest', action='store_true', dest='checksum_manifest',
+        help='hash the expected outputs of each stage once they have been '
+             'verified, recording path, size, modification time and blake2b '
+             'in the session\'s logs/manifest.json and logs/checksums.b2. '
+             'Reruns only hash the outputs they changed, see manifest.py'
+    )
+    runopts.add_argument(
+        '--spool', metavar='SPOOL_DIR',
+        help='instead of running, submit each session to a spool directory '
+             'on a shared filesystem, from which any number of "worker" '
+             'processes pull and run one stage at a time. Start workers '
+             'with: nhp-abcd-bids-pipeline worker SPOOL_DIR'
+    )
+    runopts.add_argument(
+        '--schedule', choices=['critical-path', 'fifo'],
+        default='critical-path',
+        help='order in which workers pick up spooled stages. critical-path '
+             'starts the sessions with the longest estimated remaining run '
+             'time first, based on the durations of previous runs; fifo '
+             'runs them in submission order. Default: critical-path.'
+    )
+    runopts.add_argument(
+        '--history', metavar='FILE',
+        help='file in which stage run times are recorded and from which '
+             'they are estimated for critical-path scheduling. May be shared '
+             'by many runs. Default for spooled runs: SPOOL_DIR/'
+             'history.jsonl, otherwise no history is recorded.'
+    )
     parser.add_argument(
         '--multi-template-dir',
         help='directory for joint label fusion templates. It should contain '
@@ -280,6 +483,13 @@ def generate_parser(parser=None):
              '"Segmentation.nii.gz". Each subdirectory may have any name and '
              'any number of additional files.'
     )
+    parser.add_argument(
+        '--jlf-top-k', type=int, metavar='K', dest='jlf_top_k',
+        help='rank the --multi-template-dir atlases by their similarity to '
+             'the subject\'s T1w (or to its --t1-brain-mask region) and '
+             'use only the K most similar for joint label fusion. The '
+             'ranking is written to logs/jlf_selection.json. Requires numpy.'
+    )
     parser.add_argument(
         '--hyper-normalization-method', dest='norm_method',
         default='ADULT_GM_IP',
@@ -309,7 +519,14 @@ def interface(bids_dir, output_dir, aseg=None, subject_list=None, session_list=N
               ignore_expected_outputs=False, multi_template_dir=None, norm_method=None,
               norm_gm_std_dev_scale=1, norm_wm_std_dev_scale=1, norm_csf_std_dev_scale=1,
               make_white_from_norm_t1=False, single_pass_pial=False, registration_assist=None,
-              freesurfer_license=None):
+              freesurfer_license=None, spool=None, stop_stage=None, layout=None,
+              schedule='critical-path', history=None, profile=False,
+              profile_memory=False, trace=False, trace_counters=None,
+              metrics_file=None, preflight=False, preflight_only=False,
+              export_plan=None, dbp_sweep=None, fork_from=None,
+              template_cache=None, jlf_top_k=None, node_cache=None,
+              uncompressed_intermediates=False, dedup_store=None,
+              native_clean=False, checksum_manifest=False):
     """
     main application interface
     :param bids_dir: input bids dataset see "helpers.read_bids_dataset" for
@@ -337,19 +554,145 @@ def interface(bids_dir, output_dir, aseg=None, subject_list=None, session_list=N
     :param norm_csf_std_dev_scale: scale factor for normalized CSF standard deviation (relative to normalization template)
     :param make_white_from_norm_t1: generate white surfaces in FreeSurfer from normalized T1w
     :param single_pass_pial: generate pial surfaces in FreeSurfer with a single pass of mris_make_surfaces instead of default two-pass method (using surfaces generated in first pass create priors)
+    :param spool: submit sessions to this spool directory instead of running.
+    :param stop_stage: last stage to run.
+    :param layout: prebuilt BIDSLayout of bids_dir, used by serve mode.
+    :param schedule: order of spooled work items, critical-path or fifo.
+    :param history: path to stage duration history to record to.
+    :param profile: profile the run, see profiling.Profiler.
+    :param profile_memory: include memory allocations in the profile.
+    :param trace: write a Chrome trace of each session, see tracing.py
+    :param trace_counters: seconds between cpu and memory samples in traces.
+    :param metrics_file: Prometheus textfile to record metrics to.
+    :param preflight: check every session's inputs first, excluding those
+    which fail, see preflight.py
+    :param preflight_only: write the preflight report then terminate.
+    :param export_plan: (format, file) to write the run's commands to as a
+    dependency graph instead of running them, see planner.py
+    :param dbp_sweep: list of "parameter=value,..." strings, to run
+    DCANBOLDProcessing for every combination of, see sweep.py
+    :param fork_from: output directory of an earlier run from which the
+    outputs of the stages before start_stage are linked, see fork.py
+    :param template_cache: directory of snapshots of the study template and
+    joint label fusion atlases, see cache.py
+    :param jlf_top_k: number of joint label fusion atlases to select for
+    each session, see atlas_selection.py
+    :param node_cache: node local directory to copy templates to, see
+    node_cache.py
+    :param uncompressed_intermediates: write images uncompressed, compressing
+    each stage's expected outputs after it has run, see compression.py
+    :param dedup_store: content store to deduplicate each session's outputs
+    into after the last stage, see dedup.py
+    :param native_clean: run CustomClean in process, see clean.py
+    :param checksum_manifest: record checksums of each stage's expected
+    outputs, see manifest.py
     :return:
     """
+    # interface parameters, forwarded to workers when spooling sessions.
+    parameters = {k: v for k, v in locals().items()
+                  if k not in ('spool', 'layout')}
 
     if not check_only or not print_commands:
         validate_license(freesurfer_license)
+    assert os.path.isdir(bids_dir), bids_dir + ' is not a directory!'
+
+    # the pipeline itself is only imported once the arguments and license
+    # have been validated, so that --help, --version and usage errors return
+    # without paying for it.
+    from history import History, session_features
+    import metrics
+    from profiling import (Profiler, enable_spans, record_span,
+                           restart_session, set_session, span, timed_iter)
+    from pipelines import (ParameterSettings, PreliminaryMasking,
+                           PreFreeSurfer, FreeSurfer, PostFreeSurfer,
+                           FMRIVolume, FMRISurface, DCANBOLDProcessing,
+                           ExecutiveSummary, CustomClean)
+
+    if profile:
+        profiler = Profiler(memory=profile_memory)
+        profiler.start()
+    else:
+        profiler = None
+    if trace:
+        enable_spans()
+    if metrics_file:
+        metrics.set_metrics_file(metrics_file)
+
+    if fork_from:
+        assert os.path.abspath(fork_from) != os.path.abspath(output_dir), \
+            'a fork needs an output directory of its own'
+        assert not export_plan, '--fork-from cannot be combined with ' \
+            '--export-plan'
+        from fork import fork_session
+        start_stage = start_stage or 'FreeSurfer'
+    if dbp_sweep:
+        assert not spool and not export_plan, \
+            '--dbp-sweep cannot be combined with --spool or --export-plan'
+        from sweep import Sweep, parse_grid
+        grid = parse_grid(dbp_sweep)
+    if uncompressed_intermediates:
+        assert not export_plan, '--uncompressed-intermediates cannot be ' \
+            'combined with --export-plan'
+        os.environ['FSLOUTPUTTYPE'] = 'NIFTI'
+    if dedup_store:
+        assert not export_plan, '--dedup-store cannot be combined with ' \
+            '--export-plan'
+        from dedup import ContentStore, deduplicate
+    if export_plan:
+        import planner
+        plan_format, plan_file = export_plan
+        assert plan_format in planner.FORMATS, \
+            '"%s" is not a plan format, choose from %s' % (
+                plan_format, ', '.join(sorted(planner.FORMATS)))
+        jobs = []
 
     # read from bids dataset
-    assert os.path.isdir(bids_dir), bids_dir + ' is not a directory!'
-    if not os.path.isdir(output_dir):
+    if (preflight or not export_plan) and not os.path.isdir(output_dir):
         os.makedirs(output_dir)
     session_generator = read_bids_dataset(
-        bids_dir, subject_list=subject_list, session_list=session_list
+        bids_dir, subject_list=subject_list, session_list=session_list,
+        layout=layout
     )
+    session_generator = timed_iter('bids discovery', session_generator)
+    if preflight:
+        from preflight import preflight as check_sessions, write_report
+        sessions = list(session_generator)
+        with span('preflight'):
+            report = check_sessions(sessions)
+        write_report(report, output_dir)
+        if preflight_only:
+            return 1 if report['excluded'] else 0
+        session_generator = [s for s, entry in zip(sessions,
+                                                  report['sessions'])
+                             if entry['ok']]
+
+    if jlf_top_k:
+        assert multi_template_dir, '--jlf-top-k needs --multi-template-dir'
+        assert jlf_top_k > 0, '--jlf-top-k must be positive'
+        assert not export_plan, '--jlf-top-k cannot be combined with ' \
+            '--export-plan'
+        if importlib.util.find_spec('numpy') is None:
+            raise ImportError('--jlf-top-k needs numpy, which is not '
+                              'installed')
+        from atlas_selection import select_atlases
+    cache = None
+    if template_cache and not (check_only or print_commands or export_plan):
+        from cache import (TemplateCache, cache_jlf_atlases,
+                           cache_study_template)
+        cache = TemplateCache(template_cache)
+        with span('template cache'):
+            if study_template is not None:
+                study_template = cache_study_template(cache, *study_template)
+            if multi_template_dir is not None:
+                multi_template_dir = cache_jlf_atlases(cache,
+                                                       multi_template_dir)
+    # spooled sessions are localized by the workers running them, on their
+    # own nodes, rather than on the node submitting them.
+    node = None
+    if node_cache and not (check_only or print_commands or export_plan or
+                           spool):
+        from node_cache import NodeCache
+        node = NodeCache(node_cache)
 
     # run each session in serial
     for session in session_generator:
@@ -359,10 +702,12 @@ def interface(bids_dir, output_dir, aseg=None, subject_list=None, session_list=N
             'sub-%s' % session['subject'],
             'ses-%s' % session['session']
         )
+        if profiler or trace:
+            set_session(os.path.join(out_dir, 'logs'))
+        start = time.time()
         session_spec = ParameterSettings(session, out_dir)
-        if not run_func:
-            anat_only = True
-            session_spec.set_anat_only(anat_only)
+        if not session['func']:
+            session_spec.set_anat_only(True)
         if aseg is not None:
             session_spec.set_aseg(aseg)
             session_spec.set_asegdir(os.path.dirname(aseg))
@@ -396,8 +741,13 @@ def interface(bids_dir, output_dir, aseg=None, subject_list=None, session_list=N
             session_spec.set_templates_dir(multi_template_dir)
         if max_cortical_thickness is not 5:
             session_spec.set_max_cortical_thickness(max_cortical_thickness)
+        record_span('parameter build', start, time.time())
+        if node is not None:
+            with span('node cache'):
+                node.localize(session_spec)
 
         # create pipelines
+        start = time.time()
         mask = PreliminaryMasking(session_spec)
         pre = PreFreeSurfer(session_spec)
         free = FreeSurfer(session_spec)
@@ -406,6 +756,7 @@ def interface(bids_dir, output_dir, aseg=None, subject_list=None, session_list=N
         surf = FMRISurface(session_spec)
         boldproc = DCANBOLDProcessing(session_spec)
         execsum = ExecutiveSummary(session_spec)
+        record_span('stage construction', start, time.time())
 
         # set user parameters
         if registration_assist:
@@ -418,15 +769,52 @@ def interface(bids_dir, output_dir, aseg=None, subject_list=None, session_list=N
         order = [mask, pre, free, post, vol, surf, boldproc, execsum]
 
         if cleaning_json:
-            cclean = CustomClean(session_spec, cleaning_json)
+            cclean = CustomClean(session_spec, cleaning_json, native_clean)
             order.append(cclean)
 
+        stages = [x.__class__.__name__ for x in order]
+        session_stages = order
         if start_stage:
             names = [x.__class__.__name__ for x in order]
             assert start_stage in names, \
                 '"%s" is unknown, check class name and case for given stage' \
                 % start_stage
             order = order[names.index(start_stage):]
+        if stop_stage:
+            names = [x.__class__.__name__ for x in order]
+            assert stop_stage in names, \
+                '"%s" is unknown, check class name and case for given stage' \
+                % stop_stage
+            order = order[:names.index(stop_stage) + 1]
+        # the session's spans and profile are shared by its runs, e.g. spool
+        # workers running one stage each, until it is run from the start.
+        restarted = order[0] is session_stages[0]
+        if (profiler or trace) and restarted and \
+                not (check_only or print_commands or export_plan):
+            restart_session()
+
+        if fork_from and not (print_commands or check_only):
+            upstream = stages[:stages.index(order[0].__class__.__name__)]
+            assert upstream, 'nothing to fork before %s' % start_stage
+            fork_session(os.path.join(fork_from,
+                                      'sub-%s' % session['subject'],
+                                      'ses-%s' % session['session']),
+                         out_dir, upstream)
+        if export_plan:
+            jobs += planner.plan_session(
+                'sub-%s_ses-%s' % (session['subject'], session['session']),
+                order, ncpus)
+            continue
+        if spool or history:
+            features = session_features(session_spec, ncpus)
+        if spool:
+            from spool import enqueue
+            names = [x.__class__.__name__ for x in order]
+            item_id = enqueue(spool, session, names, parameters, features,
+                              schedule)
+            print('submitted sub-%s ses-%s to %s as %s' %
+                  (session['subject'], session['session'], spool, item_id))
+            continue
 
         # special runtime options
         if check_only:
@@ -446,14 +834,66 @@ def interface(bids_dir, output_dir, aseg=None, subject_list=None, session_list=N
             print('ignoring checks for expected outputs.')
             for stage in order:
                 stage.activate_ignore_expected_outputs()
+        if uncompressed_intermediates:
+            for stage in order:
+                stage.activate_output_compression(ncpus)
+        if checksum_manifest:
+            for stage in order:
+                stage.activate_checksum_manifest()
+
+        if jlf_top_k and pre in order and not print_commands:
+            pre.set_templates_dir(select_atlases(
+                session['t1w'][0], multi_template_dir, jlf_top_k,
+                os.path.join(session_spec.path, 'jlf_atlases'),
+                session_spec.logs, brain_mask=t1_brain_mask))
+        if dbp_sweep:
+            names = [x.__class__.__name__ for x in order]
+            assert 'DCANBOLDProcessing' in names, \
+                '--dbp-sweep needs DCANBOLDProcessing among the stages run'
+            order = order[:names.index('DCANBOLDProcessing') + 1]
+            # the sweep ends the session, no stage after it is run
+            stages = stages[:stages.index('DCANBOLDProcessing') + 1]
+            session_stages = session_stages[:len(stages)]
+        # the last stage scheduled, which a sweep stands in for
+        scheduled = order[-1].__class__.__name__
+        if dbp_sweep:
+            order = order[:-1] + [Sweep(boldproc, grid)]
 
         # run pipelines
-        for stage in order:
-            print('nhp-abcd-bids-pipeline v%s' % __version__)
-            print('running %s' % stage.__class__.__name__)
-            print(stage)
-            stage.run(ncpus)
+        with contextlib.ExitStack() as stack:
+            if profiler:
+                stack.enter_context(profiler.session(session_spec.logs,
+                                                    not restarted))
+            if trace:
+                from tracing import session as trace_session
+                stack.enter_context(trace_session(session_spec.logs,
+                                                  trace_counters))
+            for i, stage in enumerate(order):
+                metrics.set_queued(len(order) - i - 1)
+                print('nhp-abcd-bids-pipeline v%s' % __version__)
+                print('running %s' % stage.__class__.__name__)
+                print(stage)
+                start = time.time()
+                stage.run(ncpus)
+                if history and not print_commands:
+                    History(history).record(stage.__class__.__name__,
+                                            features, time.time() - start)
+            # once the session's last stage has run, e.g. by the spool
+            # worker running it.
+            finished = not print_commands and scheduled == stages[-1]
+            if dedup_store and finished:
+                with span('deduplication'):
+                    # only expected outputs may be hard linked, see dedup.py
+                    outputs = [find_output(p) for stage in session_stages
+                               for p in stage.get_expected_outputs()]
+                    deduplicate(ContentStore(dedup_store),
+                                [session_spec.path], ncpus, outputs=outputs)
+
+    if export_plan:
+        planner.write_plan(plan_file, plan_format, jobs)
+    if profiler:
+        profiler.stop()
 
 
 if __name__ == '__main__':
-    _cli()
+    sys.exit(_cli())
@@ -0,0 +1,231 @@
+"""
+Long-lived pipeline server.  The server process is started once, e.g. via the
+container entrypoint, so the pipeline environment, the imported modules, the
+BIDS index of each dataset and the parsed expected outputs stay warm between
+jobs.  Jobs are submitted over a local Unix socket by a thin client which
+accepts the same arguments as run.py.
+
+protocol:
+    client -> server: one json line {"argv": [...], "cwd": "..."}
+    server -> client: the job's stdout and stderr, followed by a newline and
+                      a final line EXIT_MARKER + exit status, so that the
+                      marker starts a line of its own even if the job's
+                      output does not end with a newline.
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import socket
+import sys
+import threading
+import traceback
+
+EXIT_MARKER = '\0exit '
+
+
+def _stamp(root):
+    """
+    :param root: bids dataset.
+    :return: latest modification time of its subject, session and datatype
+    folders, e.g. sub-X/ses-Y/func, which change as files are added, renamed
+    or removed.
+    """
+    latest = os.stat(root).st_mtime_ns
+    folders = [root]
+    for depth in range(3):
+        below = []
+        for folder in folders:
+            for entry in os.scandir(folder):
+                if entry.is_dir() and (depth or entry.name.startswith('sub-')):
+                    latest = max(latest, entry.stat().st_mtime_ns)
+                    below.append(entry.path)
+        folders = below
+    return latest
+
+
+class LayoutCache(object):
+    """
+    BIDSLayout per dataset, rebuilt when any of the dataset's subject,
+    session or datatype folders changes, e.g. when a subject, session or run
+    is added.
+    """
+
+    def __init__(self):
+        self._layouts = {}
+        self._lock = threading.Lock()
+
+    def get(self, bids_dir):
+        from bids.layout import BIDSLayout
+        key = os.path.realpath(bids_dir)
+        with self._lock:
+            stamp = _stamp(key)
+            cached = self._layouts.get(key)
+            if cached is None or cached[0] != stamp:
+                print('indexing %s' % key)
+                cached = (stamp, BIDSLayout(key, index_metadata=True))
+                self._layouts[key] = cached
+        return cached[1]
+
+
+def _run_job(conn, argv, cwd, layout):
+    """
+    runs a single job in a forked child process, so that per-job runtime
+    settings of the Stage classes cannot leak between jobs.  Output is
+    written directly to the client's connection.
+    """
+    from node_cache import release_all
+    from run import generate_parser, get_interface_kwargs, interface
+    os.dup2(conn.fileno(), sys.stdout.fileno())
+    os.dup2(conn.fileno(), sys.stderr.fileno())
+    os.chdir(cwd)
+    kwargs = get_interface_kwargs(generate_parser().parse_args(argv))
+    try:
+        interface(layout=layout, **kwargs)
+    except BaseException:
+        traceback.print_exc()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        release_all()
+        os._exit(1)
+    # os._exit skips atexit handlers
+    release_all()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(0)
+
+
+class PipelineServer(object):
+    """
+    accepts job requests on a Unix socket and runs up to max_jobs of them
+    concurrently, each in a child forked from the warm server process.
+    """
+
+    def __init__(self, socket_path, max_jobs=1):
+        """
+        :param socket_path: path of the Unix socket to listen on.
+        :param max_jobs: maximum number of concurrently running jobs.  Further
+        requests wait for a free slot.
+        """
+        self.socket_path = socket_path
+        self.slots = threading.BoundedSemaphore(max_jobs)
+        self.layouts = LayoutCache()
+        self.context = mp.get_context('fork')
+
+    def warm(self):
+        """
+        imports everything a job needs before the first request arrives.
+        """
+        import run
+        from pipelines import load_expected_outputs
+        load_expected_outputs()
+
+    def handle(self, conn):
+        with conn:
+            request = json.loads(conn.makefile('r').readline())
+            argv, cwd = request['argv'], request['cwd']
+            try:
+                from run import generate_parser
+                args = generate_parser().parse_args(argv)
+                layout = self.layouts.get(os.path.join(cwd, args.bids_dir))
+            except BaseException as e:
+                conn.sendall(('%r\n\n%s1\n' % (e, EXIT_MARKER)).encode())
+                return
+            with self.slots:
+                proc = self.context.Process(target=_run_job,
+                                            args=(conn, argv, cwd, layout))
+                proc.start()
+                proc.join()
+            conn.sendall(('\n%s%d\n' % (EXIT_MARKER,
+                                          proc.exitcode)).encode())
+
+    def serve_forever(self):
+        self.warm()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.socket_path)
+        sock.listen()
+        print('nhp-abcd-bids-pipeline server listening on %s' %
+              self.socket_path)
+        try:
+            while True:
+                conn, _ = sock.accept()
+                threading.Thread(target=self.handle, args=(conn,),
+                                 daemon=True).start()
+        finally:
+            sock.close()
+            os.remove(self.socket_path)
+
+
+def submit(socket_path, argv):
+    """
+    sends a job to the server and relays its output until it completes.
+    :param socket_path: path of the server's Unix socket.
+    :param argv: run.py command line arguments for the job.
+    :return: exit status of the job
+    """
+    request = {'argv': argv, 'cwd': os.getcwd()}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + '\n').encode())
+        # each line's newline is held back until the next line, as the
+        # newline before the exit marker is the server's, not the job's.
+        newline = ''
+        for line in sock.makefile('r', errors='replace'):
+            head, marker, status = line.partition(EXIT_MARKER)
+            if marker:
+                if head:
+                    sys.stdout.write(newline + head)
+                return int(status)
+            sys.stdout.write(newline + line.rstrip('\n'))
+            newline = '\n' if line.endswith('\n') else ''
+        sys.stdout.write(newline)
+    return 1
+
+
+def generate_parser(parser=None):
+    """
+    Generates the command line parser for the serve mode.
+    :param parser: optional subparser for wrapping this program as a submodule.
+    :return: ArgumentParser for this script/module
+    """
+    if not parser:
+        parser = argparse.ArgumentParser(
+            prog='nhp-abcd-bids-pipeline serve',
+            description='start a long-lived server which keeps the pipeline '
+                        'environment and bids indices warm, and runs jobs '
+                        'submitted with: nhp-abcd-bids-pipeline client '
+                        '--socket SOCKET bids_dir output_dir [OPTIONS]'
+        )
+    parser.add_argument(
+        '--socket', default='/tmp/nhp-abcd-bids-pipeline.sock',
+        help='path of the Unix socket. '
+             'Default = /tmp/nhp-abcd-bids-pipeline.sock'
+    )
+    parser.add_argument(
+        '--max-jobs', type=int, default=1, dest='max_jobs',
+        help='maximum number of jobs run concurrently; further jobs wait '
+             'for a free slot. Default = 1.'
+    )
+    return parser
+
+
+def _cli(mode='serve', argv=None):
+    if mode == 'client':
+        # the client takes run.py arguments, plus the socket path.
+        client = argparse.ArgumentParser(add_help=False)
+        client.add_argument('--socket',
+                            default='/tmp/nhp-abcd-bids-pipeline.sock')
+        args, argv = client.parse_known_args(argv)
+        # validate locally so usage errors never reach the server.
+        from run import generate_parser as run_parser
+        run_parser().parse_args(argv)
+        return submit(args.socket, argv)
+
+    args = generate_parser().parse_args(argv)
+    PipelineServer(args.socket, args.max_jobs).serve_forever()
+
+
+if __name__ == '__main__':
+    exit(_cli(argv=sys.argv[1:]))
@@ -0,0 +1,358 @@
+"""
+Work-stealing queue of (session, stage) work items kept in a directory on a
+filesystem shared by every participating node.
+
+spool layout:
+    pending/    work items waiting for a worker
+    claimed/    work items being processed, suffixed with the worker id
+    done/       completed work items
+    failed/     work items whose stage raised or exited non-zero
+    heartbeats/ one file per live worker, touched periodically
+
+Items move between folders exclusively by os.rename, which is atomic within a
+single filesystem (including NFS), so exactly one worker wins each claim and
+exactly one worker requeues the items of a dead worker.
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+
+import metrics
+
+FOLDERS = ('pending', 'claimed', 'done', 'failed', 'heartbeats')
+
+# shared stage duration history, see history.py
+HISTORY = 'history.jsonl'
+
+MAX_PRIORITY = 10 ** 10 - 1
+
+# work item ordering policies: longest remaining critical path first, or
+# submission order.
+SCHEDULES = ('critical-path', 'fifo')
+
+
+class Spool(object):
+    """
+    Shared directory holding pipeline work items.  A work item is a json
+    dict with the session it belongs to, the remaining stages for that
+    session, and the keyword arguments to run.interface.
+    """
+
+    # separates the item id from the worker id in claimed filenames
+    sep = '@'
+
+    def __init__(self, root):
+        """
+        :param root: path to the spool directory, created if missing.
+        """
+        self.root = root
+        for folder in FOLDERS:
+            os.makedirs(os.path.join(root, folder), exist_ok=True)
+
+    def _path(self, folder, name=''):
+        return os.path.join(self.root, folder, name)
+
+    def _list(self, folder):
+        return sorted(f for f in os.listdir(self._path(folder))
+                      if f.endswith('.json'))
+
+    def put(self, item, priority=0):
+        """
+        adds a work item to the queue.  Items are claimed in lexical order of
+        their ids, which begin with the inverted priority followed by the
+        submission time.
+        :param item: json serializable dict.
+        :param priority: items with higher priority are claimed first.
+        :return: id of the new item
+        """
+        rank = max(0, MAX_PRIORITY - int(priority))
+        item_id = '%010d-%020d-%s' % (rank, time.time_ns(),
+                                      uuid.uuid4().hex[:8])
+        item = dict(item, id=item_id)
+        # write under a dot name so workers never see a partial file
+        tmp = self._path('pending', '.%s.tmp' % item_id)
+        with open(tmp, 'w') as fd:
+            json.dump(item, fd, indent=4)
+        os.rename(tmp, self._path('pending', item_id + '.json'))
+        return item_id
+
+    def claim(self, worker_id):
+        """
+        atomically moves the first available pending item to claimed.
+        :param worker_id: unique id of the claiming worker.
+        :return: (claimed filename, item) or None if the queue is empty.
+        """
+        for name in self._list('pending'):
+            claimed = name[:-len('.json')] + self.sep + worker_id + '.json'
+            try:
+                os.rename(self._path('pending', name),
+                          self._path('claimed', claimed))
+            except FileNotFoundError:
+                # another worker won the race for this item
+                continue
+            with open(self._path('claimed', claimed)) as fd:
+                return claimed, json.load(fd)
+        return None
+
+    def finish(self, claimed, succeeded=True):
+        """
+        moves a claimed item to done or failed.
+        :param claimed: claimed filename returned by claim.
+        :param succeeded: destination is done if True, else failed.
+        :return: False if the item is no longer claimed, having been
+        requeued as if its worker were dead, else True.
+        """
+        name = claimed.split(self.sep)[0] + '.json'
+        folder = 'done' if succeeded else 'failed'
+        try:
+            os.rename(self._path('claimed', claimed),
+                      self._path(folder, name))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def beat(self, worker_id):
+        """
+        records that a worker is alive.
+        """
+        path = self._path('heartbeats', worker_id)
+        with open(path, 'w') as fd:
+            fd.write('%s\n' % time.time())
+
+    def retire(self, worker_id):
+        """
+        removes the heartbeat of a worker which exits cleanly.
+        """
+        try:
+            os.remove(self._path('heartbeats', worker_id))
+        except FileNotFoundError:
+            pass
+
+    def requeue_dead(self, timeout):
+        """
+        returns claimed items to pending when their worker has not sent a
+        heartbeat within timeout seconds.
+        :param timeout: seconds after which a worker is considered dead.
+        :return: list of requeued item filenames.
+        """
+        now = time.time()
+        requeued = []
+        for claimed in self._list('claimed'):
+            worker_id = claimed[:-len('.json')].split(self.sep, 1)[1]
+            try:
+                last = os.stat(self._path('heartbeats', worker_id)).st_mtime
+            except FileNotFoundError:
+                last = 0
+            if now - last < timeout:
+                continue
+            name = claimed.split(self.sep)[0] + '.json'
+            try:
+                os.rename(self._path('claimed', claimed),
+                          self._path('pending', name))
+            except FileNotFoundError:
+                continue
+            print('requeued %s from dead worker %s' % (name, worker_id))
+            requeued.append(name)
+        return requeued
+
+    def counts(self):
+        """
+        :return: dict of number of items per folder.
+        """
+        return {f: len(self._list(f)) for f in FOLDERS if f != 'heartbeats'}
+
+
+def get_priority(spool_dir, item):
+    """
+    priority of a work item under its scheduling policy.  For critical-path
+    scheduling this is the estimated number of seconds until the item's
+    session completes, so long FreeSurfer and bold sessions start first and
+    short stages backfill idle workers.
+    """
+    if item['schedule'] != 'critical-path':
+        return 0
+    from history import History
+    history = History(item['kwargs'].get('history') or
+                      os.path.join(spool_dir, HISTORY))
+    return history.critical_path(item['stages'], item['features'])
+
+
+def enqueue(spool_dir, session, stage_names, kwargs, features,
+            schedule='critical-path'):
+    """
+    submits the stages of one session to the spool.  Only the first stage is
+    queued; the worker which completes it queues the remainder.
+    :param spool_dir: path to the spool directory.
+    :param session: bids data struct yielded by read_bids_dataset.
+    :param stage_names: ordered list of stage class names to run.
+    :param kwargs: keyword arguments for run.interface.
+    :param features: session features, see history.session_features.
+    :param schedule: one of SCHEDULES.
+    :return: id of the queued item
+    """
+    item = {
+        'subject': session['subject'],
+        'session': session['session'],
+        'stages': stage_names,
+        'kwargs': kwargs,
+        'features': features,
+        'schedule': schedule,
+    }
+    return Spool(spool_dir).put(item, get_priority(spool_dir, item))
+
+
+def _run_item(spool_dir, item):
+    """
+    runs the first stage of a work item.  Executed in a child process so
+    the class level runtime settings of one item's stages cannot leak into
+    the next item processed by the same worker.
+    """
+    from node_cache import release_all
+    from run import interface
+    kwargs = dict(item['kwargs'])
+    if not kwargs.get('history'):
+        kwargs['history'] = os.path.join(spool_dir, HISTORY)
+    kwargs['subject_list'] = [item['subject']]
+    if item['session'] is not None:
+        kwargs['session_list'] = item['session'] \
+            if isinstance(item['session'], list) else [item['session']]
+    kwargs['start_stage'] = kwargs['stop_stage'] = item['stages'][0]
+    # sessions were checked, and forked, when they were submitted
+    kwargs['preflight'] = kwargs['preflight_only'] = False
+    kwargs['fork_from'] = None
+    try:
+        interface(**kwargs)
+    finally:
+        # the child exits by os._exit, which skips atexit handlers
+        release_all()
+
+
+def _heartbeat(spool, worker_id, interval, stop):
+    while not stop.wait(interval):
+        spool.beat(worker_id)
+
+
+def work(spool_dir, heartbeat=30, timeout=300, poll=10, wait=False):
+    """
+    main worker loop.  Claims and runs work items until the spool is drained.
+    :param spool_dir: path to the spool directory.
+    :param heartbeat: seconds between heartbeats.
+    :param timeout: seconds without heartbeat before a worker's items are
+    requeued.  Must be comfortably larger than heartbeat.
+    :param poll: seconds to sleep when no item is available.
+    :param wait: keep polling for new items after the spool is drained.
+    :return: number of failed items
+    """
+    spool = Spool(spool_dir)
+    worker_id = '%s.%d' % (socket.gethostname(), os.getpid())
+    spool.beat(worker_id)
+    stop = threading.Event()
+    beater = threading.Thread(target=_heartbeat,
+                              args=(spool, worker_id, heartbeat, stop),
+                              daemon=True)
+    beater.start()
+    failures = 0
+    try:
+        while True:
+            spool.requeue_dead(timeout)
+            metrics.set_spool_counts(spool.counts())
+            claim = spool.claim(worker_id)
+            if claim is None:
+                counts = spool.counts()
+                if not wait and not counts['pending'] and \
+                        not counts['claimed']:
+                    break
+                time.sleep(poll)
+                continue
+            claimed, item = claim
+            stage = item['stages'][0]
+            print('worker %s running %s for sub-%s ses-%s' %
+                  (worker_id, stage, item['subject'], item['session']))
+            proc = mp.Process(target=_run_item, args=(spool_dir, item))
+            proc.start()
+            proc.join()
+            succeeded = proc.exitcode == 0
+            if not succeeded:
+                print('worker %s: %s failed for sub-%s ses-%s' %
+                      (worker_id, stage, item['subject'], item['session']))
+                failures += 1
+            # finished before the next stage is queued, as the item may have
+            # been requeued meanwhile, e.g. after a heartbeat was delayed,
+            # in which case whoever runs it again queues the next stage.
+            if not spool.finish(claimed, succeeded):
+                print('worker %s: %s for sub-%s ses-%s was requeued while '
+                      'running, leaving it to the worker running it again' %
+                      (worker_id, stage, item['subject'], item['session']))
+                continue
+            if succeeded and item['stages'][1:]:
+                item = dict(item, stages=item['stages'][1:])
+                spool.put(item, get_priority(spool_dir, item))
+    finally:
+        stop.set()
+        spool.retire(worker_id)
+    return failures
+
+
+def generate_parser(parser=None):
+    """
+    Generates the command line parser for the worker mode.
+    :param parser: optional subparser for wrapping this program as a submodule.
+    :return: ArgumentParser for this script/module
+    """
+    if not parser:
+        parser = argparse.ArgumentParser(
+            prog='nhp-abcd-bids-pipeline worker',
+            description='pull (session, stage) work items from a spool '
+                        'directory on a shared filesystem and run them. '
+                        'Items are submitted with nhp-abcd-bids-pipeline '
+                        '--spool. Any number of workers may run on any '
+                        'number of nodes.'
+        )
+    parser.add_argument(
+        'spool_dir',
+        help='path to the spool directory shared by all workers.'
+    )
+    parser.add_argument(
+        '--heartbeat', type=float, default=30,
+        help='seconds between worker heartbeats. Default = 30.'
+    )
+    parser.add_argument(
+        '--timeout', type=float, default=300,
+        help='seconds without a heartbeat after which a worker is presumed '
+             'dead and its claimed items are requeued. Default = 300.'
+    )
+    parser.add_argument(
+        '--poll', type=float, default=10,
+        help='seconds to wait between checks of an empty spool. Default = 10.'
+    )
+    parser.add_argument(
+        '--metrics-file', metavar='PROM_FILE', dest='metrics_file',
+        help='Prometheus textfile to which the number of pending, claimed, '
+             'done and failed items is written, see nhp-abcd-bids-pipeline '
+             '--metrics-file.'
+    )
+    parser.add_argument(
+        '--wait', action='store_true',
+        help='keep waiting for new items once the spool is drained, rather '
+             'than exiting.'
+    )
+    return parser
+
+
+def _cli(mode='worker', argv=None):
+    args = generate_parser().parse_args(argv)
+    if args.metrics_file:
+        metrics.set_metrics_file(args.metrics_file)
+    failures = work(args.spool_dir, heartbeat=args.heartbeat,
+                    timeout=args.timeout, poll=args.poll, wait=args.wait)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    exit(_cli(argv=sys.argv[1:]))
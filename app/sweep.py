@@ -0,0 +1,268 @@
+"""
+Parameter sweeps of DCANBOLDProcessing.  Rather than rerunning a session for
+each set of bold processing parameters, the session's DCANBOLDProcessing
+setup (ventricle and white matter masks) is run once, then every combination
+of the swept values runs concurrently, each in its own workspace:
+
+    <output_dir>/sub-X/ses-Y/sweep/<combination>/files
+    <output_dir>/sub-X/ses-Y/sweep/<combination>/logs
+
+A workspace links to the outputs of the session's earlier stages (FMRISurface
+and before), so they are shared rather than copied.  Only the outputs named
+after $DCANBOLDPROCVER, which DCANBOLDProcessing writes, are the workspace's
+own, including its summary_$DCANBOLDPROCVER folder.  The parameters, exit
+status and resource usage of every combination are written to sweep.json.
+
+    --dbp-sweep fd_threshold=0.2,0.3 bandstop=18.582:25.726,12:18
+"""
+import itertools
+import json
+import os
+import resource
+import sys
+import time
+import traceback
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+
+from helpers import get_fmriname
+from pipelines import DCANBOLDProcessing, Stage
+
+REPORT = 'sweep.json'
+
+# swept parameters, see ParameterSettings, and their types.
+PARAMETERS = {
+    'fd_threshold': float,
+    'filter_order': int,
+    'lower_bpf': float,
+    'upper_bpf': float,
+    'motion_filter_type': str,
+    'motion_filter_order': int,
+    'motion_filter_option': int,
+    'brain_radius': int,
+    'skip_seconds': int,
+    'contiguous_frames': int,
+}
+# motion regressor band-stop limits, as with --bandstop, given as MIN:MAX
+BANDSTOP = 'bandstop'
+
+
+def _bandstop(value):
+    lower, upper = value.split(':')
+    return float(lower), float(upper)
+
+
+def parse_grid(specs):
+    """
+    :param specs: list of "parameter=value,value,..." strings.
+    :return: list of (parameter, list of values) in the given order.
+    """
+    grid = []
+    for spec in specs:
+        name, sep, values = spec.partition('=')
+        if not sep or not values:
+            raise ValueError('"%s" is not of the form parameter=value,...'
+                             % spec)
+        if name == BANDSTOP:
+            convert = _bandstop
+        elif name in PARAMETERS:
+            convert = PARAMETERS[name]
+        else:
+            raise ValueError('"%s" cannot be swept, choose from %s' % (
+                name, ', '.join(sorted(list(PARAMETERS) + [BANDSTOP]))))
+        try:
+            grid.append((name, [convert(v) for v in values.split(',')]))
+        except ValueError:
+            raise ValueError('invalid values for %s: %s' % (name, values))
+    return grid
+
+
+def combinations(grid):
+    """
+    :param grid: see parse_grid
+    :return: list of dicts of parameter to value, one per combination.
+    """
+    names = [name for name, _ in grid]
+    return [dict(zip(names, values))
+            for values in itertools.product(*(v for _, v in grid))]
+
+
+def get_label(combination):
+    """
+    :return: folder name of a combination, e.g. fd_threshold-0.2_bandstop-12-18
+    """
+    parts = []
+    for name, value in combination.items():
+        if name == BANDSTOP:
+            value = '%g-%g' % value
+        parts.append('%s-%s' % (name, value))
+    return '_'.join(parts)
+
+
+def link_workspace(source, target, private_dirs, private_names):
+    """
+    mirrors source in target with symbolic links.  Directories on the path to
+    one of private_dirs are created rather than linked, so that new files may
+    be written to them without touching source.
+    :param source: session output folder, e.g. sub-X/ses-Y/files
+    :param target: workspace output folder.
+    :param private_dirs: paths relative to source.
+    :param private_names: entries containing any of these strings are
+    neither linked nor descended into.
+    """
+    def mirror(relpath):
+        os.makedirs(os.path.join(target, relpath), exist_ok=True)
+        for entry in os.scandir(os.path.join(source, relpath)):
+            if any(name in entry.name for name in private_names):
+                continue
+            rel = os.path.join(relpath, entry.name)
+            dst = os.path.join(target, rel)
+            if entry.is_dir(follow_symlinks=False) and any(
+                    d == rel or d.startswith(rel + os.sep)
+                    for d in private_dirs):
+                mirror(rel)
+            elif not os.path.lexists(dst):
+                os.symlink(entry.path, dst)
+
+    mirror('')
+
+
+def _run_combination(stage, report):
+    """
+    runs in a forked child, so that the resource usage of the combination's
+    commands is that of the child's own children.
+    """
+    start = time.time()
+    try:
+        stage.run(1)
+        status = 0
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    with open(report, 'w') as fd:
+        json.dump({'status': status,
+                   'wall_time': time.time() - start,
+                   'cpu_user': usage.ru_utime,
+                   'cpu_system': usage.ru_stime,
+                   'max_rss_bytes': usage.ru_maxrss * 1024,
+                   'written_bytes': usage.ru_oublock * 512}, fd)
+    sys.exit(status)
+
+
+class Sweep(object):
+    """
+    stands in for DCANBOLDProcessing in the pipeline order, running it once
+    per combination of the swept parameters.
+    """
+
+    def __init__(self, stage, grid):
+        """
+        :param stage: the session's DCANBOLDProcessing, whose parameters are
+        those of every combination but for the swept ones.
+        :param grid: swept parameters, see parse_grid
+        """
+        self.config = stage.config
+        # runs the shared setup
+        self.stage = stage
+        self.root = os.path.join(os.path.dirname(stage.kwargs['path']),
+                                 'sweep')
+        self.stages = {}
+        for combination in combinations(grid):
+            label = get_label(combination)
+            stage = DCANBOLDProcessing(self.config)
+            stage.kwargs = dict(self.stage.kwargs)
+            for name, value in combination.items():
+                if name == BANDSTOP:
+                    stage.set_bandstop_filter(*value)
+                else:
+                    stage.kwargs[name] = value
+            stage.set_workspace(os.path.join(self.root, label, 'files'),
+                                os.path.join(self.root, label, 'logs'))
+            self.stages[label] = (combination, stage)
+
+    def __str__(self):
+        return '\n'.join('%s:\n%s' % (label, stage)
+                         for label, (_, stage) in self.stages.items())
+
+    def setup(self):
+        """
+        runs DCANBOLDProcessing setup in the session's output folder.
+        """
+        # as in a normal run, setup reads the kwargs of the stage's last run.
+        for _ in self.stage.cmdline():
+            pass
+        cmd = self.stage.setup_cmdline()
+        log_dir = self.stage._get_log_dir()
+        out_log = os.path.join(log_dir, 'DCANBOLDProcessing_setup.out')
+        err_log = os.path.join(log_dir, 'DCANBOLDProcessing_setup.err')
+        result = self.stage.call(cmd, out_log, err_log)
+        if result != 0:
+            raise Exception('DCANBOLDProcessing setup terminated with exit '
+                            'code %s' % result)
+
+    def link(self, stage):
+        """
+        links the session's outputs into a combination's workspace.
+        """
+        private_dirs = [os.path.join('MNINonLinear', 'Results',
+                                     get_fmriname(fmri))
+                        for fmri, _ in self.config.get_bold_runs()]
+        private_names = [os.environ['DCANBOLDPROCVER'], 'summary_']
+        link_workspace(self.stage.kwargs['path'], stage.kwargs['path'], private_dirs,
+                       private_names)
+
+    def run(self, ncpus=1):
+        """
+        runs the shared setup, then ncpus combinations at a time.
+        :param ncpus: number of concurrent combinations.
+        """
+        if not Stage.call_active:
+            return
+        self.setup()
+        context = mp.get_context('fork')
+
+        def run_one(label):
+            _, stage = self.stages[label]
+            self.link(stage)
+            report = os.path.join(self.root, label, 'logs', 'resources.json')
+            os.makedirs(os.path.dirname(report), exist_ok=True)
+            proc = context.Process(target=_run_combination,
+                                   args=(stage, report))
+            proc.start()
+            proc.join()
+            try:
+                with open(report) as fd:
+                    return json.load(fd)
+            except (OSError, ValueError):
+                return {'status': proc.exitcode}
+
+        labels = list(self.stages)
+        with ThreadPool(processes=max(1, min(ncpus, len(labels)))) as pool:
+            results = pool.map(run_one, labels)
+
+        entries = []
+        for label, result in zip(labels, results):
+            combination, stage = self.stages[label]
+            parameters = dict(combination)
+            if BANDSTOP in parameters:
+                parameters[BANDSTOP] = list(parameters[BANDSTOP])
+            entries.append(dict(label=label, parameters=parameters,
+                                workspace=os.path.join(self.root, label),
+                                succeeded=result['status'] == 0, **result))
+        path = os.path.join(self.root, REPORT)
+        with open(path, 'w') as fd:
+            json.dump({'combinations': entries}, fd, indent=4)
+        for entry in entries:
+            print('%-48s %s  wall %6.1fs  cpu %6.1fs  max rss %6.1f MB' % (
+                entry['label'],
+                'ok    ' if entry['succeeded'] else 'FAILED',
+                entry.get('wall_time', 0),
+                entry.get('cpu_user', 0) + entry.get('cpu_system', 0),
+                entry.get('max_rss_bytes', 0) / 2. ** 20))
+        print('sweep report written to %s' % path)
+        failed = [e['label'] for e in entries if not e['succeeded']]
+        if failed:
+            raise Exception('error caught during sweep of '
+                            'DCANBOLDProcessing: %s' % ', '.join(failed))
+
@@ -0,0 +1,238 @@
+"""
+Export of pipeline execution timelines in the Chrome Trace Event format, for
+chrome://tracing or https://ui.perfetto.dev.
+
+Timelines are built from the timing spans of profiling.py.  Each session is
+a process in the trace.  Its first lane holds the stages and the phases run
+by the main process (setup, teardown, checks); each further lane is a worker
+slot, holding the subprocesses which ran concurrently.  Optionally, the CPU
+usage and memory of the session's process tree are sampled as counters.
+"""
+import argparse
+import contextlib
+import glob
+import json
+import os
+import threading
+import time
+
+import profiling
+
+# spans drawn in the worker slot lanes rather than the main lane
+SLOT_SPANS = ('subprocess',)
+
+
+def _proc_tree(root):
+    """
+    :return: list of pids of root and all its descendants.
+    """
+    children = {}
+    for stat in glob.glob('/proc/[0-9]*/stat'):
+        try:
+            with open(stat) as fd:
+                fields = fd.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        pid = int(stat.split('/')[2])
+        children.setdefault(int(fields[1]), []).append(pid)
+    tree, stack = [], [root]
+    while stack:
+        pid = stack.pop()
+        tree.append(pid)
+        stack.extend(children.get(pid, []))
+    return tree
+
+
+def _proc_usage(pid):
+    """
+    :return: (cpu seconds, resident bytes) of a process, or None.
+    """
+    try:
+        with open('/proc/%d/stat' % pid) as fd:
+            fields = fd.read().rsplit(')', 1)[1].split()
+        with open('/proc/%d/statm' % pid) as fd:
+            resident = int(fd.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    ticks = os.sysconf('SC_CLK_TCK')
+    cpu = (int(fields[11]) + int(fields[12])) / ticks
+    return cpu, resident * os.sysconf('SC_PAGE_SIZE')
+
+
+class Sampler(object):
+    """
+    samples the cores in use and resident memory of the current process and
+    its descendants, recording them as counters in the span log.  Only
+    available where /proc is.
+    """
+
+    def __init__(self, interval=1.):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        last, last_time = {}, time.time()
+        while not self._stop.wait(self.interval):
+            now = time.time()
+            usage = {pid: _proc_usage(pid) for pid in _proc_tree(os.getpid())}
+            usage = {k: v for k, v in usage.items() if v is not None}
+            busy = sum(cpu - last[pid] for pid, (cpu, _) in usage.items()
+                       if pid in last)
+            rss = sum(r for _, r in usage.values())
+            profiling.record_span(
+                'counters', now, now, counter=True,
+                cores=max(busy, 0.) / (now - last_time),
+                rss_mib=rss / 2 ** 20, processes=len(usage))
+            last = {pid: cpu for pid, (cpu, _) in usage.items()}
+            last_time = now
+
+    def start(self):
+        if not os.path.isdir('/proc'):
+            print('/proc is not available, cpu and memory are not sampled.')
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+
+def _assign_slots(spans):
+    """
+    places each span in the lowest numbered slot which is free at its start.
+    :return: list of slot numbers, parallel to spans
+    """
+    slot_ends = []
+    slots = [None] * len(spans)
+    for i in sorted(range(len(spans)), key=lambda i: spans[i]['start']):
+        for slot, end in enumerate(slot_ends):
+            if end <= spans[i]['start']:
+                break
+        else:
+            slot = len(slot_ends)
+            slot_ends.append(0)
+        slot_ends[slot] = spans[i]['end']
+        slots[i] = slot + 1
+    return slots
+
+
+def to_trace_events(records, pid=1, name='session'):
+    """
+    converts the span log of one session to trace events.
+    :param records: span records, see profiling.read_spans
+    :param pid: trace process id of the session.
+    :param name: label of the session.
+    :return: list of trace event dicts
+    """
+    events = [{'name': 'process_name', 'ph': 'M', 'pid': pid,
+               'args': {'name': name}},
+              {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+               'args': {'name': 'main'}}]
+    counters = [r for r in records if r.get('counter')]
+    spans = [r for r in records if not r.get('counter')]
+    slotted = [r for r in spans if r['name'] in SLOT_SPANS]
+    slots = _assign_slots(slotted)
+    for slot in sorted(set(slots)):
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                       'tid': slot, 'args': {'name': 'slot %d' % slot}})
+    tids = {id(r): slot for r, slot in zip(slotted, slots)}
+
+    for r in spans:
+        args = {k: v for k, v in r.items()
+                if k not in ('name', 'start', 'end', 'pid', 'tid')}
+        label = r['name']
+        if r['name'] in ('stage',) + SLOT_SPANS:
+            label = ' '.join(str(x) for x in
+                             (r.get('stage'), r.get('task')) if x)
+        elif r.get('stage'):
+            label = '%s %s' % (r.get('stage'), r['name'])
+        events.append({'name': label, 'cat': r['name'], 'ph': 'X',
+                       'ts': r['start'] * 1e6,
+                       'dur': (r['end'] - r['start']) * 1e6,
+                       'pid': pid, 'tid': tids.get(id(r), 0),
+                       'args': dict(args, os_pid=r.get('pid'))})
+    for r in counters:
+        events.append({'name': 'cores', 'ph': 'C', 'ts': r['start'] * 1e6,
+                       'pid': pid, 'args': {'cores': r['cores']}})
+        events.append({'name': 'memory', 'ph': 'C', 'ts': r['start'] * 1e6,
+                       'pid': pid, 'args': {'rss MiB': r['rss_mib']}})
+    return events
+
+
+def write_trace(path, sessions):
+    """
+    :param path: output trace json.
+    :param sessions: list of (label, span log path) tuples
+    """
+    events = []
+    for pid, (label, span_log) in enumerate(sessions, start=1):
+        events += to_trace_events(profiling.read_spans(span_log), pid, label)
+    with open(path, 'w') as fd:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fd)
+
+
+@contextlib.contextmanager
+def session(logs, interval=None):
+    """
+    samples counters while the block runs, then writes the session's trace
+    to logs/profile/trace.json.
+    :param logs: the session's log directory.
+    :param interval: seconds between cpu and memory samples, or None.
+    """
+    sampler = Sampler(interval) if interval else None
+    if sampler:
+        sampler.start()
+    try:
+        yield
+    finally:
+        if sampler:
+            sampler.stop()
+        folder = os.path.join(logs, profiling.Profiler.folder)
+        # sub-<id> ses-<id>
+        label = ' '.join(os.path.normpath(logs).split(os.sep)[-3:-1])
+        write_trace(os.path.join(folder, 'trace.json'),
+                    [(label, os.path.join(folder, 'spans.jsonl'))])
+
+
+def generate_parser(parser=None):
+    """
+    Generates the command line parser for the trace mode.
+    :param parser: optional subparser for wrapping this program as a submodule.
+    :return: ArgumentParser for this script/module
+    """
+    if not parser:
+        parser = argparse.ArgumentParser(
+            prog='nhp-abcd-bids-pipeline trace',
+            description='merge the timelines of all sessions in an output '
+                        'directory, recorded with --trace or --profile, into '
+                        'a single Chrome trace, one process per session.'
+        )
+    parser.add_argument(
+        'output_dir',
+        help='pipeline output directory.'
+    )
+    parser.add_argument(
+        'trace',
+        help='path of the merged trace json.'
+    )
+    return parser
+
+
+def _cli(mode='trace', argv=None):
+    args = generate_parser().parse_args(argv)
+    pattern = os.path.join(args.output_dir, 'sub-*', 'ses-*', 'logs',
+                           profiling.Profiler.folder, 'spans.jsonl')
+    sessions = []
+    for span_log in sorted(glob.glob(pattern)):
+        parts = span_log[len(args.output_dir):].strip(os.sep).split(os.sep)
+        sessions.append((' '.join(parts[:2]), span_log))
+    write_trace(args.trace, sessions)
+    print('wrote %d sessions to %s' % (len(sessions), args.trace))
+
+
+if __name__ == '__main__':
+    import sys
+    exit(_cli(argv=sys.argv[1:]))
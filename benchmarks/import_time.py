@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Import time budget of the command line interface.  Runs run.py with
+--version, --help and without arguments (a usage error) under
+python -X importtime, and fails if any of them imports a module which should
+only be loaded once a run has been validated (pybids, multiprocessing, the
+pipeline stages, ...) or if the best of --repeat runs spends more than
+--budget milliseconds in imports.
+
+    python3 benchmarks/import_time.py --budget 100
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+RUN = os.path.join(os.path.dirname(HERE), 'app', 'run.py')
+
+COMMANDS = (['--version'], ['--help'], [])
+
+# modules which must not be imported before interface() has validated the
+# arguments and the license.
+DEFERRED = ('bids', 'multiprocessing', 'inspect', 'pstats', 'tracemalloc',
+            'pipelines', 'history', 'profiling', 'metrics', 'numpy',
+            'nibabel')
+
+
+def import_times(args):
+    """
+    :param args: command line arguments of run.py
+    :return: (dict of top level module name to cumulative import
+    microseconds, set of the names of all imported modules)
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', RUN] + args,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    times, modules = {}, set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            continue  # header
+        modules.add(name.strip())
+        # nested imports are indented
+        if not name[1:].startswith(' '):
+            times[name.strip()] = int(cumulative)
+    return times, modules
+
+
+def check(budget, repeat=5):
+    """
+    :param budget: milliseconds allowed for imports.
+    :param repeat: runs per command, of which the fastest is used.
+    :return: list of failure messages
+    """
+    failures = []
+    for args in COMMANDS:
+        command = ' '.join(['run.py'] + args)
+        runs = [import_times(args) for _ in range(repeat)]
+        best, modules = min(runs, key=lambda run: sum(run[0].values()))
+        total = sum(best.values()) / 1000.
+        slowest = sorted(best.items(), key=lambda x: -x[1])[:5]
+        print('%-16s %8.1f ms  (%s)' % (command, total, ', '.join(
+            '%s %.1f' % (name, us / 1000.) for name, us in slowest)))
+        deferred = sorted(name for name in modules
+                          if name.split('.')[0] in DEFERRED)
+        if deferred:
+            failures.append('%s imports %s' % (command, ', '.join(deferred)))
+        if total > budget:
+            failures.append('%s spends %.1f ms in imports, over the budget '
+                            'of %.1f ms' % (command, total, budget))
+    return failures
+
+
+def generate_parser(parser=None):
+    if not parser:
+        parser = argparse.ArgumentParser(
+            description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget', type=float, default=100.,
+                        help='milliseconds allowed for imports. Default = '
+                             '100.')
+    parser.add_argument('--repeat', type=int, default=5)
+    return parser
+
+
+def _cli():
+    args = generate_parser().parse_args()
+    failures = check(args.budget, args.repeat)
+    for message in failures:
+        print('FAIL: %s' % message)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(_cli())
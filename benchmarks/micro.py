@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks of the orchestration hot paths, run on synthetic cohorts of
+increasing size.  Each operation is timed over the whole cohort; the best of
+--repeat runs is reported.
+
+Results may be saved as a baseline, and later runs compared against it: any
+operation slower than --threshold times its baseline is reported as a
+regression and the script exits non-zero.  Baselines are only comparable on
+the machine which produced them.
+
+    python3 benchmarks/micro.py --sizes 10 100 --save baseline.json
+    python3 benchmarks/micro.py --sizes 10 100 --baseline baseline.json
+"""
+import argparse
+import inspect
+import json
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+APP = os.path.join(os.path.dirname(HERE), 'app')
+sys.path.insert(0, HERE)
+sys.path.insert(0, APP)
+
+import stubs
+import synthetic_bids
+
+DEFAULT_SIZES = (10, 100, 1000)
+
+# operations whose baseline is below this many seconds are too noisy to be
+# held to the threshold.
+MIN_SECONDS = 0.01
+
+
+def _timed(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, value
+
+
+def bench_cohort(bids_dir, output_dir, repeat=3):
+    """
+    times each hot path over every session of a dataset.
+    :return: dict of operation name to seconds
+    """
+    from bids.layout import BIDSLayout
+    from helpers import read_bids_dataset
+    from pipelines import (ParameterSettings, PreliminaryMasking,
+                           PreFreeSurfer, FreeSurfer, PostFreeSurfer,
+                           FMRIVolume, FMRISurface, DCANBOLDProcessing,
+                           ExecutiveSummary)
+    stage_classes = (PreliminaryMasking, PreFreeSurfer, FreeSurfer,
+                     PostFreeSurfer, FMRIVolume, FMRISurface,
+                     DCANBOLDProcessing, ExecutiveSummary)
+    times = {}
+
+    times['BIDSLayout'], layout = _timed(
+        lambda: BIDSLayout(bids_dir, index_metadata=True), 1)
+    times['read_bids_dataset'], sessions = _timed(
+        lambda: list(read_bids_dataset(bids_dir, layout=layout)), repeat)
+
+    def out_dir(session):
+        return os.path.join(output_dir, 'sub-%s' % session['subject'],
+                            'ses-%s' % session['session'])
+
+    times['ParameterSettings.__init__'], specs = _timed(
+        lambda: [ParameterSettings(s, out_dir(s)) for s in sessions], repeat)
+    times['ParameterSettings.get_params'], _ = _timed(
+        lambda: [spec.get_params() for spec in specs], repeat)
+    times['Stage.__init__'], stages = _timed(
+        lambda: [[cls(spec) for cls in stage_classes] for spec in specs],
+        repeat)
+    stages = [stage for session in stages for stage in session]
+
+    def cmdlines():
+        for stage in stages:
+            cmdline = stage.cmdline()
+            if inspect.isgenerator(cmdline):
+                list(cmdline)
+    times['Stage.cmdline'], _ = _timed(cmdlines, repeat)
+    times['Stage.__str__'], _ = _timed(
+        lambda: [str(s) for s in stages], repeat)
+    times['Stage.get_expected_outputs'], _ = _timed(
+        lambda: [s.get_expected_outputs() for s in stages], repeat)
+
+    def update_status():
+        for stage in stages:
+            stage.status.update_start_run()
+            stage.status.update_success()
+    times['Status updates'], _ = _timed(update_status, repeat)
+    return times
+
+
+def run(sizes, work_dir, repeat=3):
+    """
+    :param sizes: numbers of sessions of the synthetic cohorts.
+    :param work_dir: datasets are generated here, and reused if present.
+    :return: {size: {operation: seconds}}
+    """
+    os.environ.update(stubs.install(os.path.join(work_dir, 'stubs')))
+    results = {}
+    for size in sizes:
+        bids_dir = os.path.join(work_dir, 'bids-%d' % size)
+        if not os.path.exists(os.path.join(bids_dir,
+                                           'dataset_description.json')):
+            print('generating %d sessions' % size)
+            synthetic_bids.generate(bids_dir, subjects=size, runs=2)
+        output_dir = tempfile.mkdtemp(dir=work_dir, prefix='output-')
+        print('timing %d sessions' % size)
+        results[str(size)] = bench_cohort(bids_dir, output_dir, repeat)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    :return: list of regression messages
+    """
+    regressions = []
+    for size, times in results.items():
+        for op, seconds in times.items():
+            reference = baseline.get(size, {}).get(op)
+            if reference is None or reference < MIN_SECONDS:
+                continue
+            if seconds > reference * threshold:
+                regressions.append(
+                    '%s sessions, %s: %.3fs vs baseline %.3fs (x%.2f)' %
+                    (size, op, seconds, reference, seconds / reference))
+    return regressions
+
+
+def generate_parser(parser=None):
+    if not parser:
+        parser = argparse.ArgumentParser(
+            description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=list(DEFAULT_SIZES),
+                        help='cohort sizes in sessions. Default: 10 100 1000.')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--work-dir',
+                        help='directory for generated datasets, reused '
+                             'between runs. Default: a new temporary '
+                             'directory.')
+    parser.add_argument('--save', metavar='BASELINE',
+                        help='write results as a baseline json.')
+    parser.add_argument('--baseline', metavar='BASELINE',
+                        help='compare results to a baseline json.')
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help='fail when an operation takes more than '
+                             'THRESHOLD times its baseline. Default = 1.5.')
+    return parser
+
+
+def _cli():
+    args = generate_parser().parse_args()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='nhp-micro-')
+    os.makedirs(work_dir, exist_ok=True)
+    results = run(args.sizes, work_dir, args.repeat)
+    for size, times in results.items():
+        print('%s sessions' % size)
+        for op, seconds in times.items():
+            print('    %-32s %10.4fs' % (op, seconds))
+    if args.save:
+        with open(args.save, 'w') as fd:
+            json.dump(results, fd, indent=4)
+    if args.baseline:
+        with open(args.baseline) as fd:
+            regressions = compare(results, json.load(fd), args.threshold)
+        for message in regressions:
+            print('REGRESSION: %s' % message)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_cli())
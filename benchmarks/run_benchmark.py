@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+End to end orchestration benchmark.  Generates a synthetic bids dataset,
+installs stub stage scripts, runs the pipeline through run.interface() (or
+through spool workers), and reports:
+
+    makespan     wall time from first submission to last stub exit
+    utilisation  stub busy time / (makespan * cores)
+    overhead     time during which no stub was running, i.e. time spent in
+                 orchestration: bids indexing, planning, pool start up,
+                 expected output checks and scheduling gaps.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+APP = os.path.join(os.path.dirname(HERE), 'app')
+sys.path.insert(0, HERE)
+sys.path.insert(0, APP)
+
+import stubs
+import synthetic_bids
+
+
+def _union(intervals):
+    """
+    :return: total length covered by a list of (start, end) intervals.
+    """
+    total = 0.
+    current_start = current_end = None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+def summarize(log, start, end, cores):
+    """
+    :param log: path of the stub invocation log.
+    :param start: benchmark start time.
+    :param end: benchmark end time.
+    :param cores: number of cores available to the pipeline.
+    :return: dict of benchmark metrics
+    """
+    with open(log) as fd:
+        records = [json.loads(line) for line in fd if line.strip()]
+    intervals = [(r['start'], r['end']) for r in records]
+    makespan = end - start
+    busy = sum(e - s for s, e in intervals)
+    per_stage = {}
+    for r in records:
+        per_stage[r['stage']] = per_stage.get(r['stage'], 0) + \
+            r['end'] - r['start']
+    return {
+        'makespan': makespan,
+        'cores': cores,
+        'stub_invocations': len(records),
+        'busy_seconds': busy,
+        'utilisation': busy / (makespan * cores) if makespan else 0.,
+        'overhead_seconds': makespan - _union(intervals),
+        'stage_seconds': per_stage,
+    }
+
+
+def benchmark(work_dir, ncpus=1, workers=0, schedule='critical-path',
+              dataset_kwargs=None, interface_kwargs=None):
+    """
+    :param work_dir: directory for the dataset, stubs and outputs.
+    :param ncpus: --ncpus of each session.
+    :param workers: number of spool workers; 0 runs sessions sequentially
+    in this process, as a plain pipeline invocation does.
+    :param schedule: spool scheduling policy.
+    :param dataset_kwargs: keyword arguments for synthetic_bids.generate.
+    :param interface_kwargs: additional keyword arguments for interface.
+    :return: dict of benchmark metrics
+    """
+    bids_dir = synthetic_bids.generate(os.path.join(work_dir, 'bids'),
+                                       **(dataset_kwargs or {}))
+    output_dir = os.path.join(work_dir, 'output')
+    log = os.path.join(work_dir, 'stubs.jsonl')
+    os.environ.update(stubs.install(os.path.join(work_dir, 'stubs')))
+    os.environ['BENCH_LOG'] = log
+    open(log, 'w').close()
+
+    from run import interface
+    kwargs = dict(interface_kwargs or {}, ncpus=ncpus)
+    start = time.time()
+    if workers:
+        spool = os.path.join(work_dir, 'spool')
+        interface(bids_dir, output_dir, spool=spool, schedule=schedule,
+                  **kwargs)
+        procs = [subprocess.Popen([sys.executable,
+                                   os.path.join(APP, 'run.py'), 'worker',
+                                   spool, '--poll', '0.1',
+                                   '--heartbeat', '1', '--timeout', '30'])
+                 for _ in range(workers)]
+        for proc in procs:
+            proc.wait()
+    else:
+        interface(bids_dir, output_dir, **kwargs)
+    end = time.time()
+    return summarize(log, start, end, ncpus * max(1, workers))
+
+
+def generate_parser(parser=None):
+    if not parser:
+        parser = argparse.ArgumentParser(
+            description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--work-dir',
+                        help='directory for dataset, stubs and outputs. '
+                             'Default: a new temporary directory.')
+    parser.add_argument('--subjects', type=int, default=2)
+    parser.add_argument('--sessions', type=int, default=1)
+    parser.add_argument('--runs', type=int, default=2)
+    parser.add_argument('--volumes', type=int, nargs=2, default=[100, 400],
+                        metavar=('MIN', 'MAX'))
+    parser.add_argument('--ncpus', type=int, default=2)
+    parser.add_argument('--workers', type=int, default=0,
+                        help='number of spool workers. Default: none, '
+                             'sessions run sequentially.')
+    parser.add_argument('--schedule', default='critical-path',
+                        choices=['critical-path', 'fifo'])
+    parser.add_argument('--scale', type=float, default=1.,
+                        help='multiplier for all stub durations.')
+    parser.add_argument('--jitter', type=float, default=2.,
+                        help='anatomical stages take up to 1 + JITTER times '
+                             'longer, varying by subject. Default = 2.')
+    parser.add_argument('--memory-mb', type=float, default=0,
+                        help='memory held by each stub.')
+    parser.add_argument('--report', help='write the metrics json here.')
+    return parser
+
+
+def _cli():
+    args = generate_parser().parse_args()
+    os.environ['BENCH_SCALE'] = str(args.scale)
+    os.environ['BENCH_JITTER'] = str(args.jitter)
+    os.environ['BENCH_MEMORY_MB'] = str(args.memory_mb)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='nhp-bench-')
+    metrics = benchmark(
+        work_dir, ncpus=args.ncpus, workers=args.workers,
+        schedule=args.schedule,
+        dataset_kwargs=dict(subjects=args.subjects, sessions=args.sessions,
+                            runs=args.runs, volumes=tuple(args.volumes)))
+    text = json.dumps(metrics, indent=4)
+    print(text)
+    if args.report:
+        with open(args.report, 'w') as fd:
+            fd.write(text + '\n')
+
+
+if __name__ == '__main__':
+    _cli()
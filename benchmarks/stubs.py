@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Stand-ins for the HCP, DCANBOLDProcessing, ExecutiveSummary and CustomClean
+scripts.  Each stub sleeps, holds a block of memory, then writes the stage's
+expected outputs from pipeline_expected_outputs.json, so the orchestration
+in app/ can be exercised end to end in seconds.
+
+A stub invocation is recorded as a json line in $BENCH_LOG:
+    {"stage": ..., "task": ..., "session": ..., "start": ..., "end": ...}
+
+install() writes one executable wrapper per Stage.script, and returns the
+environment variables pointing the pipeline at them.
+"""
+import gzip
+import hashlib
+import json
+import os
+import stat
+import struct
+import sys
+import time
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+APP = os.path.join(os.path.dirname(HERE), 'app')
+
+# stub run time in seconds.  Per-run stages are given per 100 bold volumes.
+DURATIONS = {
+    'PreliminaryMasking': 0.5,
+    'PreFreeSurfer': 2.,
+    'FreeSurfer': 6.,
+    'PostFreeSurfer': 1.,
+    'FMRIVolume': 1.,
+    'FMRISurface': 0.2,
+    'DCANBOLDProcessing': 0.4,
+    'ExecutiveSummary': 0.3,
+    'CustomClean': 0.1,
+}
+PER_RUN_STAGES = ('FMRIVolume', 'FMRISurface', 'DCANBOLDProcessing')
+
+# environment variables referenced by Stage.script and ParameterSettings
+SCRIPT_ROOTS = ('HCPPIPEDIR', 'DCANBOLDPROCDIR', 'EXECSUMDIR',
+                'CUSTOMCLEANDIR')
+
+
+def _parse(argv):
+    """
+    parses --key=value and --key value pairs, and bare --flags.
+    """
+    args = {}
+    key = None
+    for token in argv:
+        if token.startswith('--'):
+            key, sep, value = token[2:].partition('=')
+            args[key] = value if sep else True
+            if sep:
+                key = None
+        elif key is not None:
+            args[key] = token if args[key] is True else \
+                '%s %s' % (args[key], token)
+    return args
+
+
+def _nifti_dims(filename):
+    with gzip.open(filename, 'rb') as fd:
+        header = fd.read(56)
+    dim = struct.unpack('<8h', header[40:56])
+    return dim[1:dim[0] + 1]
+
+
+def _write_output(filename, dims=(2, 2, 2)):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    if filename.endswith(('.nii', '.nii.gz')):
+        sys.path.insert(0, HERE)
+        from synthetic_bids import write_nifti
+        write_nifti(filename, dims)
+    else:
+        with open(filename, 'w') as fd:
+            fd.write('stub\n')
+
+
+def _results(path, fmriname):
+    return os.path.join(path, 'MNINonLinear', 'Results', fmriname,
+                        fmriname + '.nii.gz')
+
+
+def run(stage, argv):
+    args = _parse(argv)
+    # every script names the session's output folder differently
+    path = args.get('path') or args.get('output-folder') or \
+        args.get('output-dir') or args.get('dir')
+    if not path and 'subjectDIR' in args:
+        path = os.path.dirname(args['subjectDIR'])
+    fmriname = args.get('fmriname') or args.get('task')
+    subject = args.get('subject') or args.get('participant-label', '')
+
+    # per-run stages scale with the run's volumes, other stages vary per
+    # subject, as FreeSurfer does between animals.
+    seconds = DURATIONS.get(stage, 0.1)
+    dims = None
+    if stage == 'FMRIVolume':
+        dims = _nifti_dims(args['fmritcs'])
+    elif fmriname and os.path.exists(_results(path, fmriname)):
+        dims = _nifti_dims(_results(path, fmriname))
+    if stage in PER_RUN_STAGES:
+        if 'setup' in args or 'teardown' in args:
+            seconds *= 0.5
+        elif dims:
+            seconds *= dims[3] / 100.
+    else:
+        digest = hashlib.md5(subject.encode()).digest()[0]
+        seconds *= 1 + float(os.environ.get('BENCH_JITTER', 0)) * \
+            digest / 255.
+    seconds *= float(os.environ.get('BENCH_SCALE', 1))
+
+    start = time.time()
+    memory = bytearray(int(float(os.environ.get('BENCH_MEMORY_MB', 0)) *
+                           2 ** 20))
+    memory[::4096] = b'\1' * len(memory[::4096])
+    time.sleep(seconds)
+    del memory
+
+    with open(os.path.join(APP, 'pipeline_expected_outputs.json')) as fd:
+        spec = json.load(fd).get(stage, [])
+    keys = dict(os.environ, **args)
+    keys.update(path=path, subject=subject, fmriname=fmriname)
+    for template in spec:
+        try:
+            filename = template.format(**keys)
+        except (KeyError, IndexError):
+            continue
+        if dims and filename == _results(path, fmriname):
+            _write_output(filename, dims)
+        elif dims and filename.endswith('.dtseries.nii'):
+            # cifti dense time series: time points by grayordinates
+            _write_output(filename, (1, 1, 1, 1, dims[3], 16))
+        else:
+            _write_output(filename)
+
+    log = os.environ.get('BENCH_LOG')
+    if log:
+        record = {'stage': stage, 'task': fmriname, 'session': path,
+                  'start': start, 'end': time.time(), 'pid': os.getpid()}
+        with open(log, 'a') as fd:
+            fd.write(json.dumps(record) + '\n')
+    return 0
+
+
+def install(root):
+    """
+    writes executable stubs for every pipeline stage script under root.
+    :param root: directory for the stubs.
+    :return: dict of environment variables for running the pipeline
+    """
+    sys.path.insert(0, APP)
+    import pipelines
+    env = {name: os.path.join(root, name.lower()) for name in SCRIPT_ROOTS}
+    env.update({
+        'HCPPIPEDIR_Templates': os.path.join(root, 'templates'),
+        'HCPPIPEDIR_Config': os.path.join(root, 'config'),
+        'DCANBOLDPROCVER': 'DCANBOLDProc_stub',
+        'FREESURFER_HOME': os.path.join(root, 'freesurfer'),
+    })
+    for folder in env.values():
+        if os.path.isabs(folder):
+            os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(env['FREESURFER_HOME'], 'license.txt'), 'w') as fd:
+        fd.write('stub license\n')
+
+    for stage in pipelines.Stage.__subclasses__():
+        script = stage.script.format(**env)
+        os.makedirs(os.path.dirname(script), exist_ok=True)
+        with open(script, 'w') as fd:
+            fd.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n' % (
+                sys.executable, os.path.realpath(__file__), stage.__name__))
+        os.chmod(script, os.stat(script).st_mode | stat.S_IXUSR)
+    return env
+
+
+if __name__ == '__main__':
+    sys.exit(run(sys.argv[1], sys.argv[2:]))
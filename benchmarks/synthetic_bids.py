@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Generates a synthetic BIDS dataset which satisfies everything the pipeline
+reads: T1w/T2w with sidecar metadata, bold runs with phase encoding, and
+spin echo field map pairs with IntendedFor.  Images are tiny but have valid
+nifti-1 headers, with a configurable number of bold volumes.
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import struct
+
+# int16 nifti-1 header, voxel data starting at vox_offset 352
+NIFTI_DATATYPE_INT16 = 4
+
+
+def write_nifti(filename, dims, pixdim=1.0):
+    """
+    writes a nifti-1 file of zeros, gzipped if the filename ends in .gz
+    :param filename: output path ending in .nii or .nii.gz
+    :param dims: image dimensions, e.g. (8, 8, 8) or (4, 4, 4, 120)
+    :param pixdim: voxel size in mm (and TR in seconds for 4d images)
+    """
+    header = bytearray(352)
+    struct.pack_into('<i', header, 0, 348)
+    dim = [len(dims)] + list(dims) + [1] * (7 - len(dims))
+    struct.pack_into('<8h', header, 40, *dim)
+    struct.pack_into('<hh', header, 70, NIFTI_DATATYPE_INT16, 16)
+    struct.pack_into('<8f', header, 76, 1., *([pixdim] * 7))
+    struct.pack_into('<f', header, 108, 352.)
+    struct.pack_into('<f', header, 112, 1.)  # scl_slope
+    struct.pack_into('<h', header, 252, 1)   # qform_code
+    struct.pack_into('<4s', header, 344, b'n+1\0')
+    size = 1
+    for d in dims:
+        size *= d
+    if filename.endswith('.gz'):
+        fd = gzip.open(filename, 'wb', compresslevel=1)
+    else:
+        fd = open(filename, 'wb')
+    with fd:
+        fd.write(bytes(header))
+        fd.write(bytes(2 * size))
+
+
+def _write_json(filename, data):
+    with open(filename, 'w') as fd:
+        json.dump(data, fd, indent=4)
+
+
+def generate(root, subjects=2, sessions=1, runs=2, tasks=('rest',),
+             volumes=(100, 400), t2=True, fieldmaps=True, seed=0):
+    """
+    :param root: output directory of the dataset.
+    :param subjects: number of subjects.
+    :param sessions: number of sessions per subject.
+    :param runs: number of runs per task per session.
+    :param tasks: task names.
+    :param volumes: (min, max) number of volumes per bold run.
+    :param t2: include a T2w image per session.
+    :param fieldmaps: include a spin echo field map pair per session.
+    :param seed: random seed for the number of volumes.
+    :return: root
+    """
+    rng = random.Random(seed)
+    os.makedirs(root, exist_ok=True)
+    _write_json(os.path.join(root, 'dataset_description.json'),
+                {'Name': 'synthetic', 'BIDSVersion': '1.4.0'})
+    anat_meta = {
+        'DwellTime': 7.8e-06,
+        'ImageOrientationPatientDICOM': [1, 0, 0, 0, 1, 0],
+        'InPlanePhaseEncodingDirectionDICOM': 'ROW',
+    }
+    for s in range(1, subjects + 1):
+        subject = 'sub-%02d' % s
+        for t in range(1, sessions + 1):
+            session = 'ses-%02d' % t
+            prefix = '%s_%s' % (subject, session)
+            base = os.path.join(root, subject, session)
+            for folder in ('anat', 'func', 'fmap'):
+                os.makedirs(os.path.join(base, folder), exist_ok=True)
+
+            anat = os.path.join(base, 'anat', prefix)
+            write_nifti(anat + '_T1w.nii.gz', (8, 8, 8), 0.5)
+            _write_json(anat + '_T1w.json', anat_meta)
+            if t2:
+                write_nifti(anat + '_T2w.nii.gz', (8, 8, 8), 0.5)
+                _write_json(anat + '_T2w.json', anat_meta)
+
+            # the anatomical spin echo pair is found by "T1w" in IntendedFor
+            intended = ['%s/anat/%s_T1w.nii.gz' % (session, prefix)]
+            for task in tasks:
+                for r in range(1, runs + 1):
+                    name = '%s_task-%s_run-%02d_bold' % (prefix, task, r)
+                    func = os.path.join(base, 'func', name)
+                    write_nifti(func + '.nii.gz',
+                                (4, 4, 4, rng.randint(*volumes)), 1.5)
+                    _write_json(func + '.json', {
+                        'RepetitionTime': 1.5,
+                        'PhaseEncodingDirection': 'j-',
+                        'EffectiveEchoSpacing': 0.00051,
+                    })
+                    intended.append('%s/func/%s.nii.gz' % (session, name))
+
+            if fieldmaps:
+                for direction, ped in (('AP', 'j-'), ('PA', 'j')):
+                    name = '%s_dir-%s_epi' % (prefix, direction)
+                    fmap = os.path.join(base, 'fmap', name)
+                    write_nifti(fmap + '.nii.gz', (4, 4, 4), 1.5)
+                    _write_json(fmap + '.json', {
+                        'PhaseEncodingDirection': ped,
+                        'EffectiveEchoSpacing': 0.00051,
+                        'TotalReadoutTime': 0.04,
+                        'IntendedFor': intended,
+                    })
+    return root
+
+
+def generate_parser(parser=None):
+    if not parser:
+        parser = argparse.ArgumentParser(
+            description='generate a synthetic bids dataset for benchmarks.')
+    parser.add_argument('output_dir')
+    parser.add_argument('--subjects', type=int, default=2)
+    parser.add_argument('--sessions', type=int, default=1)
+    parser.add_argument('--runs', type=int, default=2,
+                        help='runs per task per session.')
+    parser.add_argument('--tasks', nargs='+', default=['rest'])
+    parser.add_argument('--volumes', type=int, nargs=2, default=[100, 400],
+                        metavar=('MIN', 'MAX'))
+    parser.add_argument('--no-t2', dest='t2', action='store_false')
+    parser.add_argument('--no-fieldmaps', dest='fieldmaps',
+                        action='store_false')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+def _cli():
+    args = generate_parser().parse_args()
+    generate(args.output_dir, args.subjects, args.sessions, args.runs,
+             args.tasks, tuple(args.volumes), args.t2, args.fieldmaps,
+             args.seed)
+
+
+if __name__ == '__main__':
+    _cli()